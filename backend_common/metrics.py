@@ -0,0 +1,574 @@
+# coding=utf-8
+
+"""
+Custom metrics for the Python backends.
+
+Metric families are registered through the Python backend metrics API
+(`pb_utils.MetricFamily`) and show up on the server's Prometheus
+endpoint next to Triton's own metrics, labelled by model and version:
+
+    backend_batch_size                 request rows per execute call
+    backend_phase_duration_seconds     time per phase, e.g. preprocess,
+                                       tokenize, prefill, decode
+    backend_generated_tokens_total     completion tokens generated
+    backend_tokens_per_second          decode speed per completion
+    backend_memory_high_water_bytes    peak CPU (RSS) and GPU memory
+    backend_queue_depth                request rows waiting in the backend
+    backend_admission_tokens           KV cache tokens reserved, and the
+                                       budget ("state" label)
+    backend_admission_rejected_total   request rows turned away, by reason
+    backend_requests_stopped_total     request rows stopped mid-generation,
+                                       cancelled or expired ("reason" label)
+    backend_cache_lookups_total        prefix and response cache lookups
+                                       ("cache" label), by "result"
+    backend_cache_hit_ratio            hits per lookup since startup
+    backend_cache_bytes                memory held by a cache
+    backend_cache_evictions_total      entries evicted from a cache
+    backend_speculative_tokens_total   tokens drafted and accepted ("state")
+    backend_speculative_acceptance_rate  accepted per drafted token since
+                                       startup
+
+Triton releases without histogram support in the metrics API get each
+histogram as Prometheus-style `_bucket` (with an `le` label), `_sum` and
+`_count` counters, which histogram_quantile() reads the same way.
+
+Every metric call from the backend to the server is an IPC round trip,
+so updates are buffered in process and pushed by `flush()`, at most
+once per flush interval.
+
+StubMetricsApi stands in for pb_utils so that the layer can be used and
+checked without a Triton server.
+"""
+
+import bisect
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _histograms_supported(api) -> bool:
+    return getattr(api.MetricFamily, "HISTOGRAM", None) is not None
+
+
+class _Counter:
+    def __init__(self, metric):
+        self.metric = metric
+        self.pending = 0.0
+
+    def add(self, value: float = 1.0):
+        self.pending += value
+
+    def flush(self):
+        if self.pending:
+            self.metric.increment(self.pending)
+            self.pending = 0.0
+
+
+class _Gauge:
+    def __init__(self, metric):
+        self.metric = metric
+        self.value = 0.0
+        self.dirty = False
+
+    def set(self, value: float):
+        self.value = value
+        self.dirty = True
+
+    def set_max(self, value: float):
+        if value > self.value:
+            self.set(value)
+
+    def flush(self):
+        if self.dirty:
+            self.metric.set(self.value)
+            self.dirty = False
+
+
+class _Histogram:
+    """
+    Histogram on the native API when there is one, otherwise on counters.
+    """
+
+    def __init__(self, api, families: dict, labels: dict, buckets: Sequence[float]):
+        self.buckets = list(buckets)
+        self.pending_values = []
+        if "histogram" in families:
+            self.metric = families["histogram"].Metric(labels=labels, buckets=self.buckets)
+            return
+        self.metric = None
+        self.bucket_counters = [
+            _Counter(families["bucket"].Metric(labels={**labels, "le": _format_le(le)}))
+            for le in self.buckets + [float("inf")]
+        ]
+        self.sum = _Counter(families["sum"].Metric(labels=labels))
+        self.count = _Counter(families["count"].Metric(labels=labels))
+
+    def observe(self, value: float):
+        if self.metric is not None:
+            self.pending_values.append(value)
+            return
+        # Buckets are cumulative: every bucket at or above the value counts it
+        for counter in self.bucket_counters[bisect.bisect_left(self.buckets, value):]:
+            counter.add()
+        self.sum.add(value)
+        self.count.add()
+
+    def flush(self):
+        if self.metric is not None:
+            for value in self.pending_values:
+                self.metric.observe(value)
+            self.pending_values = []
+            return
+        for counter in self.bucket_counters + [self.sum, self.count]:
+            counter.flush()
+
+
+def _format_le(value: float) -> str:
+    return "+Inf" if value == float("inf") else f"{value:g}"
+
+
+class BackendMetrics:
+    """
+    :param api: triton_python_backend_utils, or a StubMetricsApi
+    :param model: model name label
+    :param version: model version label
+    :param instance: instance name, labels the per-process memory gauges
+    :param flush_interval: minimum seconds between pushes to the server
+    """
+
+    def __init__(
+        self,
+        api,
+        model: str,
+        version: str = "1",
+        instance: str = "",
+        flush_interval: float = 1.0,
+    ):
+        self.api = api
+        self.labels = {"model": model, "version": version}
+        self.instance = instance or model
+        self.flush_interval = flush_interval
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+        kind = api.MetricFamily
+        self._batch_size_families = self._histogram_families(
+            "backend_batch_size", "Request rows per execute call"
+        )
+        self._phase_families = self._histogram_families(
+            "backend_phase_duration_seconds", "Seconds spent per phase of execute"
+        )
+        self._tokens_per_second_families = self._histogram_families(
+            "backend_tokens_per_second", "Completion tokens per second of generation"
+        )
+        self._generated_tokens_family = kind(
+            name="backend_generated_tokens_total",
+            description="Completion tokens generated",
+            kind=kind.COUNTER,
+        )
+        self._memory_family = kind(
+            name="backend_memory_high_water_bytes",
+            description="Peak memory used by the model instance",
+            kind=kind.GAUGE,
+        )
+        # Only models with admission control, caches or a draft model get these
+        self._admission_families = None
+        self._stopped_family = None
+        self._cache_families = None
+        self._speculative_families = None
+        # Last cumulative totals passed in, as counters take increments
+        self._totals = {}
+
+    def _histogram_families(self, name: str, description: str) -> dict:
+        kind = self.api.MetricFamily
+        if _histograms_supported(self.api):
+            return {
+                "histogram": kind(name=name, description=description, kind=kind.HISTOGRAM)
+            }
+        return {
+            part: kind(name=f"{name}_{part}", description=description, kind=kind.COUNTER)
+            for part in ("bucket", "sum", "count")
+        }
+
+    def _get(self, key, build):
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = build()
+        return metric
+
+    def _add_total(self, key, build, total: float):
+        """
+        Advance a counter to a cumulative `total` from a stats() dict.
+        """
+        self._get(key, build).add(total - self._totals.get(key, 0))
+        self._totals[key] = total
+
+    def observe_batch(self, rows: int):
+        with self._lock:
+            self._get(
+                "batch_size",
+                lambda: _Histogram(
+                    self.api, self._batch_size_families, self.labels, BATCH_SIZE_BUCKETS
+                ),
+            ).observe(rows)
+
+    def observe_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self._get(
+                ("phase", phase),
+                lambda: _Histogram(
+                    self.api,
+                    self._phase_families,
+                    {**self.labels, "phase": phase},
+                    DURATION_BUCKETS,
+                ),
+            ).observe(seconds)
+
+    @contextmanager
+    def time(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start)
+
+    def observe_completion(
+        self, completion_tokens: int, seconds: float, prefill_seconds: Optional[float] = None
+    ):
+        """
+        Record one generated completion. With the prefill time known, the
+        rest of the generation time is recorded as decode time.
+        """
+        if prefill_seconds is not None:
+            self.observe_phase("prefill", prefill_seconds)
+            self.observe_phase("decode", max(0.0, seconds - prefill_seconds))
+        with self._lock:
+            self._get(
+                "generated_tokens",
+                lambda: _Counter(self._generated_tokens_family.Metric(labels=self.labels)),
+            ).add(completion_tokens)
+            if seconds > 0:
+                self._get(
+                    "tokens_per_second",
+                    lambda: _Histogram(
+                        self.api,
+                        self._tokens_per_second_families,
+                        self.labels,
+                        TOKENS_PER_SECOND_BUCKETS,
+                    ),
+                ).observe(completion_tokens / seconds)
+
+    def record_memory(self, gpu_bytes: Optional[int] = None):
+        """
+        Update the memory high-water marks: the process's peak RSS and,
+        when given, the peak GPU memory allocated.
+        """
+        # ru_maxrss is in kilobytes on Linux
+        values = {"cpu": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+        if gpu_bytes is not None:
+            values["gpu"] = gpu_bytes
+        with self._lock:
+            for device, value in values.items():
+                self._get(
+                    ("memory", device),
+                    lambda: _Gauge(
+                        self._memory_family.Metric(
+                            labels={**self.labels, "instance": self.instance, "device": device}
+                        )
+                    ),
+                ).set_max(value)
+
+    def record_admission(self, queue_depth: int, stats: dict):
+        """
+        Update the admission gauges and rejection counts from
+        AdmissionController.stats().
+        """
+        with self._lock:
+            if self._admission_families is None:
+                kind = self.api.MetricFamily
+                self._admission_families = {
+                    "queue_depth": kind(
+                        name="backend_queue_depth",
+                        description="Request rows waiting in the backend",
+                        kind=kind.GAUGE,
+                    ),
+                    "tokens": kind(
+                        name="backend_admission_tokens",
+                        description="KV cache tokens reserved by admitted rows, and the budget",
+                        kind=kind.GAUGE,
+                    ),
+                    "rejected": kind(
+                        name="backend_admission_rejected_total",
+                        description="Request rows rejected by admission control",
+                        kind=kind.COUNTER,
+                    ),
+                }
+                self._rejected_counts = {}
+            families = self._admission_families
+            self._get(
+                "queue_depth",
+                lambda: _Gauge(families["queue_depth"].Metric(labels=self.labels)),
+            ).set(queue_depth)
+            for state, value in (
+                ("reserved", stats["outstanding_tokens"]),
+                ("budget", stats["token_budget"]),
+            ):
+                self._get(
+                    ("admission_tokens", state),
+                    lambda: _Gauge(
+                        families["tokens"].Metric(labels={**self.labels, "state": state})
+                    ),
+                ).set(value)
+            # The controller's counts are cumulative, the counter takes increments
+            for reason, count in stats["rejected"].items():
+                self._get(
+                    ("admission_rejected", reason),
+                    lambda: _Counter(
+                        families["rejected"].Metric(labels={**self.labels, "reason": reason})
+                    ),
+                ).add(count - self._rejected_counts.get(reason, 0))
+                self._rejected_counts[reason] = count
+
+    def record_stopped(self, reason: str, rows: int = 1):
+        """
+        Count request rows that stopped generating because they were
+        cancelled or ran past their deadline.
+        """
+        with self._lock:
+            if self._stopped_family is None:
+                kind = self.api.MetricFamily
+                self._stopped_family = kind(
+                    name="backend_requests_stopped_total",
+                    description="Request rows stopped before finishing, by reason",
+                    kind=kind.COUNTER,
+                )
+            self._get(
+                ("stopped", reason),
+                lambda: _Counter(
+                    self._stopped_family.Metric(labels={**self.labels, "reason": reason})
+                ),
+            ).add(rows)
+
+    def record_cache(self, cache: str, stats: dict):
+        """
+        Update a cache's lookup counts and size from its stats(), e.g.
+        PrefixCache's or ResponseCache's.
+        :param cache: the "cache" label, e.g. "prefix" or "response"
+        """
+        with self._lock:
+            if self._cache_families is None:
+                kind = self.api.MetricFamily
+                self._cache_families = {
+                    "lookups": kind(
+                        name="backend_cache_lookups_total",
+                        description="Cache lookups, by result",
+                        kind=kind.COUNTER,
+                    ),
+                    "hit_ratio": kind(
+                        name="backend_cache_hit_ratio",
+                        description="Cache hits per lookup since startup",
+                        kind=kind.GAUGE,
+                    ),
+                    "bytes": kind(
+                        name="backend_cache_bytes",
+                        description="Memory held by the cache",
+                        kind=kind.GAUGE,
+                    ),
+                    "evictions": kind(
+                        name="backend_cache_evictions_total",
+                        description="Entries evicted from the cache",
+                        kind=kind.COUNTER,
+                    ),
+                }
+            families = self._cache_families
+            labels = {**self.labels, "cache": cache}
+            for result, total in (("hit", stats["hits"]), ("miss", stats["misses"])):
+                self._add_total(
+                    ("cache_lookups", cache, result),
+                    lambda: _Counter(
+                        families["lookups"].Metric(labels={**labels, "result": result})
+                    ),
+                    total,
+                )
+            if "evictions" in stats:
+                self._add_total(
+                    ("cache_evictions", cache),
+                    lambda: _Counter(families["evictions"].Metric(labels=labels)),
+                    stats["evictions"],
+                )
+            for name in ("hit_ratio", "bytes"):
+                self._get(
+                    (f"cache_{name}", cache),
+                    lambda: _Gauge(families[name].Metric(labels=labels)),
+                ).set(stats[name])
+
+    def record_speculative(self, stats: dict):
+        """
+        Update the draft acceptance from SpeculativeDecoder.stats().
+        """
+        with self._lock:
+            if self._speculative_families is None:
+                kind = self.api.MetricFamily
+                self._speculative_families = {
+                    "tokens": kind(
+                        name="backend_speculative_tokens_total",
+                        description="Draft tokens proposed and accepted by the target model",
+                        kind=kind.COUNTER,
+                    ),
+                    "acceptance_rate": kind(
+                        name="backend_speculative_acceptance_rate",
+                        description="Accepted per drafted token since startup",
+                        kind=kind.GAUGE,
+                    ),
+                }
+            families = self._speculative_families
+            for state in ("drafted", "accepted"):
+                self._add_total(
+                    ("speculative_tokens", state),
+                    lambda: _Counter(
+                        families["tokens"].Metric(labels={**self.labels, "state": state})
+                    ),
+                    stats[f"{state}_tokens"],
+                )
+            self._get(
+                "speculative_acceptance_rate",
+                lambda: _Gauge(families["acceptance_rate"].Metric(labels=self.labels)),
+            ).set(stats["acceptance_rate"])
+
+    def flush(self, force: bool = False):
+        """
+        Push buffered updates to the server, unless the last push was less
+        than the flush interval ago.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.flush()
+        self._last_flush = now
+
+
+def metrics_from_parameters(api, args: dict, model_params: dict) -> BackendMetrics:
+    """
+    Build the backend's metrics from its initialize() args and config
+    "parameters". With "metrics" set to "false", or a Triton without the
+    metrics API, updates only go to an in-process StubMetricsApi.
+    """
+
+    def param(key, default):
+        return model_params.get(key, {}).get("string_value", default)
+
+    enabled = param("metrics", "true") == "true" and hasattr(api, "MetricFamily")
+    return BackendMetrics(
+        api if enabled else StubMetricsApi(),
+        model=args.get("model_name", ""),
+        version=str(args.get("model_version", "1")),
+        instance=args.get("model_instance_name", ""),
+        flush_interval=float(param("metrics_flush_interval_s", "1")),
+    )
+
+
+class _StubMetric:
+    def __init__(self, family: "_StubMetricFamily", labels: dict, buckets=None):
+        self.family = family
+        self.labels = labels
+        self.value = 0.0
+        self.buckets = list(buckets) if buckets is not None else None
+        self.bucket_counts = [0] * (len(self.buckets) + 1) if buckets is not None else None
+        self.count = 0
+
+    def increment(self, value: float):
+        if self.family.kind != self.family.COUNTER or value < 0:
+            raise ValueError(f"{self.family.name}: increment() needs a counter and value >= 0")
+        self.value += value
+
+    def set(self, value: float):
+        if self.family.kind != self.family.GAUGE:
+            raise ValueError(f"{self.family.name}: set() needs a gauge")
+        self.value = value
+
+    def observe(self, value: float):
+        if self.family.kind != self.family.HISTOGRAM:
+            raise ValueError(f"{self.family.name}: observe() needs a histogram")
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.value += value
+        self.count += 1
+
+
+class _StubMetricFamily:
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+    api: "StubMetricsApi" = None
+
+    def __init__(self, name: str, description: str, kind: str):
+        if kind is None:
+            raise ValueError(f"{name}: unsupported metric kind")
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.metrics: Dict[tuple, _StubMetric] = {}
+        self.api.families[name] = self
+
+    def Metric(self, labels: dict, buckets=None):
+        key = tuple(sorted(labels.items()))
+        if key not in self.metrics:
+            self.metrics[key] = _StubMetric(self, labels, buckets)
+        return self.metrics[key]
+
+
+class StubMetricsApi:
+    """
+    In-process stand-in for the metrics part of triton_python_backend_utils.
+    :param histograms: offer the HISTOGRAM kind, as newer Triton releases do
+    """
+
+    def __init__(self, histograms: bool = True):
+        self.families: Dict[str, _StubMetricFamily] = {}
+        attributes = {"api": self}
+        if not histograms:
+            attributes["HISTOGRAM"] = None
+        self.MetricFamily = type("MetricFamily", (_StubMetricFamily,), attributes)
+
+    def value(self, name: str, **labels) -> float:
+        """
+        Current value of a counter or gauge, or the sum of a histogram.
+        """
+        family = self.families[name]
+        return family.metrics[tuple(sorted(labels.items()))].value
+
+    def exposition(self) -> str:
+        """
+        The metrics in Prometheus text format, as the server would show them.
+        """
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.description}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for metric in family.metrics.values():
+                if family.kind != family.HISTOGRAM:
+                    lines.append(f"{family.name}{_format_labels(metric.labels)} {metric.value:.15g}")
+                    continue
+                cumulative = 0
+                for le, count in zip(metric.buckets + [float("inf")], metric.bucket_counts):
+                    cumulative += count
+                    labels = _format_labels({**metric.labels, "le": _format_le(le)})
+                    lines.append(f"{family.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(metric.labels)
+                lines.append(f"{family.name}_sum{labels} {metric.value:.15g}")
+                lines.append(f"{family.name}_count{labels} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: dict) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
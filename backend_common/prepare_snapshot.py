@@ -0,0 +1,85 @@
+# coding=utf-8
+
+"""
+Offline step that downloads and converts a backend's model once and
+writes it as a local safetensors snapshot into the model's version
+directory, where the backend loads it from at startup. Run it inside the
+server image, e.g.:
+
+    python -m backend_common.prepare_snapshot llama3_8b --quantize full
+    python -m backend_common.prepare_snapshot trocr
+"""
+
+import os
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from backend_common.startup import SNAPSHOT_DIR, quantization_kwargs, save_snapshot
+
+
+def load_llama3_8b(hf_model: str, quantize: str):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(hf_model)
+    model = AutoModelForCausalLM.from_pretrained(
+        hf_model,
+        torch_dtype=torch.float16,
+        device_map="auto",
+        **quantization_kwargs(quantize),
+    )
+    model.resize_token_embeddings(len(tokenizer))
+    return model, tokenizer
+
+
+def load_trocr(hf_model: str, quantize: str):
+    from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+
+    if quantize != "full":
+        raise ValueError("trocr snapshots are saved in full precision")
+    processor = TrOCRProcessor.from_pretrained(hf_model)
+    model = VisionEncoderDecoderModel.from_pretrained(hf_model)
+    return model, processor
+
+
+# Backend name -> (hub model, loader)
+MODELS = {
+    "llama3_8b": ("meta-llama/Meta-Llama-3-8B-Instruct", load_llama3_8b),
+    "trocr": ("microsoft/trocr-small-printed", load_trocr),
+}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument(
+        "--quantize",
+        default="full",
+        choices=["full", "8bit", "4bit"],
+        help="must match the model's 'quantize' parameter",
+    )
+    parser.add_argument(
+        "--model-repository",
+        default=os.path.join(os.path.dirname(__file__), "..", "model_repository"),
+    )
+    parser.add_argument("--version", default="1")
+    parser.add_argument("--max-shard-size", default="2GB")
+    args = parser.parse_args()
+
+    import huggingface_hub
+
+    huggingface_hub.login(token=os.environ.get("HF_TOKEN"))
+    hf_model, load = MODELS[args.model]
+    output = os.path.join(args.model_repository, args.model, args.version, SNAPSHOT_DIR)
+
+    start = time.perf_counter()
+    model, tokenizer = load(hf_model, args.quantize)
+    save_snapshot(
+        output,
+        model,
+        tokenizer,
+        info={"model": hf_model, "quantize": args.quantize},
+        max_shard_size=args.max_shard_size,
+    )
+    print(f"Wrote {output} in {time.perf_counter() - start:.0f}s")
@@ -0,0 +1,277 @@
+# coding=utf-8
+
+"""
+Response cache for the Python backends.
+
+Requests are keyed on a hash of their raw input tensors plus whatever
+model parameters affect the output. Hits are answered straight away and
+only the misses are batched into the model. Entries live in memory with
+size and TTL eviction, and can also be written to a directory (e.g. on
+/dev/shm) so that every instance of a model shares them.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+Outputs = Dict[str, np.ndarray]
+# Entry of a stored archive holding the JSON record of output kinds
+_KINDS = "__kinds__"
+
+
+def hash_arrays(arrays: Iterable[np.ndarray], params: Optional[dict] = None) -> str:
+    """
+    Hash input tensors (including BYTES/object tensors) and parameters into
+    a cache key.
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        digest.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+        if array.dtype == np.object_:
+            for item in array.flat:
+                item = item if isinstance(item, bytes) else str(item).encode("utf-8")
+                digest.update(len(item).to_bytes(8, "little"))
+                digest.update(item)
+        else:
+            digest.update(np.ascontiguousarray(array).data)
+    if params:
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def outputs_nbytes(outputs: Outputs) -> int:
+    total = 0
+    for array in outputs.values():
+        if array.dtype == np.object_:
+            total += sum(len(item) for item in array.flat)
+        else:
+            total += array.nbytes
+    return total
+
+
+def _encode_outputs(outputs: Outputs) -> Dict[str, np.ndarray]:
+    """
+    Outputs as arrays that load without pickle: object (BYTES) tensors
+    become fixed-width bytes or str arrays, and a JSON record of which
+    ones they were is stored alongside them.
+    """
+    arrays, kinds = {}, {}
+    for name, array in outputs.items():
+        if array.dtype != np.object_:
+            arrays[name], kinds[name] = array, "array"
+        elif all(isinstance(item, bytes) for item in array.flat):
+            arrays[name], kinds[name] = array.astype(np.bytes_), "bytes"
+        else:
+            text = [
+                item.decode("utf-8") if isinstance(item, bytes) else str(item)
+                for item in array.flat
+            ]
+            arrays[name] = np.array(text, dtype=np.str_).reshape(array.shape)
+            kinds[name] = "str"
+    arrays[_KINDS] = np.frombuffer(json.dumps(kinds).encode("utf-8"), dtype=np.uint8)
+    return arrays
+
+
+def _decode_outputs(arrays) -> Outputs:
+    kinds = json.loads(arrays[_KINDS].tobytes().decode("utf-8"))
+    outputs = {}
+    for name, kind in kinds.items():
+        array = arrays[name]
+        outputs[name] = array if kind == "array" else array.astype(np.object_)
+    return outputs
+
+
+class DirectoryStore:
+    """
+    Cache entries as files in a directory shared by all instances.
+    Writes are atomic renames so concurrent readers never see a partial
+    entry. Entries are .npz archives loaded with allow_pickle=False, so a
+    process that can write to the directory can't run code in the backend.
+    :param path: directory to keep entries in, e.g. under /dev/shm
+    :param max_bytes: total size above which the oldest files are removed
+    :param ttl_seconds: age after which an entry is ignored
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._puts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str) -> Optional[Tuple[Outputs, float]]:
+        """
+        :return: the entry's outputs and its age in seconds, or None
+        """
+        path = self._file(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age > self.ttl_seconds:
+                return None
+            with np.load(path, allow_pickle=False) as arrays:
+                return _decode_outputs(arrays), age
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # Missing, corrupt, or not written by this version
+            return None
+
+    def put(self, key: str, outputs: Outputs):
+        tmp_path = f"{self._file(key)}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **_encode_outputs(outputs))
+        os.replace(tmp_path, self._file(key))
+        self._puts += 1
+        if self._puts % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        Remove expired entries, then the oldest until under the size budget.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    """
+    In-memory LRU of model outputs with entry-count, size and TTL limits,
+    optionally backed by a DirectoryStore shared between instances.
+    :param max_entries: maximum number of entries held in memory
+    :param max_bytes: maximum size of the outputs held in memory
+    :param ttl_seconds: age after which an entry expires
+    :param shared_dir: directory for the shared store, None for memory only
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 300,
+        shared_dir: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.store = (
+            DirectoryStore(shared_dir, max_bytes, ttl_seconds) if shared_dir else None
+        )
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, int, Outputs]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, arrays: Iterable[np.ndarray], params: Optional[dict] = None) -> str:
+        return hash_arrays(arrays, params)
+
+    def get(self, key: str) -> Optional[Outputs]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, size, outputs = entry
+                if time.monotonic() - created <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return outputs
+                del self._entries[key]
+                self.bytes -= size
+
+        stored = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        outputs, age = stored
+        # Keeps the entry's age, so reading it doesn't extend its TTL
+        self._insert(key, outputs, created=time.monotonic() - age)
+        return outputs
+
+    def put(self, key: str, outputs: Outputs):
+        self._insert(key, outputs)
+        if self.store is not None:
+            self.store.put(key, outputs)
+
+    def _insert(self, key: str, outputs: Outputs, created: Optional[float] = None):
+        """
+        :param created: time.monotonic() at which the entry was made, now
+            when None
+        """
+        if created is None:
+            created = time.monotonic()
+        size = outputs_nbytes(outputs)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            while self._entries and (
+                len(self._entries) >= self.max_entries
+                or self.bytes + size > self.max_bytes
+            ):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+            self._entries[key] = (created, size, outputs)
+            self.bytes += size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+        }
+
+
+def response_cache_from_parameters(model_params: dict) -> Optional[ResponseCache]:
+    """
+    Build the cache from a model config's "parameters", or return None
+    when "response_cache" isn't enabled.
+    """
+
+    def param(key, default):
+        return model_params.get(key, {}).get("string_value", default)
+
+    if param("response_cache", "false") != "true":
+        return None
+    return ResponseCache(
+        max_entries=int(param("response_cache_entries", "1024")),
+        max_bytes=int(float(param("response_cache_mb", "64")) * 1024 * 1024),
+        ttl_seconds=float(param("response_cache_ttl_s", "300")),
+        shared_dir=param("response_cache_dir", "") or None,
+    )
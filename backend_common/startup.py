@@ -0,0 +1,180 @@
+# coding=utf-8
+
+"""
+Fast model startup from local safetensors snapshots.
+
+Resolving a model on the hub, logging in and converting its weights on
+every container start makes cold starts take minutes. Instead,
+prepare_snapshot.py writes the converted (fp16 or quantized) weights,
+config and tokenizer into the model's version directory once, offline.
+At startup the backends load that snapshot: shards are read in parallel
+from the memory-mapped safetensors files into a model built without
+initialising its weights, and nothing touches the network.
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import torch
+from safetensors.torch import load_file
+
+SNAPSHOT_DIR = "snapshot"
+# Written next to the weights, records how the snapshot was made
+SNAPSHOT_INFO = "snapshot.json"
+
+
+class StartupTimer:
+    """
+    Wall time of each startup phase, reported as one structured record.
+    :param model_name: name the record is tagged with
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.phases: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+
+    def as_dict(self) -> dict:
+        return {
+            "model": self.model_name,
+            "startup_seconds": {
+                **self.phases,
+                "total": round(time.perf_counter() - self._start, 3),
+            },
+        }
+
+
+def quantization_kwargs(level: str) -> dict:
+    """
+    from_pretrained arguments for a "quantize" setting of "full", "8bit"
+    or "4bit".
+    """
+    if level == "8bit":
+        return {"load_in_8bit": True}
+    if level == "4bit":
+        from transformers import BitsAndBytesConfig
+
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+        return {"quantization_config": bnb_config}
+    return {}
+
+
+def snapshot_info(path: str) -> Optional[dict]:
+    """
+    What a snapshot directory was prepared from, or None if there's no
+    snapshot there.
+    """
+    try:
+        with open(os.path.join(path, SNAPSHOT_INFO)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_fingerprint(path: str) -> Optional[str]:
+    """
+    Hash of a snapshot's info file and of the name, size and modification
+    time of every file in it, which changes whenever the snapshot is
+    prepared again; None if there's no snapshot there.
+    """
+    if snapshot_info(path) is None:
+        return None
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, name))
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    with open(os.path.join(path, SNAPSHOT_INFO), "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def save_snapshot(
+    path: str, model, tokenizer, info: dict, max_shard_size: str = "2GB"
+):
+    """
+    Write a model, its tokenizer or processor and `info` to `path`.
+    The info file is written last, so an interrupted save is never used.
+    """
+    os.makedirs(path, exist_ok=True)
+    model.save_pretrained(path, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(path)
+    with open(os.path.join(path, SNAPSHOT_INFO), "w") as f:
+        json.dump(info, f, indent=2)
+
+
+def shard_files(path: str) -> List[str]:
+    index_path = os.path.join(path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return sorted(set(json.load(f)["weight_map"].values()))
+    return ["model.safetensors"]
+
+
+def load_state_dict_parallel(
+    path: str, device="cpu", num_workers: int = 4
+) -> Dict[str, torch.Tensor]:
+    """
+    Read every safetensors shard in `path` on its own thread. The reads
+    release the GIL, so shards load concurrently straight onto `device`.
+    """
+
+    def load(shard):
+        return load_file(os.path.join(path, shard), device=str(device))
+
+    state_dict = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for shard in pool.map(load, shard_files(path)):
+            state_dict.update(shard)
+    return state_dict
+
+
+def load_snapshot(
+    path: str,
+    build_model: Callable[[object], torch.nn.Module],
+    config,
+    device="cpu",
+    num_workers: int = 4,
+) -> torch.nn.Module:
+    """
+    Load an unquantized snapshot without initialising weights that are
+    about to be overwritten. The parameters are created empty and then
+    replaced by the loaded tensors, so weights are only allocated once.
+    :param path: snapshot directory
+    :param build_model: constructs the model architecture from its config
+    :param config: the snapshot's model config
+    :param device: device to load the weights onto
+    :param num_workers: shards read concurrently
+    """
+    from accelerate import init_empty_weights
+
+    with init_empty_weights(include_buffers=False):
+        model = build_model(config)
+    state_dict = load_state_dict_parallel(path, device, num_workers)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    # Tied weights (e.g. the LM head) are saved once. Composite models such
+    # as encoder-decoders tie within each sub-model.
+    for module in model.modules():
+        if hasattr(module, "tie_weights"):
+            module.tie_weights()
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"Snapshot {path} is missing weights: {missing[:5]}")
+    return model.to(device).eval()
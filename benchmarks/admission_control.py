@@ -0,0 +1,156 @@
+# coding=utf-8
+
+"""
+CPU check of llama3_8b's token-budget admission control
+(model_repository/llama3_8b/1/admission.py), in two parts:
+
+- the AdmissionController on its own, with a fake clock: a row larger
+  than the budget is rejected as too_large, a full budget rejects rows
+  whose estimated wait is over the queue limit (queue_slo) even at cold
+  start, before anything finished, and the wait follows the measured
+  drain rate once rows have finished
+- the backend with the tiny random Llama through the offline harness
+  (offline/harness.py): one dynamic batch with more rows than the budget
+  holds, and a request that can never fit. Rejected rows must get
+  UNAVAILABLE or INVALID_ARG errors while the rows admitted generate.
+
+The script exits non-zero when any of it doesn't hold.
+
+    python benchmarks/admission_control.py --budget 400 --max-queue-s 1
+"""
+
+import os
+import shutil
+import sys
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+sys.path.append(os.path.join(ROOT, "model_repository", "llama3_8b", "1"))
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from admission import AdmissionController, AdmissionRejected  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def rejection(controller: AdmissionController, tokens: int):
+    """
+    :return: the AdmissionRejected raised for `tokens`, None when admitted
+    """
+    try:
+        controller.admit(tokens)
+    except AdmissionRejected as e:
+        return e
+    return None
+
+
+def check_controller() -> list:
+    """
+    :return: failure messages, empty when everything held
+    """
+    failures = []
+    clock = FakeClock()
+    controller = AdmissionController(token_budget=1000, max_queue_seconds=2.0, clock=clock)
+
+    too_large = rejection(controller, 1001)
+    if too_large is None or too_large.retryable:
+        failures.append("a row above the whole budget wasn't rejected for good")
+
+    # Cold start: nothing has finished, the drain rate is the seeded budget
+    # per queue limit, 500 tokens/s
+    for tokens in (1000, 500):
+        if rejection(controller, tokens) is not None:
+            failures.append(f"cold start: {tokens} tokens were rejected within the queue limit")
+    queued = rejection(controller, 1000)
+    if queued is None:
+        failures.append("cold start: a row 3s away from the budget was admitted")
+    elif not queued.retryable or abs(queued.retry_after - 1.0) > 1e-6:
+        failures.append(f"cold start: expected retry after 1s, got {queued.retry_after}")
+
+    # A row frees 1000 tokens after 10s of busy time, far slower than the
+    # seed, so a row 500 tokens over the budget, 1s away at the seeded
+    # rate, is now over the limit
+    clock.now = 10.0
+    controller.release(1000)
+    wait = controller.estimated_wait(1000)
+    if rejection(controller, 1000) is None:
+        failures.append(f"measured: a row {wait:.1f}s away was admitted")
+
+    stats = controller.stats()
+    print(f"Controller: {stats}")
+    if stats["rejected"] != {"too_large": 1, "queue_slo": 2}:
+        failures.append(f"controller: unexpected rejection counts {stats['rejected']}")
+    return failures
+
+
+def request_payloads(config_path: str, count: int, max_new_tokens: int) -> list:
+    payloads = create_payload_corpus(
+        os.path.join(ROOT, "load_testing", "data", "data_llama.json"), config_path, count
+    )
+    for payload in payloads:
+        payload["inputs"] += [
+            {"name": "greedy", "datatype": "BOOL", "shape": [1, 1], "data": [True]},
+            {"name": "max_new_tokens", "datatype": "INT32", "shape": [1, 1],
+             "data": [max_new_tokens]},
+        ]
+    return payloads
+
+
+def check_backend(args) -> list:
+    """
+    :return: failure messages, empty when everything held
+    """
+    failures = []
+    model_dir = harness.tiny_model_dir(os.path.join(ROOT, "model_repository", "llama3_8b"))
+    parameters = {
+        "admission_token_budget": str(args.budget),
+        "admission_max_queue_s": str(args.max_queue_s),
+    }
+    backend = harness.OfflineBackend(model_dir, parameters=parameters)
+    try:
+        payloads = request_payloads(backend.config_path, args.requests, args.max_new_tokens)
+        payloads += request_payloads(backend.config_path, 1, args.budget)
+        responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+        codes = [r.error().code() if r.has_error() else None for r in responses]
+        stats = backend.model.admission.stats()
+    finally:
+        backend.finalize()
+        shutil.rmtree(os.path.dirname(model_dir))
+
+    batch, too_large = codes[:-1], codes[-1]
+    admitted = batch.count(None)
+    busy = batch.count(pb_utils.TritonError.UNAVAILABLE)
+    print(f"Backend: {admitted} of {len(batch)} rows admitted, {busy} told to retry; "
+          f"rejected {stats['rejected']}")
+    if too_large != pb_utils.TritonError.INVALID_ARG:
+        failures.append("backend: the request above the budget didn't get INVALID_ARG")
+    if not admitted or not busy or admitted + busy != len(batch):
+        failures.append(f"backend: expected admitted rows and UNAVAILABLE ones, got {batch}")
+    if stats["rejected"] != {"too_large": 1, "queue_slo": busy}:
+        failures.append(f"backend: unexpected rejection counts {stats['rejected']}")
+    if stats["outstanding_tokens"] or stats["outstanding_rows"]:
+        failures.append(f"backend: reservations left after the batch: {stats}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--budget", type=int, default=400, help="admission_token_budget")
+    parser.add_argument("--max-queue-s", type=float, default=1.0, help="admission_max_queue_s")
+    parser.add_argument("--requests", type=int, default=6)
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = True
+    failures = check_controller() + check_backend(args)
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
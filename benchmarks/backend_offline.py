@@ -0,0 +1,175 @@
+# coding=utf-8
+
+"""
+CPU micro-benchmarks of the backends, run through the offline harness
+(offline/harness.py) with tiny random models, so they need neither a GPU
+nor a Triton server and take well under a minute:
+
+- trocr_preprocess: BatchPreprocessor on a batch of encoded images
+- llama_bucketing: bucket_by_length over a dynamic batch of prompt lengths
+- trocr_execute: execute() on a batch of image requests
+- llama_static / llama_continuous: execute() on a batch of prompts with
+  each scheduler, generating a fixed number of tokens
+- harness_batching: the dynamic batcher feeding tiny trocr, per request
+
+Times are medians over `--repeats` runs. `--output` saves them, and with
+`--baseline` the script exits non-zero when a case got slower than the
+saved one by more than `--tolerance`, for use in CI:
+
+    python benchmarks/backend_offline.py --output baseline.json
+    python benchmarks/backend_offline.py --baseline baseline.json --tolerance 0.3
+
+Absolute numbers only compare across runs on the same machine.
+"""
+
+import base64
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+for model in ("trocr", "llama3_8b"):
+    sys.path.append(os.path.join(ROOT, "model_repository", model, "1"))
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+LOGO = os.path.abspath(os.path.join(ROOT, "assets", "triton_logo.png"))
+
+
+def timeit(fn, repeats: int) -> dict:
+    fn()  # warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median_ms": float(np.median(times)) * 1000, "p90_ms": float(np.percentile(times, 90)) * 1000}
+
+
+def tiny_backend(model: str, parameters: dict) -> harness.OfflineBackend:
+    model_dir = harness.tiny_model_dir(os.path.join(ROOT, "model_repository", model))
+    return harness.OfflineBackend(model_dir, parameters=parameters)
+
+
+def remove_backend(backend: harness.OfflineBackend):
+    backend.finalize()
+    shutil.rmtree(os.path.dirname(backend.model_dir))
+
+
+def check(responses):
+    for response in responses:
+        if response.has_error():
+            raise RuntimeError(response.error().message())
+
+
+def bench_trocr(args, results: dict, data_path: str):
+    from preprocessing import BatchPreprocessor
+
+    # The real model's 384x384 input, whatever the tiny model takes
+    preprocessor = BatchPreprocessor(image_size=(384, 384), num_workers=args.workers)
+    with open(LOGO, "rb") as f:
+        images = [base64.b64encode(f.read()).decode("utf-8")] * args.batch_size
+    results["trocr_preprocess"] = timeit(lambda: preprocessor(images), args.repeats)
+    preprocessor.close()
+
+    backend = tiny_backend("trocr", {"share_weights": "false"})
+    try:
+        payloads = create_payload_corpus(data_path, backend.config_path, args.batch_size)
+        results["trocr_execute"] = timeit(
+            lambda: check(backend.execute_payloads(payloads)), args.repeats
+        )
+
+        # Per request through the batcher, so batching overhead shows up
+        payloads = create_payload_corpus(data_path, backend.config_path, 4 * args.batch_size)
+
+        def batched():
+            summary = harness.simulate(backend, payloads)["summary"]
+            if summary["errors"]:
+                raise RuntimeError(f"{summary['errors']} failed requests")
+
+        timing = timeit(batched, max(args.repeats // 4, 1))
+        results["harness_batching"] = {k: v / len(payloads) for k, v in timing.items()}
+    finally:
+        remove_backend(backend)
+
+
+def bench_llama(args, results: dict):
+    from batching import bucket_by_length
+
+    rng = random.Random(0)
+    lengths = [int(rng.lognormvariate(5, 1)) + 1 for _ in range(256)]
+    results["llama_bucketing"] = timeit(
+        lambda: bucket_by_length(lengths, max_padding=0.1, max_bucket_size=16), args.repeats
+    )
+
+    data_path = os.path.join(ROOT, "load_testing", "data", "data_llama.json")
+    for scheduler in ("static", "continuous"):
+        # The tiny weights are seeded, so generation lengths repeat run to run
+        backend = tiny_backend(
+            "llama3_8b", {"scheduler": scheduler, "max_new_tokens": str(args.new_tokens)}
+        )
+        try:
+            payloads = create_payload_corpus(data_path, backend.config_path, args.batch_size)
+            results[f"llama_{scheduler}"] = timeit(
+                lambda: check(backend.execute_payloads(payloads)), args.repeats
+            )
+        finally:
+            remove_backend(backend)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=8, help="Requests per execute()")
+    parser.add_argument("--new-tokens", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="Preprocessing threads")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Slowdown over the baseline median that fails the run")
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = True
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump({"image_bytes": {"type": "image_bytes", "content": LOGO}}, f)
+    data_path = f.name
+
+    results = {}
+    try:
+        bench_trocr(args, results, data_path)
+        bench_llama(args, results)
+    finally:
+        os.remove(data_path)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'case':<20}{'median ms':>11}{'p90 ms':>9}{'baseline':>10}{'change':>9}")
+    regressions = []
+    for case, timing in results.items():
+        line = f"{case:<20}{timing['median_ms']:>11.2f}{timing['p90_ms']:>9.2f}"
+        if case in baseline:
+            before = baseline[case]["median_ms"]
+            change = timing["median_ms"] / before - 1
+            line += f"{before:>10.2f}{change:>+9.0%}"
+            if change > args.tolerance:
+                regressions.append(case)
+        print(line)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,124 @@
+# coding=utf-8
+
+"""
+CPU check of length bucketing in llama3_8b's static scheduler, with the
+tiny random Llama through the offline harness (offline/harness.py). One
+dynamic batch of greedy requests with prompts of mixed lengths is run
+with bucketing (the `--max-padding` parameter) and without it (a
+max_padding of 1, which keeps the batch in one bucket), and:
+
+- bucketing must process fewer pad tokens, counted from the attention
+  masks the model is given
+- every request must get the same completion either way, in request order
+
+The script exits non-zero when either doesn't hold.
+
+    python benchmarks/length_bucketing.py --requests 8 --max-padding 0.1
+"""
+
+import os
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+SENTENCE = "The patient reports a dry cough and mild fever for three days. "
+
+
+def mixed_length_payloads(config_path: str, count: int, max_new_tokens: int) -> list:
+    """
+    Greedy requests whose user messages grow from one sentence to many,
+    interleaved so that short and long prompts sit side by side.
+    """
+    payloads = create_payload_corpus(
+        os.path.join(ROOT, "load_testing", "data", "data_llama.json"), config_path, count
+    )
+    repeats = [1 + (i * 7) % (2 * count) for i in range(count)]
+    for payload, repeat in zip(payloads, repeats):
+        for input_dict in payload["inputs"]:
+            if input_dict["name"] == "user_message":
+                input_dict["data"] = [SENTENCE * repeat]
+        payload["inputs"] += [
+            {"name": "greedy", "datatype": "BOOL", "shape": [1, 1], "data": [True]},
+            {"name": "max_new_tokens", "datatype": "INT32", "shape": [1, 1],
+             "data": [max_new_tokens]},
+        ]
+        payload["outputs"] = [{"name": "generated_text"}, {"name": "prompt_tokens"}]
+    return payloads
+
+
+def count_padding(backend: harness.OfflineBackend) -> dict:
+    """
+    Wrap the model's generate to count the pad tokens it is given.
+    """
+    counts = {"pad_tokens": 0, "calls": 0}
+    model = backend.model.model
+    generate = model.generate
+
+    def counting_generate(*args, **kwargs):
+        counts["pad_tokens"] += int((kwargs["attention_mask"] == 0).sum())
+        counts["calls"] += 1
+        return generate(*args, **kwargs)
+
+    model.generate = counting_generate
+    return counts
+
+
+def run(model_dir: str, args, max_padding: float) -> dict:
+    backend = harness.OfflineBackend(model_dir, parameters={"max_padding": str(max_padding)})
+    try:
+        counts = count_padding(backend)
+        payloads = mixed_length_payloads(backend.config_path, args.requests, args.max_new_tokens)
+        start = time.perf_counter()
+        responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+        seconds = time.perf_counter() - start
+        for response in responses:
+            if response.has_error():
+                raise RuntimeError(response.error().message())
+        outputs = [response.as_dict() for response in responses]
+        return {
+            **counts,
+            "seconds": seconds,
+            "texts": [output["generated_text"].reshape(-1)[0] for output in outputs],
+            "prompt_tokens": [int(output["prompt_tokens"].reshape(-1)[0]) for output in outputs],
+        }
+    finally:
+        backend.finalize()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--max-padding", type=float, default=0.1)
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = True
+    model_dir = harness.tiny_model_dir(os.path.join(ROOT, "model_repository", "llama3_8b"))
+    try:
+        unbucketed = run(model_dir, args, 1.0)
+        bucketed = run(model_dir, args, args.max_padding)
+    finally:
+        shutil.rmtree(os.path.dirname(model_dir))
+
+    print(f"Prompt tokens: {unbucketed['prompt_tokens']}")
+    print(f"{'':<12}{'generate calls':>16}{'pad tokens':>12}{'ms':>8}")
+    for name, result in (("unbucketed", unbucketed), ("bucketed", bucketed)):
+        print(f"{name:<12}{result['calls']:>16}{result['pad_tokens']:>12}"
+              f"{result['seconds'] * 1e3:>8.0f}")
+
+    failures = []
+    if bucketed["pad_tokens"] >= unbucketed["pad_tokens"]:
+        failures.append("bucketing didn't reduce the pad tokens")
+    for i, (text, reference) in enumerate(zip(bucketed["texts"], unbucketed["texts"])):
+        if text != reference:
+            failures.append(f"request {i} got a different completion when bucketed")
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,92 @@
+# coding=utf-8
+
+"""
+Load-generator CPU per request in the locust harness: building and
+JSON-encoding the payload in every user and request, as the harness
+used to, against posting bytes pre-built once per process. Requests are
+prepared with `requests` exactly as locust's HttpUser sends them, but
+not sent, so no server is needed.
+
+    python benchmarks/locust_payloads.py --requests 200
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "load_testing"))
+from request_schema import encode_request_body  # noqa: E402
+from utils import create_payload, create_payload_corpus  # noqa: E402
+
+URL = "http://localhost:8000/v2/models/model/infer"
+
+
+def cpu_seconds(fn, repeats: int) -> float:
+    fn()  # warmup
+    start = time.process_time()
+    for _ in range(repeats):
+        fn()
+    return (time.process_time() - start) / repeats
+
+
+def benchmark(name: str, schema_path: str, data_path: str, args):
+    session = requests.Session()
+
+    # Before: each user parsed the schema and built the payload in
+    # on_start, and each request re-serialized the dict to JSON.
+    user_setup = cpu_seconds(lambda: create_payload(data_path, schema_path), args.users)
+    payload = create_payload(data_path, schema_path)
+    legacy_request = cpu_seconds(
+        lambda: session.prepare_request(requests.Request("POST", URL, json=payload)),
+        args.requests,
+    )
+
+    # After: built and serialized once per process, then posted as bytes
+    process_setup = cpu_seconds(
+        lambda: [
+            encode_request_body(p)
+            for p in create_payload_corpus(data_path, schema_path, args.corpus_size)
+        ],
+        1,
+    )
+    body, headers = encode_request_body(payload)
+    cached_request = cpu_seconds(
+        lambda: session.prepare_request(
+            requests.Request("POST", URL, data=body, headers=headers)
+        ),
+        args.requests,
+    )
+
+    print(f"{name} ({len(body) / 1024:.0f} KiB body)")
+    print(f"  setup:       {user_setup * 1e3:8.2f} ms per user    -> "
+          f"{process_setup * 1e3:8.2f} ms per process ({args.corpus_size} payloads)")
+    print(f"  per request: {legacy_request * 1e6:8.1f} us             -> "
+          f"{cached_request * 1e6:8.1f} us ({legacy_request / cached_request:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--corpus-size", type=int, default=16)
+    args = parser.parse_args()
+
+    llama_schema = os.path.join(ROOT, "model_repository", "llama3_8b", "config.pbtxt")
+    trocr_schema = os.path.join(ROOT, "model_repository", "trocr", "config.pbtxt")
+    benchmark(
+        "llama3_8b, 6000-token prompt",
+        llama_schema,
+        os.path.join(ROOT, "load_testing", "data", "data_llama_6000.json"),
+        args,
+    )
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        image = os.path.abspath(os.path.join(ROOT, "assets", "triton_logo.png"))
+        json.dump({"image": {"type": "image", "content": image}}, f)
+    benchmark("trocr, base64 image", trocr_schema, f.name, args)
+    os.remove(f.name)
@@ -0,0 +1,153 @@
+# coding=utf-8
+
+"""
+CPU check of the prefix cache with a tiny random Llama model: greedy
+completions started from a cached system prompt KV must match a cold
+`generate` over the whole prompt, and the cached tensors must come out of
+later decoding steps unchanged.
+
+Prompts share one of two system prefixes. The cache budget holds only
+one of them, so the run goes through a miss, hits on the first prefix,
+an eviction by the second one, and a miss again when the first comes
+back. The script exits non-zero when an output differs, a cached entry
+was modified, or the hits and evictions aren't the ones expected.
+
+    python benchmarks/prefix_cache.py --users-per-prefix 4
+"""
+
+import os
+import sys
+from argparse import ArgumentParser
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), "..", "model_repository", "llama3_8b", "1"),
+)
+from engine import ContinuousBatchingEngine, GenerationParams, Sequence  # noqa: E402
+from prefix_cache import PrefixCache, past_key_values_bytes  # noqa: E402
+
+
+def reference_output(model, prompt, max_new_tokens: int, eos_token_id: int) -> list:
+    """
+    Greedy completion of the whole prompt with `generate`, no cache reuse.
+    """
+    with torch.inference_mode():
+        input_ids = torch.tensor([prompt])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+            eos_token_id=eos_token_id,
+        )
+    return output[0, len(prompt) :].tolist()
+
+
+def run(engine: ContinuousBatchingEngine, prefix: list, users: list, args) -> list:
+    """
+    Decode the prompts of one system prefix together.
+    """
+    params = GenerationParams(max_new_tokens=args.max_new_tokens, do_sample=False)
+    seqs = [
+        engine.submit(Sequence(input_ids=prefix + user, params=params, prefix_length=len(prefix)))
+        for user in users
+    ]
+    engine.run_until_complete()
+    return seqs
+
+
+def snapshot(past) -> list:
+    return [tensor.clone() for layer in past for tensor in layer]
+
+
+def unchanged(past, saved: list) -> bool:
+    return all(
+        torch.equal(tensor, before)
+        for tensor, before in zip((t for layer in past for t in layer), saved)
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--prefix-tokens", type=int, default=48)
+    parser.add_argument("--users-per-prefix", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=512,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=args.layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    eos_token_id = config.vocab_size
+    model = LlamaForCausalLM(config).eval()
+
+    def random_ids(length):
+        return torch.randint(0, config.vocab_size, (int(length),)).tolist()
+
+    prefixes = [random_ids(args.prefix_tokens), random_ids(args.prefix_tokens + 8)]
+    users = [
+        [random_ids(length) for length in torch.randint(1, 24, (args.users_per_prefix,))]
+        for _ in prefixes
+    ]
+    with torch.inference_mode():
+        sizes = [
+            past_key_values_bytes(model(torch.tensor([prefix]), use_cache=True).past_key_values)
+            for prefix in prefixes
+        ]
+    # Room for either prefix, but not both
+    cache = PrefixCache(max(sizes) + min(sizes) // 2)
+    engine = ContinuousBatchingEngine(
+        model, eos_token_id=eos_token_id, max_running=4, prefix_cache=cache
+    )
+
+    failures = []
+
+    def check(name, seqs, prefix, prefix_users):
+        for i, (seq, user) in enumerate(zip(seqs, prefix_users)):
+            reference = reference_output(model, prefix + user, args.max_new_tokens, eos_token_id)
+            if seq.error is not None or seq.generated != reference:
+                failures.append(f"{name}: prompt {i} differs from a cold run")
+
+    # Miss on the first prefix, which is then cached; later prompts hit it
+    # as the engine admits them
+    first = run(engine, prefixes[0], users[0][:1], args)
+    cached = cache.get(prefixes[0])
+    if cached is None:
+        failures.append("first prefix wasn't cached")
+    else:
+        saved = snapshot(cached)
+        hits = run(engine, prefixes[0], users[0][1:], args)
+        check("first prefix", first + hits, prefixes[0], users[0])
+        if not unchanged(cached, saved):
+            failures.append("cached KV of the first prefix changed during decoding")
+        if sum(seq.cached_tokens == len(prefixes[0]) for seq in hits) != len(hits):
+            failures.append("prompts after the first one didn't hit the cache")
+
+    # The second prefix doesn't fit next to the first, which is evicted
+    second = run(engine, prefixes[1], users[1], args)
+    check("second prefix", second, prefixes[1], users[1])
+    if cache.evictions != 1 or cache.get(prefixes[0]) is not None:
+        failures.append(f"expected the first prefix evicted, cache: {cache.stats()}")
+
+    # Back to the first prefix: a miss that rebuilds it
+    again = run(engine, prefixes[0], users[0][:1], args)
+    check("first prefix after eviction", again, prefixes[0], users[0][:1])
+    if again[0].cached_tokens:
+        failures.append("the evicted prefix was still served from the cache")
+
+    print(f"Prefix cache: {cache.stats()}")
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if not failures:
+        print("Outputs from cached prefixes match cold runs")
+    sys.exit(1 if failures else 0)
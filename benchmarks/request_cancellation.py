@@ -0,0 +1,140 @@
+# coding=utf-8
+
+"""
+How quickly llama3_8b stops generating for requests nobody is waiting
+for, on CPU with a tiny random model through the offline harness
+(offline/harness.py). For each scheduler, a batch of two greedy requests
+asks for `--max-new-tokens` each, and:
+
+- cancel: the first request reports itself cancelled from its
+  `--cancel-at-step`th check on, so it must stop with about that many
+  tokens, while the second one runs to the end
+- deadline: the first request has a `--timeout-ms` timeout parameter,
+  and must stop within `--max-steps` decode steps of it
+
+The script exits non-zero when either doesn't hold.
+
+    python benchmarks/request_cancellation.py
+    python benchmarks/request_cancellation.py --max-new-tokens 256 --timeout-ms 100
+"""
+
+import itertools
+import os
+import re
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+GENERATED = re.compile(r"after (\d+) generated tokens")
+
+
+def greedy_payloads(config_path: str, count: int, max_new_tokens: int) -> list:
+    payloads = create_payload_corpus(
+        os.path.join(ROOT, "load_testing", "data", "data_llama.json"), config_path, count
+    )
+    for payload in payloads:
+        payload["inputs"] += [
+            {"name": "greedy", "datatype": "BOOL", "shape": [1, 1], "data": [True]},
+            {"name": "max_new_tokens", "datatype": "INT32", "shape": [1, 1],
+             "data": [max_new_tokens]},
+        ]
+        payload["outputs"] = [{"name": "generated_text"}, {"name": "completion_tokens"}]
+    return payloads
+
+
+def completion_tokens(response) -> int:
+    """
+    Tokens generated for a response, also for the error of a stopped one.
+    """
+    if response.has_error():
+        match = GENERATED.search(response.error().message())
+        if match is None:
+            raise RuntimeError(response.error().message())
+        return int(match.group(1))
+    return int(response.as_dict()["completion_tokens"].reshape(-1)[0])
+
+
+def timed_execute(backend: harness.OfflineBackend, requests: list):
+    start = time.perf_counter()
+    responses = backend.execute(requests)
+    return responses, time.perf_counter() - start
+
+
+def check_scheduler(args, model_dir: str, scheduler: str) -> list:
+    """
+    :return: failure messages, empty when everything held
+    """
+    backend = harness.OfflineBackend(model_dir, parameters={"scheduler": scheduler})
+    failures = []
+    try:
+        payloads = greedy_payloads(backend.config_path, 2, args.max_new_tokens)
+        # The first run warms up, the second one times a step
+        for _ in range(2):
+            responses, seconds = timed_execute(
+                backend, [harness.request_from_payload(p) for p in payloads]
+            )
+        full = [completion_tokens(r) for r in responses]
+        step_seconds = seconds / max(full)
+        print(f"{scheduler}: uncancelled {full} tokens in {seconds * 1e3:.0f} ms, "
+              f"{step_seconds * 1e3:.1f} ms per step")
+        if min(full) <= args.cancel_at_step + args.max_steps:
+            print("  the tiny model stopped early, raise --max-new-tokens or lower --cancel-at-step")
+
+        requests = [harness.request_from_payload(p) for p in payloads]
+        polls = itertools.count(1)
+        requests[0].is_cancelled = lambda: next(polls) >= args.cancel_at_step
+        responses, seconds = timed_execute(backend, requests)
+        stopped, other = (completion_tokens(r) for r in responses)
+        print(f"  cancel: stopped with {stopped} tokens at step {args.cancel_at_step}, "
+              f"the other request got {other} of {full[1]}, {seconds * 1e3:.0f} ms")
+        if not responses[0].has_error() or abs(stopped - args.cancel_at_step) > args.max_steps:
+            failures.append(f"{scheduler}: cancelled request generated {stopped} tokens")
+        if responses[1].has_error() or other != full[1]:
+            failures.append(f"{scheduler}: the other request got {other} of {full[1]} tokens")
+
+        timeout = args.timeout_ms / 1000
+        payloads[0]["parameters"] = {"timeout": int(timeout * 1e6)}
+        responses, seconds = timed_execute(
+            backend, [harness.request_from_payload(p) for p in payloads]
+        )
+        stopped = completion_tokens(responses[0])
+        # The deadline falls `timeout` into the call, by which time about
+        # this many steps have run
+        expected = timeout / step_seconds
+        print(f"  deadline: stopped with {stopped} tokens, about {expected:.0f} fit in "
+              f"{args.timeout_ms:g} ms")
+        if not responses[0].has_error() or stopped > expected + args.max_steps:
+            failures.append(f"{scheduler}: expired request generated {stopped} tokens")
+    finally:
+        backend.finalize()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--cancel-at-step", type=int, default=8)
+    parser.add_argument("--timeout-ms", type=float, default=50)
+    parser.add_argument("--max-steps", type=int, default=2,
+                        help="Decode steps a request may run past its cancellation or deadline")
+    parser.add_argument("--schedulers", nargs="+", default=["static", "continuous"])
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = True
+    model_dir = harness.tiny_model_dir(os.path.join(ROOT, "model_repository", "llama3_8b"))
+    try:
+        failures = []
+        for scheduler in args.schedulers:
+            failures += check_scheduler(args, model_dir, scheduler)
+    finally:
+        shutil.rmtree(os.path.dirname(model_dir))
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,151 @@
+# coding=utf-8
+
+"""
+Client cost of the three ways to send a request to a server on the same
+host: JSON, the binary tensor extension, and system shared memory. For
+each transport the same request is posted `--runs` times and the script
+reports the latency, the client CPU time and the bytes posted per
+request, and checks that all transports get the same generated_text.
+
+By default trocr is sent assets/triton_logo.png, base64-encoded in the
+JSON request and as raw bytes otherwise. Without `--host`, a stub server
+with zero latency is started for the model, so the numbers show only
+transport costs; use a model config without a long max_queue_delay, as
+the stub waits for it between sequential requests. Against Triton the
+container must share the host's IPC namespace (docker run --ipc=host).
+
+    python benchmarks/shared_memory_transport.py --runs 200
+    python benchmarks/shared_memory_transport.py --host http://localhost:8000 \\
+        --schema model_repository/llama3_8b/config.pbtxt \\
+        --data load_testing/data/data_llama_6000.json
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import requests
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "load_testing"))
+from histogram import LatencyHistogram  # noqa: E402
+from model_config import load_model_config  # noqa: E402
+from request_schema import encode_request_body  # noqa: E402
+from shared_memory import SharedMemoryRequest  # noqa: E402
+from utils import create_payload  # noqa: E402
+
+
+def start_stub_server(schema: str, port: int) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "load_testing", "stub_server.py"),
+            "--config", schema,
+            "--port", str(port),
+            "--base-latency-ms", "0",
+            "--per-item-latency-ms", "0",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    host = f"http://localhost:{port}"
+    for _ in range(100):
+        try:
+            if requests.get(f"{host}/v2/health/ready", timeout=1).status_code == 200:
+                return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("stub server did not start")
+
+
+def generated_text(response_json: dict, shm_request: SharedMemoryRequest = None):
+    outputs = (
+        shm_request.outputs(response_json)
+        if shm_request is not None
+        else {o["name"]: o.get("data") for o in response_json["outputs"]}
+    )
+    texts = np.array(outputs["generated_text"], dtype=np.object_).reshape(-1)
+    return [t.decode("utf-8") if isinstance(t, bytes) else t for t in texts]
+
+
+def measure(url: str, body: bytes, headers: dict, runs: int, warmup: int):
+    session = requests.Session()
+    for _ in range(warmup):
+        session.post(url, data=body, headers=headers).raise_for_status()
+    latency = LatencyHistogram()
+    cpu_start = time.process_time()
+    for _ in range(runs):
+        start = time.perf_counter()
+        response = session.post(url, data=body, headers=headers)
+        response.raise_for_status()
+        response_json = response.json()
+        latency.record(time.perf_counter() - start)
+    cpu = (time.process_time() - cpu_start) / runs
+    return latency, cpu, response_json
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--schema", default=os.path.join(ROOT, "model_repository", "trocr", "config.pbtxt"))
+    parser.add_argument("--data", help="Data for the binary and shared memory requests "
+                                       "(default: the trocr image)")
+    parser.add_argument("--json-data", help="Data for the JSON request, e.g. with a base64 image "
+                                            "where --data has image_bytes (default: --data)")
+    parser.add_argument("--host", help="Server on this host (default: start a stub server)")
+    parser.add_argument("--port", type=int, default=8123, help="Port for the stub server")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--output-byte-size", type=int, default=65536)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    args = parser.parse_args()
+
+    data_files = []
+    if args.data is None:
+        image = os.path.abspath(os.path.join(ROOT, "assets", "triton_logo.png"))
+        for data_type in ("image_bytes", "image"):
+            with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+                json.dump({data_type: {"type": data_type, "content": image}}, f)
+            data_files.append(f.name)
+        args.data, args.json_data = data_files
+
+    server = None
+    host = args.host
+    if host is None:
+        server = start_stub_server(args.schema, args.port)
+        host = f"http://localhost:{args.port}"
+    url = f"{host}/v2/models/{load_model_config(args.schema).name}/infer"
+
+    payload = create_payload(args.data, args.schema, args.batch_size)
+    json_payload = create_payload(args.json_data or args.data, args.schema, args.batch_size)
+    shm_request = SharedMemoryRequest(payload, {"generated_text": args.output_byte_size})
+    try:
+        shm_request.register(host)
+        transports = {
+            "json": (*encode_request_body(json_payload), None),
+            "binary": (*encode_request_body(payload, binary=True), None),
+            "shared memory": (shm_request.body, shm_request.headers, shm_request),
+        }
+        print(f"{'transport':<15}{'body KiB':>10}{'p50 ms':>9}{'p99 ms':>9}{'CPU us/req':>12}")
+        texts = {}
+        for name, (body, headers, shm) in transports.items():
+            latency, cpu, response_json = measure(url, body, headers, args.runs, args.warmup)
+            texts[name] = generated_text(response_json, shm)
+            print(f"{name:<15}{len(body) / 1024:>10.1f}{latency.percentile(50) * 1e3:>9.2f}"
+                  f"{latency.percentile(99) * 1e3:>9.2f}{cpu * 1e6:>12.0f}")
+        reference = texts["json"]
+        for name, text in texts.items():
+            if text != reference:
+                print(f"Outputs differ: {name} returned {text!r}, json returned {reference!r}")
+                sys.exit(1)
+        print("Outputs match across transports")
+    finally:
+        shm_request.close()
+        if server is not None:
+            server.terminate()
+        for path in data_files:
+            os.remove(path)
@@ -0,0 +1,103 @@
+# coding=utf-8
+
+"""
+CPU check of speculative decoding with two tiny random Llama models:
+the output must match plain greedy decoding of the target, and the
+draft's acceptance rate determines how many target forward passes are
+saved. The draft is the target with noise added to its weights, so
+`--draft-noise` controls how often the two agree. The draft is as big
+as the target here, so the timings only show the overhead of drafting,
+not the saving a much smaller draft gives.
+
+    python benchmarks/speculative_decoding.py --draft-noise 0.02 --draft-tokens 4
+"""
+
+import copy
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), "..", "model_repository", "llama3_8b", "1"),
+)
+from speculative import SpeculativeDecoder  # noqa: E402
+
+
+def noisy_copy(model: LlamaForCausalLM, noise: float) -> LlamaForCausalLM:
+    """
+    A draft model whose weights are the target's plus gaussian noise of
+    `noise` times each weight's std.
+    """
+    draft = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in draft.parameters():
+            if param.dim() > 1:
+                param.add_(torch.randn_like(param) * param.std() * noise)
+    return draft
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--draft-noise", type=float, default=0.02)
+    parser.add_argument("--draft-tokens", type=int, default=4)
+    parser.add_argument("--prompts", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=512,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=args.layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    # No EOS, so every prompt generates max_new_tokens
+    eos_token_id = config.vocab_size
+    model = LlamaForCausalLM(config).eval()
+    draft = noisy_copy(model, args.draft_noise).eval()
+    decoder = SpeculativeDecoder(
+        model, draft, eos_token_id=eos_token_id, num_draft_tokens=args.draft_tokens
+    )
+    prompts = [
+        torch.randint(0, config.vocab_size, (int(length),)).tolist()
+        for length in torch.randint(8, 64, (args.prompts,))
+    ]
+
+    greedy_time = speculative_time = 0.0
+    mismatches = 0
+    for prompt in prompts:
+        start = time.perf_counter()
+        with torch.inference_mode():
+            input_ids = torch.tensor([prompt])
+            reference = model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=args.max_new_tokens,
+                do_sample=False,
+                pad_token_id=0,
+                eos_token_id=eos_token_id,
+            )[0, len(prompt) :].tolist()
+        greedy_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        output, _ = decoder.generate(prompt, args.max_new_tokens)
+        speculative_time += time.perf_counter() - start
+        mismatches += output != reference
+
+    stats = decoder.stats()
+    print(f"Outputs matching greedy decoding: {args.prompts - mismatches}/{args.prompts}")
+    print(f"Acceptance rate: {stats['acceptance_rate']:.2f}")
+    print(
+        f"Target forward passes: {stats['target_forwards']} "
+        f"(greedy: {stats['generated_tokens']}, saved: {stats['target_forwards_saved']})"
+    )
+    print(f"Greedy:      {greedy_time * 1000:.0f} ms")
+    print(f"Speculative: {speculative_time * 1000:.0f} ms")
@@ -0,0 +1,133 @@
+# coding=utf-8
+
+"""
+Throughput of the trocr backend at saturation, with batches run as one
+chunk against the chunked pipeline that overlaps preprocessing with the
+model (see model_repository/trocr/1/pipeline.py).
+
+The backend runs in-process through the offline harness, with a tiny
+random model taking the real model's 384x384 pixel values, and is sent
+`--requests` synthetic text-line crops at once, so the dynamic batcher
+forms full batches. Each `--chunk-rows` value sets pipeline_batch_size;
+0 runs every batch as a single chunk, without overlap.
+
+On CPU, the tiny model competes with preprocessing for the same cores.
+`--device-ms` stands in for an accelerator instead: generation becomes a
+sleep of that many milliseconds per chunk plus `--device-ms-per-row` per
+image, leaving the CPU free the way a GPU would. Chunking only gains when
+the device time grows with the rows: every chunk pays `--device-ms` again,
+and on CPU alone it loses (see the README for measured numbers):
+
+    python benchmarks/trocr_pipeline.py --requests 256
+    python benchmarks/trocr_pipeline.py --device-ms-per-row 2
+    python benchmarks/trocr_pipeline.py --device-ms 20 --device-ms-per-row 2
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+
+def write_crops(directory: str, count: int, size=(640, 64)) -> str:
+    """
+    Synthetic text-line crops as PNG files, and a data JSON listing them.
+    :return: the data JSON path
+    """
+    rng = np.random.default_rng(0)
+    items = []
+    for i in range(count):
+        img = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(img)
+        draw.text((10, 25), f"INVOICE No. {rng.integers(1e9)} TOTAL {rng.integers(1e5)}", fill="black")
+        path = os.path.join(directory, f"crop_{i}.png")
+        img.save(path)
+        items.append({"image_bytes": {"type": "image_bytes", "content": path}})
+    data_path = os.path.join(directory, "crops.json")
+    with open(data_path, "w") as f:
+        json.dump(items, f)
+    return data_path
+
+
+def emulate_device(backend: harness.OfflineBackend, base_ms: float, per_row_ms: float):
+    """
+    Replace generation with a sleep, returning the ids the model gives for
+    one image, so the CPU is idle while the "device" works.
+    """
+    model = backend.model.model
+    sample = model.generate(torch.zeros((1, *backend.model.buffers.shape)))
+
+    def generate(pixel_values, **kwargs):
+        time.sleep((base_ms + per_row_ms * len(pixel_values)) / 1000)
+        return sample.expand(len(pixel_values), -1)
+
+    model.generate = generate
+
+
+def run(args, model_dir: str, data_path: str, chunk_rows: int) -> dict:
+    parameters = {"share_weights": "false", "pipeline_batch_size": str(chunk_rows)}
+    backend = harness.OfflineBackend(model_dir, parameters=parameters)
+    try:
+        if args.device_ms > 0 or args.device_ms_per_row > 0:
+            emulate_device(backend, args.device_ms, args.device_ms_per_row)
+        payloads = create_payload_corpus(data_path, backend.config_path, args.requests)
+        harness.simulate(backend, payloads[: args.warmup])
+        result = harness.simulate(backend, payloads)
+        summary = result["summary"]
+        if summary["errors"]:
+            raise RuntimeError(f"{summary['errors']} failed requests")
+        summary["texts"] = [
+            r.as_dict()["generated_text"].reshape(-1)[0] for r in result["results"]
+        ]
+        return summary
+    finally:
+        backend.finalize()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--warmup", type=int, default=32)
+    parser.add_argument("--chunk-rows", type=int, nargs="+", default=[0, 8, 4],
+                        help="pipeline_batch_size values to compare, 0 for no chunking")
+    parser.add_argument("--device-ms", type=float, default=0.0,
+                        help="Emulate the device: milliseconds per chunk")
+    parser.add_argument("--device-ms-per-row", type=float, default=0.0,
+                        help="Emulate the device: milliseconds per image")
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = True
+    workdir = tempfile.mkdtemp(prefix="trocr-pipeline-")
+    model_dir = harness.tiny_model_dir(
+        os.path.join(ROOT, "model_repository", "trocr"), image_size=384, patch_size=32
+    )
+    try:
+        data_path = write_crops(workdir, 64)
+        print(f"{'chunk rows':<12}{'req/s':>9}{'batch rows':>12}{'p50 ms':>9}{'p99 ms':>9}")
+        texts = None
+        for chunk_rows in args.chunk_rows:
+            summary = run(args, model_dir, data_path, chunk_rows)
+            latency = summary["latency_s"]
+            print(f"{chunk_rows or 'off':<12}{summary['throughput_rps']:>9.1f}"
+                  f"{summary['mean_batch_rows']:>12.1f}{latency['p50'] * 1e3:>9.1f}"
+                  f"{latency['p99'] * 1e3:>9.1f}")
+            if texts is not None and summary["texts"] != texts:
+                print("Outputs differ between chunk sizes")
+                sys.exit(1)
+            texts = summary["texts"]
+    finally:
+        shutil.rmtree(os.path.dirname(model_dir))
+        shutil.rmtree(workdir)
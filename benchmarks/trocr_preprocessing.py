@@ -0,0 +1,101 @@
+# coding=utf-8
+
+"""
+CPU benchmark of TrOCR preprocessing: the original per-image
+torchvision + TrOCRProcessor path against the batched preprocessor.
+
+    python benchmarks/trocr_preprocessing.py --batch-size 32 --repeats 20
+"""
+
+import base64
+import io
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image, ImageDraw
+from torchvision.transforms import PILToTensor, Resize
+from transformers import ViTImageProcessor
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), "..", "model_repository", "trocr", "1"),
+)
+from preprocessing import BatchPreprocessor  # noqa: E402
+
+
+def make_crop(seed: int, size=(320, 48)) -> str:
+    """
+    A synthetic text-line crop, base64-encoded like the clients send it.
+    """
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((5, 15), f"INVOICE No. {rng.integers(1e6)}", fill="black")
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def legacy_preprocess(images, image_processor):
+    """
+    The original backend path: one image at a time, then the processor.
+    """
+    legacy_transforms = transforms.Compose(
+        [
+            transforms.RandomInvert(p=1),
+            transforms.Grayscale(num_output_channels=3),
+            Resize((50, 50)),
+            PILToTensor(),
+        ]
+    )
+    tensors = []
+    for data in images:
+        img = Image.open(io.BytesIO(base64.b64decode(data))).convert("RGB")
+        tensors.append(legacy_transforms(img).unsqueeze_(0))
+    batch = torch.cat(tensors, dim=0)
+    return image_processor(images=batch, return_tensors="pt").pixel_values
+
+
+def timeit(fn, repeats):
+    fn()  # warmup
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    # trocr-small-printed's processor settings, so no download is needed
+    image_processor = ViTImageProcessor(
+        size={"height": 384, "width": 384},
+        image_mean=[0.5, 0.5, 0.5],
+        image_std=[0.5, 0.5, 0.5],
+    )
+    preprocessor = BatchPreprocessor.from_image_processor(
+        image_processor, num_workers=args.workers
+    )
+    images = [make_crop(i) for i in range(args.batch_size)]
+
+    legacy = legacy_preprocess(images, image_processor)
+    batched = preprocessor(images)
+    print(f"Max abs difference in pixel values: {(legacy - batched).abs().max():.4f}")
+
+    legacy_time = timeit(lambda: legacy_preprocess(images, image_processor), args.repeats)
+    batched_time = timeit(lambda: preprocessor(images), args.repeats)
+    print(f"Legacy:  {legacy_time * 1000:.1f} ms per batch of {args.batch_size}")
+    print(f"Batched: {batched_time * 1000:.1f} ms per batch of {args.batch_size}")
+    print(f"Speedup: {legacy_time / batched_time:.1f}x")
+    preprocessor.close()
@@ -0,0 +1,84 @@
+# coding=utf-8
+
+"""
+HDR-style latency histogram.
+
+Values are counted in log-linear buckets: every power-of-two range is
+split into the same number of linear sub-buckets, so any recorded value
+is reported to within a fixed relative precision (about 1% for two
+significant digits) however long the tail gets, in constant memory.
+"""
+
+import math
+from collections import Counter
+from typing import Iterable
+
+
+class LatencyHistogram:
+    """
+    :param significant_digits: decimal digits of precision kept per value
+    :param unit: recorded values are divided by this before bucketing,
+        e.g. 1e-6 to count seconds in whole microseconds
+    """
+
+    def __init__(self, significant_digits: int = 2, unit: float = 1e-6):
+        self.sub_bucket_count = 2 ** math.ceil(math.log2(2 * 10**significant_digits))
+        self.sub_bucket_bits = self.sub_bucket_count.bit_length() - 1
+        self.half_count = self.sub_bucket_count // 2
+        self.unit = unit
+        self.counts = Counter()
+        self.total = 0
+        self.min = math.inf
+        self.max = 0.0
+        self.sum = 0.0
+
+    def _index(self, value: int) -> int:
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return shift * self.half_count + (value >> shift)
+
+    def _highest_equivalent(self, index: int) -> int:
+        shift = max(0, index // self.half_count - 1)
+        sub_bucket = index - shift * self.half_count
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value: float, count: int = 1):
+        """
+        Record a value, e.g. a latency in seconds.
+        """
+        self.counts[self._index(max(0, int(value / self.unit)))] += count
+        self.total += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value * count
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+
+    def percentile(self, p: float) -> float:
+        """
+        Value at or below which `p` percent of the recorded values fall.
+        """
+        if not self.total:
+            return 0.0
+        rank = max(1, math.ceil(p / 100 * self.total))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                value = self._highest_equivalent(index) * self.unit
+                return min(value, self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+    def summary(self, percentiles: Iterable[float] = (50, 90, 95, 99, 99.9)) -> dict:
+        summary = {"count": self.total, "mean": self.mean}
+        summary.update({f"p{p:g}": self.percentile(p) for p in percentiles})
+        summary["max"] = self.max
+        return summary
@@ -1,7 +1,263 @@
-from utils import create_payload
-from argparse import ArgumentParser
-import requests
+# coding=utf-8
+
+"""
+Benchmark a single model endpoint.
+
+Sends the same request `--num_runs` times, after `--warmup_runs`
+untimed ones, either one after another or from `--concurrency` threads,
+each reusing its own HTTP session. Client-side latency is split into
+server time and everything else (network, serialization) with the
+model's statistics endpoint: per run when the runs are sequential,
+averaged over the runs otherwise. For models with a `completion_tokens`
+output, tokens/sec is reported as well.
+
+    python load_testing/hit_model.py --schema_path model_repository/llama3_8b/config.pbtxt \\
+        --data_path load_testing/data/data_llama.json --host http://localhost:80 \\
+        --num_runs 50 --warmup_runs 3 --output results.json --csv runs.csv
+
+With `--shared_memory`, for a client on the same host as the server, the
+inputs are written once into a system shared memory region and every
+request only carries references to them; sequential runs get the
+generated text back through the region as well.
+
+The JSON summary can be compared with one saved at another commit with
+`--baseline`, which exits non-zero when a latency percentile regressed by
+more than `--max_regression` percent.
+"""
+
+import csv
+import json
+import subprocess
+import sys
+import threading
 import time
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+
+from histogram import LatencyHistogram
+from model_config import load_model_config
+from request_schema import encode_request_body
+from shared_memory import SharedMemoryRequest
+from utils import create_payload
+
+PERCENTILES = (50, 90, 99)
+# Server statistics, as cumulative nanoseconds per request
+SERVER_STATS = ("success", "queue", "compute_input", "compute_infer", "compute_output")
+
+
+def server_stats(session, host: str, model: str) -> Optional[dict]:
+    """
+    Cumulative request counts and durations from the KServe v2
+    statistics endpoint, summed over the model's versions, or None when
+    the server doesn't provide them.
+    """
+    try:
+        response = session.get(f"{host}/v2/models/{model}/stats", timeout=5)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    totals = {f"{name}_{field}": 0 for name in SERVER_STATS for field in ("count", "ns")}
+    for version_stats in response.json().get("model_stats", []):
+        inference_stats = version_stats.get("inference_stats")
+        if inference_stats is None:
+            return None
+        for name in SERVER_STATS:
+            totals[f"{name}_count"] += int(inference_stats.get(name, {}).get("count", 0))
+            totals[f"{name}_ns"] += int(inference_stats.get(name, {}).get("ns", 0))
+    return totals
+
+
+def server_split(before: Optional[dict], after: Optional[dict]) -> Optional[dict]:
+    """
+    Mean seconds per request spent in the server, queued and computing
+    between two `server_stats` snapshots.
+    """
+    if before is None or after is None:
+        return None
+    count = after["success_count"] - before["success_count"]
+    if count <= 0:
+        return None
+
+    def seconds(name):
+        return (after[f"{name}_ns"] - before[f"{name}_ns"]) / count / 1e9
+
+    return {
+        "server_s": seconds("success"),
+        "queue_s": seconds("queue"),
+        "compute_s": sum(
+            seconds(name) for name in ("compute_input", "compute_infer", "compute_output")
+        ),
+    }
+
+
+def completion_tokens(response_json: dict) -> Optional[int]:
+    for output in response_json.get("outputs", []):
+        if output["name"] == "completion_tokens":
+            return int(sum(output["data"]))
+    return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+class Benchmark:
+    """
+    :param url: inference endpoint
+    :param body: pre-encoded request body
+    :param headers: HTTP headers to send with it
+    :param host: server URL, for the statistics endpoint
+    :param model: model name, for the statistics endpoint
+    """
+
+    def __init__(self, url: str, body: bytes, headers: dict, host: str, model: str):
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.host = host
+        self.model = model
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        # requests.Session isn't thread-safe, so one per thread
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def send(self) -> dict:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data=self.body, headers=self.headers)
+            ok = response.status_code == 200
+            content = response.json() if ok else response.text
+        except requests.RequestException as e:
+            ok, content = False, str(e)
+        return {
+            "ok": ok,
+            "client_s": time.perf_counter() - start,
+            "response": content,
+        }
+
+    def run(self, num_runs: int, warmup_runs: int = 0, concurrency: int = 1) -> dict:
+        for _ in range(warmup_runs):
+            self.send()
+
+        runs = []
+        start = time.perf_counter()
+        before = server_stats(self.session, self.host, self.model)
+        if concurrency == 1:
+            for _ in range(num_runs):
+                run = self.send()
+                after = server_stats(self.session, self.host, self.model)
+                run["split"] = server_split(before, after)
+                before = after
+                runs.append(run)
+            split = None
+        else:
+            with ThreadPoolExecutor(concurrency) as pool:
+                runs = list(pool.map(lambda _: self.send(), range(num_runs)))
+            split = server_split(before, server_stats(self.session, self.host, self.model))
+        elapsed = time.perf_counter() - start
+        return self.summarize(runs, elapsed, concurrency, split)
+
+    def summarize(self, runs: list, elapsed: float, concurrency: int, split: Optional[dict]):
+        client = LatencyHistogram()
+        server = LatencyHistogram()
+        tokens = 0
+        for run in runs:
+            run["completion_tokens"] = (
+                completion_tokens(run["response"]) if run["ok"] else None
+            )
+            if not run["ok"]:
+                continue
+            client.record(run["client_s"])
+            if run.get("split") is not None:
+                server.record(run["split"]["server_s"])
+            tokens += run["completion_tokens"] or 0
+
+        if split is None and server.total:
+            # Sequential runs: average the per-run splits
+            splits = [run["split"] for run in runs if run["ok"] and run.get("split")]
+            split = {key: sum(s[key] for s in splits) / len(splits) for key in splits[0]}
+        if split is not None:
+            split["other_s"] = client.mean - split["server_s"]
+
+        summary = {
+            "commit": git_commit(),
+            "url": self.url,
+            "num_runs": len(runs),
+            "concurrency": concurrency,
+            "errors": sum(not run["ok"] for run in runs),
+            "elapsed_s": elapsed,
+            "throughput_rps": client.total / elapsed if elapsed else 0.0,
+            "client_latency_s": client.summary(PERCENTILES),
+            "server_latency_s": server.summary(PERCENTILES) if server.total else None,
+            "server_split_s": split,
+        }
+        if any(run["completion_tokens"] is not None for run in runs):
+            summary["completion_tokens"] = tokens
+            summary["tokens_per_second"] = tokens / elapsed if elapsed else 0.0
+        return {"summary": summary, "runs": runs}
+
+
+def write_runs_csv(path: str, runs: list):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["run", "ok", "client_ms", "server_ms", "queue_ms", "completion_tokens"])
+        for i, run in enumerate(runs):
+            split = run.get("split") or {}
+            writer.writerow(
+                [
+                    i,
+                    run["ok"],
+                    f"{run['client_s'] * 1000:.3f}",
+                    f"{split['server_s'] * 1000:.3f}" if split else "",
+                    f"{split['queue_s'] * 1000:.3f}" if split else "",
+                    "" if run["completion_tokens"] is None else run["completion_tokens"],
+                ]
+            )
+
+
+def compare_to_baseline(summary: dict, baseline: dict, max_regression: float) -> list:
+    """
+    Print the change of each latency percentile against a baseline summary.
+    :return: the metrics that got slower by more than `max_regression` percent
+    """
+    regressions = []
+    print(f"\n{'vs baseline ' + str(baseline.get('commit')):<28}{'before':>10}{'after':>10}{'change':>9}")
+    for key in ("client_latency_s", "server_latency_s"):
+        if not summary.get(key) or not baseline.get(key):
+            continue
+        for p in [f"p{p}" for p in PERCENTILES] + ["mean"]:
+            before, after = baseline[key][p], summary[key][p]
+            change = (after - before) / before * 100 if before else 0.0
+            name = f"{key[:-10]} {p}"
+            print(f"{name:<28}{before * 1000:>10.1f}{after * 1000:>10.1f}{change:>+8.1f}%")
+            if change > max_regression:
+                regressions.append(name)
+    return regressions
+
+
+def positive_int(value: str) -> int:
+    """
+    argparse type for counts that must be at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -9,23 +265,111 @@ if __name__ == "__main__":
     parser.add_argument("--data_path", help="Path to the data file")
     parser.add_argument("--host", help="Endpoint name")
     parser.add_argument("--model", help="Model name", default="llama3_8b")
-    # TODO use this to run n number of times and avg
-    parser.add_argument("--num_runs", help="Model name", default=1, type=int)
+    parser.add_argument("--num_runs", help="Timed requests to send", default=1, type=positive_int)
+    parser.add_argument("--warmup_runs", help="Untimed requests sent first", default=0, type=int)
+    parser.add_argument(
+        "--concurrency", help="Requests in flight at once", default=1, type=positive_int
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="Data items packed into the request along its first dimension",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--binary",
+        help="Send inputs with the binary tensor extension instead of JSON",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shared_memory",
+        help="Pass tensors through system shared memory, for servers on this host",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output_byte_size",
+        help="Shared memory bytes reserved for the generated_text output",
+        default=65536,
+        type=int,
+    )
+    parser.add_argument("--output", help="Save the summary as JSON")
+    parser.add_argument("--csv", help="Save the individual runs as CSV")
+    parser.add_argument("--baseline", help="Summary JSON from an earlier run to compare with")
+    parser.add_argument(
+        "--max_regression",
+        help="Percent slowdown against the baseline that fails the run",
+        default=10.0,
+        type=float,
+    )
 
     args = parser.parse_args()
 
-    payload = create_payload(args.data_path, args.schema_path)
+    payload = create_payload(args.data_path, args.schema_path, args.batch_size)
+    output_names = [output.name for output in load_model_config(args.schema_path).outputs]
+    if "completion_tokens" in output_names:
+        payload["outputs"] = [{"name": "generated_text"}, {"name": "completion_tokens"}]
+    shm_request = None
+    if args.shared_memory:
+        # Concurrent requests would overwrite each other's outputs in the region
+        output_byte_sizes = (
+            {"generated_text": args.output_byte_size} if args.concurrency == 1 else None
+        )
+        shm_request = SharedMemoryRequest(payload, output_byte_sizes)
+        shm_request.register(args.host)
+        body, headers = shm_request.body, shm_request.headers
+    else:
+        body, headers = encode_request_body(payload, args.binary)
 
     API_URL = f"{args.host}/v2/models/{args.model}/infer"
-    start = time.time()
-    response = requests.post(API_URL, json=payload)
-    if response.status_code != 200:
-        print(
-            f"Request failed with status code {response.status_code}\n{response.text}"
-        )
+    benchmark = Benchmark(API_URL, body, headers, args.host, args.model)
+    try:
+        result = benchmark.run(args.num_runs, args.warmup_runs, args.concurrency)
+        summary, runs = result["summary"], result["runs"]
+        if shm_request is not None and shm_request.output_parameters and runs[0]["ok"]:
+            runs[0]["response"]["outputs_from_shared_memory"] = {
+                name: value.tolist() if hasattr(value, "tolist") else value
+                for name, value in shm_request.outputs(runs[0]["response"]).items()
+            }
+    finally:
+        if shm_request is not None:
+            shm_request.close()
+
+    first = runs[0]
+    if first["ok"]:
+        print("Response from server")
+        print(first["response"])
+    else:
+        print(f"Request failed\n{first['response']}")
 
-    print("Response from server")
-    print(response.json())
+    print(f"\nRuns: {summary['num_runs']}, errors: {summary['errors']}, "
+          f"concurrency: {summary['concurrency']}, {summary['throughput_rps']:.2f} req/s")
+    if "tokens_per_second" in summary:
+        print(f"Completion tokens: {summary['completion_tokens']}, "
+              f"{summary['tokens_per_second']:.1f} tokens/s")
+    print(f"{'':<10}{'mean':>9}" + "".join(f"{f'p{p}':>9}" for p in PERCENTILES) + f"{'max':>9}  (ms)")
+    for label, key in (("client", "client_latency_s"), ("server", "server_latency_s")):
+        s = summary[key]
+        if s:
+            print(f"{label:<10}" + "".join(
+                f"{s[k] * 1000:>9.1f}" for k in ["mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+            ))
+    split = summary["server_split_s"]
+    if split:
+        print(f"Mean split: server {split['server_s'] * 1000:.1f} ms "
+              f"(queue {split['queue_s'] * 1000:.1f}, compute {split['compute_s'] * 1000:.1f}), "
+              f"network and serialization {split['other_s'] * 1000:.1f} ms")
+    else:
+        print("Server statistics unavailable, no server/client split")
 
-    time_taken = time.time() - start
-    print(f"Time taken: {time_taken}s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.csv:
+        write_runs_csv(args.csv, runs)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(summary, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressed by more than {args.max_regression}%: {', '.join(regressions)}")
+            sys.exit(1)
@@ -7,13 +7,11 @@ Locust file for load testing
 import os
 import logging
 import json
+import random
+from functools import lru_cache
 from locust import HttpUser, task, tag, constant_throughput, events, LoadTestShape
-from request_schema import (
-    parse_pbtxt_to_dict,
-    convert_input_schema_into_request_data_dict,
-    parse_data_for_request,
-    validate_request_data_against_schema,
-)
+from request_schema import encode_request_body
+from utils import create_payload_corpus
 
 
 @events.init_command_line_parser.add_listener
@@ -46,6 +44,34 @@ def _(parser):
         help="How often to add users in seconds",
         default=60,
     )
+    parser.add_argument(
+        "--user-throughput",
+        type=float,
+        env_var="USER_THROUGHPUT",
+        help="Requests per second sent by each user",
+        default=1.0 / 300,
+    )
+    parser.add_argument(
+        "--corpus-size",
+        type=int,
+        env_var="CORPUS_SIZE",
+        help="Pre-build this many varied payloads from the data file, 0 for one per data item",
+        default=0,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        env_var="BATCH_SIZE",
+        help="Data items packed into each request along its first dimension",
+        default=1,
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        env_var="BINARY",
+        help="Send inputs with the binary tensor extension instead of JSON",
+        default=False,
+    )
 
 
 @events.test_start.add_listener
@@ -54,8 +80,22 @@ def _(environment, **kw):
     print(f"Custom argument supplied: {environment.parsed_options.schema}")
 
 
+@lru_cache(maxsize=None)
+def load_payloads(
+    schema_path: str, data_path: str, binary: bool, corpus_size: int, batch_size: int
+):
+    """
+    Parse the schema, build the payloads and serialize them once per
+    process. Every user then posts the same pre-encoded bytes.
+    """
+    payloads = create_payload_corpus(data_path, schema_path, corpus_size, batch_size)
+    return tuple(encode_request_body(payload, binary) for payload in payloads)
+
+
 class LoadTest(HttpUser):
-    wait_time = constant_throughput(1.0 / 300)
+    def wait_time(self):
+        throughput = self.environment.parsed_options.user_throughput
+        return constant_throughput(throughput)(self)
 
     def _read_env_vars(self):
         """
@@ -66,70 +106,35 @@ class LoadTest(HttpUser):
         self.host = kwargs.get("host", os.environ.get("HOST"))
         self.authorization = kwargs.get("authorization", os.environ.get("AUTH_TOKEN"))
         self.data_path = kwargs.get("data", os.environ.get("DATA_PATH"))
+        self.binary = kwargs.get("binary", False)
+        self.corpus_size = kwargs.get("corpus_size", 0)
+        self.batch_size = kwargs.get("batch_size", 1)
 
-        # load the dictionary from the data string
         assert os.path.exists(self.schema_path)
         assert os.path.exists(self.data_path)
-        with open(self.data_path, "r") as file:
-            data = json.load(file)
-        self.data = data
-
-    def parse_schema(self):
-        """
-        Convert the .pbtxt file for a given Triton model
-        into a dictionary.
-        """
-        self.schema = parse_pbtxt_to_dict(self.schema_path)
-
-    def get_request_input_data(self):
-        """
-        Method that parses the expected input dictionary
-        for the request from the model schema
-        """
-        self.input_data_body = convert_input_schema_into_request_data_dict(self.schema)
-
-    def verify_schema_inputs_against_data(self, data: dict):
-        """
-        For a given schema, verify that the provided
-        data dictionary is valid.
-        :param data: dict, data to be sent in the request
-        """
-        inputs = self.input_data_body["inputs"]  # List of dicts
-        for input_dict in inputs:
-            assert (
-                input_dict["name"] in data.keys()
-            ), f"Input {input_dict['name']} not found in data dictionary"
-
-        self.data = data
-
-    def format_data(self):
-        """
-        Parse the data dictionary into a format that can be sent in the request.
-        """
-        data_item = parse_data_for_request(self.data)
-        for sub_dict in self.input_data_body["inputs"]:
-            key = sub_dict["name"]
-            data = [data_item[key]]
-            sub_dict["data"].append(data)
-
-        if not validate_request_data_against_schema(self.input_data_body, self.data):
-            raise ValueError("Data dictionary does not conform to schema")
 
     @tag("inference")
     @task
     def predict(self):
-        response = self.client.post(self.host, json=self.input_data_body)
+        body, headers = self.payloads[self.next_payload]
+        self.next_payload = (self.next_payload + 1) % len(self.payloads)
+        response = self.client.post(self.host, data=body, headers=headers)
         if response.status_code != 200:
             logging.error(f"Error parsing response: {response.text}")
-        else:
+        elif logging.getLogger().isEnabledFor(logging.DEBUG):
             logging.debug(f"Great success {json.dumps(response.json())}")
 
     def on_start(self):
         self._read_env_vars()
-        self.parse_schema()
-        self.get_request_input_data()
-        self.format_data()
-        self.verify_schema_inputs_against_data(self.data)
+        self.payloads = load_payloads(
+            self.schema_path,
+            self.data_path,
+            self.binary,
+            self.corpus_size,
+            self.batch_size,
+        )
+        # Users start at different points of the corpus
+        self.next_payload = random.randrange(len(self.payloads))
 
 
 class CustomLoadShape(LoadTestShape):
@@ -141,8 +146,13 @@ class CustomLoadShape(LoadTestShape):
         starting_users = self.runner.environment.parsed_options.starting_users
         bulk_interval = self.runner.environment.parsed_options.bulk_interval
         bulk_ramp = self.runner.environment.parsed_options.bulk_ramp
+        time_limit = self.runner.environment.parsed_options.run_time
         run_time = self.get_run_time()
 
+        # Shapes have to apply --run-time themselves
+        if time_limit and run_time >= time_limit:
+            return None
+
         if run_time < bulk_interval:  # First minute
             return starting_users, starting_users  # Start with 100 users
         else:
@@ -0,0 +1,430 @@
+# coding=utf-8
+
+"""
+Parser for Triton model configs in protobuf text format (config.pbtxt).
+
+The text is tokenized line by line and parsed by recursive descent into
+plain dicts and lists, which are then wrapped in typed objects for the
+parts the tools use: inputs, outputs, dynamic batching, instance groups
+and parameters. Parsed configs are memoized by path, modification time
+and size, so repeated lookups are free until the file changes.
+
+Run as a script to validate a whole model repository:
+
+    python load_testing/model_config.py model_repository
+"""
+
+import copy
+import os
+import re
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+TOKEN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[fF]?)
+    |(?P<ident>[A-Za-z_][A-Za-z0-9_.]*)
+    |(?P<punct>[{}\[\]<>:,;])
+    """,
+    re.VERBOSE,
+)
+CLOSING = {"{": "}", "<": ">"}
+
+
+class ConfigParseError(ValueError):
+    pass
+
+
+@dataclass
+class Token:
+    kind: str
+    text: str
+    line: int
+    column: int
+
+
+def tokenize(lines) -> Iterator[Token]:
+    """
+    Yield tokens from an iterable of lines, e.g. an open file.
+    """
+    for line_number, line in enumerate(lines, start=1):
+        position = 0
+        while position < len(line):
+            match = TOKEN.match(line, position)
+            if match is None:
+                raise ConfigParseError(
+                    f"line {line_number}, column {position + 1}: "
+                    f"unexpected character {line[position]!r}"
+                )
+            if match.lastgroup != "space":
+                yield Token(match.lastgroup, match.group(), line_number, position + 1)
+            position = match.end()
+
+
+class _Parser:
+    def __init__(self, tokens: Iterator[Token]):
+        self.tokens = tokens
+        self.current: Optional[Token] = next(tokens, None)
+
+    def _error(self, message: str):
+        if self.current is None:
+            raise ConfigParseError(f"end of file: {message}")
+        raise ConfigParseError(
+            f"line {self.current.line}, column {self.current.column}: {message}, "
+            f"found {self.current.text!r}"
+        )
+
+    def _advance(self) -> Token:
+        token = self.current
+        if token is None:
+            self._error("unexpected end of file")
+        self.current = next(self.tokens, None)
+        return token
+
+    def _at(self, text: str) -> bool:
+        return self.current is not None and self.current.text == text
+
+    def message(self, end: Optional[str] = None) -> dict:
+        """
+        Parse fields until `end` (or the end of the file at the top level).
+        Fields that repeat, or are written as lists, become lists.
+        """
+        values: Dict[str, list] = {}
+        repeated = set()
+        while True:
+            if self.current is None:
+                if end is not None:
+                    self._error(f"expected {end!r}")
+                break
+            if end is not None and self._at(end):
+                self._advance()
+                break
+            if self.current.kind != "ident":
+                self._error("expected a field name")
+            name = self._advance().text
+            if self._at(":"):
+                self._advance()
+            elif not (self._at("{") or self._at("<") or self._at("[")):
+                self._error(f"expected ':' or a message after {name!r}")
+            if self._at("["):
+                values.setdefault(name, []).extend(self.list())
+                repeated.add(name)
+            else:
+                values.setdefault(name, []).append(self.value())
+            while self._at(",") or self._at(";"):
+                self._advance()
+        return {
+            name: items if name in repeated or len(items) > 1 else items[0]
+            for name, items in values.items()
+        }
+
+    def list(self) -> list:
+        self._advance()  # [
+        items = []
+        while not self._at("]"):
+            items.append(self.value())
+            if self._at(","):
+                self._advance()
+            elif not self._at("]"):
+                self._error("expected ',' or ']'")
+        self._advance()
+        return items
+
+    def value(self):
+        token = self.current
+        if token is None:
+            self._error("expected a value")
+        if token.text in CLOSING:
+            self._advance()
+            return self.message(CLOSING[token.text])
+        if token.kind == "string":
+            # Adjacent string literals are concatenated
+            parts = []
+            while self.current is not None and self.current.kind == "string":
+                parts.append(_unquote(self._advance().text))
+            return "".join(parts)
+        if token.kind == "number":
+            self._advance()
+            text = token.text.rstrip("fF")
+            if re.fullmatch(r"[-+]?\d+", text):
+                return int(text)
+            return float(text)
+        if token.kind == "ident":
+            self._advance()
+            if token.text in ("true", "True"):
+                return True
+            if token.text in ("false", "False"):
+                return False
+            return token.text  # enum value, e.g. TYPE_FP32 or KIND_GPU
+        self._error("expected a value")
+
+
+def _unquote(text: str) -> str:
+    return bytes(text[1:-1], "utf-8").decode("unicode_escape")
+
+
+def parse_pbtxt(lines) -> dict:
+    """
+    Parse protobuf text format into dicts, lists and scalars.
+    :param lines: an iterable of lines or a string
+    """
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    return _Parser(tokenize(lines)).message()
+
+
+def field_spans(text: str) -> List[Tuple[str, int, int]]:
+    """
+    The top-level fields of protobuf text as (name, start, end) character
+    offsets, so a field can be rewritten in place. The spans come from the
+    tokenizer, so nested messages and braces inside strings or comments
+    don't throw them off.
+    """
+    lines = text.splitlines(keepends=True)
+    line_starts = [0]
+    for line in lines:
+        line_starts.append(line_starts[-1] + len(line))
+    tokens = list(tokenize(lines))
+    spans = []
+    depth = 0
+    last_end = 0
+    for i, token in enumerate(tokens):
+        start = line_starts[token.line - 1] + token.column - 1
+        is_field = (
+            depth == 0
+            and token.kind == "ident"
+            and i + 1 < len(tokens)
+            and tokens[i + 1].text in (":", "{", "<")
+        )
+        if is_field:
+            if spans:
+                spans[-1][2] = last_end
+            spans.append([token.text, start, None])
+        if token.text in ("{", "[", "<"):
+            depth += 1
+        elif token.text in ("}", "]", ">"):
+            depth -= 1
+        last_end = start + len(token.text)
+    if spans:
+        spans[-1][2] = last_end
+    return [tuple(span) for span in spans]
+
+
+def as_list(value) -> list:
+    """
+    A repeated field of a parsed config as a list: the parser returns a
+    single occurrence as the value itself and a missing one as None.
+    """
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+@dataclass
+class TensorConfig:
+    name: str
+    data_type: str
+    dims: List[int]
+    optional: bool = False
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "TensorConfig":
+        return cls(
+            name=raw.get("name", ""),
+            data_type=raw.get("data_type", ""),
+            dims=[int(d) for d in as_list(raw.get("dims"))],
+            optional=bool(raw.get("optional", False)),
+        )
+
+
+@dataclass
+class DynamicBatching:
+    preferred_batch_size: List[int] = field(default_factory=list)
+    max_queue_delay_microseconds: int = 0
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "DynamicBatching":
+        return cls(
+            preferred_batch_size=[int(s) for s in as_list(raw.get("preferred_batch_size"))],
+            max_queue_delay_microseconds=int(raw.get("max_queue_delay_microseconds", 0)),
+        )
+
+
+@dataclass
+class InstanceGroup:
+    kind: str = "KIND_AUTO"
+    count: int = 1
+    gpus: List[int] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "InstanceGroup":
+        return cls(
+            kind=raw.get("kind", "KIND_AUTO"),
+            count=int(raw.get("count", 1)),
+            gpus=[int(g) for g in as_list(raw.get("gpus"))],
+        )
+
+
+@dataclass
+class ModelConfig:
+    name: str
+    backend: str = ""
+    platform: str = ""
+    max_batch_size: int = 0
+    inputs: List[TensorConfig] = field(default_factory=list)
+    outputs: List[TensorConfig] = field(default_factory=list)
+    dynamic_batching: Optional[DynamicBatching] = None
+    instance_groups: List[InstanceGroup] = field(default_factory=list)
+    parameters: Dict[str, str] = field(default_factory=dict)
+    decoupled: bool = False
+    raw: dict = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "ModelConfig":
+        parameters = {}
+        for parameter in as_list(raw.get("parameters")):
+            value = parameter.get("value", {})
+            parameters[parameter.get("key", "")] = value.get("string_value", "")
+        dynamic_batching = raw.get("dynamic_batching")
+        return cls(
+            name=raw.get("name", ""),
+            backend=raw.get("backend", ""),
+            platform=raw.get("platform", ""),
+            max_batch_size=int(raw.get("max_batch_size", 0)),
+            inputs=[TensorConfig.from_dict(t) for t in as_list(raw.get("input"))],
+            outputs=[TensorConfig.from_dict(t) for t in as_list(raw.get("output"))],
+            dynamic_batching=(
+                DynamicBatching.from_dict(dynamic_batching)
+                if isinstance(dynamic_batching, dict)
+                else None
+            ),
+            instance_groups=[
+                InstanceGroup.from_dict(g) for g in as_list(raw.get("instance_group"))
+            ],
+            parameters=parameters,
+            decoupled=bool(raw.get("model_transaction_policy", {}).get("decoupled", False)),
+            raw=raw,
+        )
+
+    def parameter(self, key: str, default: str = None) -> Optional[str]:
+        return self.parameters.get(key, default)
+
+    def as_dict(self) -> dict:
+        config = asdict(self)
+        del config["raw"]
+        return config
+
+
+_cache: Dict[str, Tuple[Tuple[int, int], ModelConfig]] = {}
+
+
+def load_model_config(path) -> ModelConfig:
+    """
+    Parse a config.pbtxt, reusing the previous result while the file's
+    modification time and size are unchanged.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, "r") as f:
+        try:
+            config = ModelConfig.from_dict(parse_pbtxt(f))
+        except ConfigParseError as e:
+            raise ConfigParseError(f"{path}: {e}") from None
+    _cache[path] = (signature, config)
+    return config
+
+
+def load_config_dict(path) -> dict:
+    """
+    The parsed config as plain dicts and lists, safe to modify.
+    """
+    return copy.deepcopy(load_model_config(path).raw)
+
+
+def validate_model_config(config: ModelConfig, model_dir: str) -> List[str]:
+    """
+    Problems with one model's config and directory layout.
+    """
+    problems = []
+    directory_name = os.path.basename(os.path.normpath(model_dir))
+    if config.name and config.name != directory_name:
+        problems.append(f"name {config.name!r} doesn't match the directory")
+    if not config.backend and not config.platform:
+        problems.append("neither backend nor platform is set")
+    if config.max_batch_size < 0:
+        problems.append("max_batch_size is negative")
+
+    for kind, tensors in (("input", config.inputs), ("output", config.outputs)):
+        names = [t.name for t in tensors]
+        for name in {n for n in names if names.count(n) > 1}:
+            problems.append(f"duplicate {kind} {name!r}")
+        for tensor in tensors:
+            if not tensor.data_type.startswith("TYPE_"):
+                problems.append(f"{kind} {tensor.name!r} has data_type {tensor.data_type!r}")
+            if not tensor.dims or any(d == 0 or d < -1 for d in tensor.dims):
+                problems.append(f"{kind} {tensor.name!r} has invalid dims {tensor.dims}")
+
+    if config.dynamic_batching is not None:
+        if config.max_batch_size == 0:
+            problems.append("dynamic_batching needs max_batch_size > 0")
+        for size in config.dynamic_batching.preferred_batch_size:
+            if size < 1 or size > config.max_batch_size:
+                problems.append(
+                    f"preferred_batch_size {size} outside 1..{config.max_batch_size}"
+                )
+
+    versions = [
+        entry for entry in os.listdir(model_dir)
+        if entry.isdigit() and os.path.isdir(os.path.join(model_dir, entry))
+    ]
+    if not versions:
+        problems.append("no numeric version directory")
+    if config.backend == "python":
+        for version in versions:
+            if not os.path.exists(os.path.join(model_dir, version, "model.py")):
+                problems.append(f"version {version} has no model.py")
+    return problems
+
+
+def validate_model_repository(root: str) -> Dict[str, List[str]]:
+    """
+    Parse and check every model in a repository.
+    :return: problems found, by model directory name (empty when valid)
+    """
+    results = {}
+    for entry in sorted(os.listdir(root)):
+        model_dir = os.path.join(root, entry)
+        if not os.path.isdir(model_dir) or entry.startswith((".", "_")):
+            continue
+        config_path = os.path.join(model_dir, "config.pbtxt")
+        if not os.path.exists(config_path):
+            results[entry] = ["no config.pbtxt"]
+            continue
+        try:
+            config = load_model_config(config_path)
+        except ConfigParseError as e:
+            results[entry] = [str(e)]
+            continue
+        results[entry] = validate_model_config(config, model_dir)
+    return results
+
+
+if __name__ == "__main__":
+    root = sys.argv[1] if len(sys.argv) > 1 else "model_repository"
+    start = time.perf_counter()
+    results = validate_model_repository(root)
+    elapsed = time.perf_counter() - start
+    for model, problems in results.items():
+        print(f"{model}: {'ok' if not problems else ''}")
+        for problem in problems:
+            print(f"  - {problem}")
+    print(f"Checked {len(results)} models in {elapsed * 1000:.1f} ms")
+    sys.exit(1 if any(results.values()) else 0)
@@ -0,0 +1,280 @@
+# coding=utf-8
+
+"""
+Open-loop load generator.
+
+Locust users are closed-loop: each waits for its response before sending
+again, so when the server slows down the offered load drops with it and
+queueing collapse never shows up. Here every request is sent at a time
+fixed up front by an arrival schedule (Poisson, bursty or replayed from
+a trace), whatever the server is doing.
+
+Latency is measured from each request's scheduled send time rather than
+from when it actually went out, so if the generator itself falls behind
+(e.g. a saturated event loop) the delay still counts, which corrects for
+coordinated omission. Waiting for a free connection in the pool counts
+too. The uncorrected service time, from when the request was issued, is
+reported alongside.
+
+Failed and timed-out requests count in the corrected latency at the time
+they took to fail, so the tail under overload doesn't vanish with them,
+and also get percentiles of their own. The service time only covers
+successful requests.
+
+    python load_testing/open_loop.py --schema model_repository/llama3_8b/config.pbtxt \\
+        --host http://localhost:8000/v2/models/llama3_8b/infer \\
+        --data load_testing/data/data_llama.json:3 load_testing/data/soap_note.json:1 \\
+        --arrivals poisson --rate 2 --duration 120
+"""
+
+import asyncio
+import json
+import random
+from argparse import ArgumentParser
+from typing import List, Tuple
+
+import aiohttp
+
+from histogram import LatencyHistogram
+from request_schema import encode_request_body
+from utils import create_payload
+
+
+def poisson_arrivals(rate: float, duration: float, rng: random.Random) -> List[float]:
+    """
+    Send times, in seconds from the start, of a Poisson process.
+    """
+    return bursty_arrivals(rate, duration, rng, burst_factor=1.0)
+
+
+def bursty_arrivals(
+    rate: float,
+    duration: float,
+    rng: random.Random,
+    burst_factor: float = 5.0,
+    burst_seconds: float = 5.0,
+    burst_period: float = 30.0,
+) -> List[float]:
+    """
+    Send times of a Poisson process whose rate jumps to
+    `rate * burst_factor` for the first `burst_seconds` of every
+    `burst_period`.
+    """
+    times = []
+    t = 0.0
+    while t < duration:
+        in_burst = t % burst_period < burst_seconds
+        current_rate = rate * burst_factor if in_burst else rate
+        # The rate is constant until the next burst boundary, and
+        # exponential gaps are memoryless, so restarting there is exact.
+        phase_end = (t // burst_period) * burst_period + (
+            burst_seconds if in_burst else burst_period
+        )
+        gap = rng.expovariate(current_rate)
+        if t + gap >= phase_end:
+            t = phase_end
+            continue
+        t += gap
+        if t < duration:
+            times.append(t)
+    return times
+
+
+def trace_arrivals(path: str, speedup: float = 1.0) -> List[float]:
+    """
+    Replay send times from a file with one timestamp in seconds per line
+    (or a JSON list of them), shifted to start at zero.
+    """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        timestamps = [float(t) for t in json.loads(text)]
+    else:
+        timestamps = [float(line.split(",")[0]) for line in text.splitlines() if line.strip()]
+    timestamps.sort()
+    return [(t - timestamps[0]) / speedup for t in timestamps]
+
+
+def load_payloads(
+    data_args: List[str], schema_path: str, binary: bool, batch_size: int = 1
+):
+    """
+    Build the request body for each data file once, up front.
+    :param data_args: data file paths, each optionally suffixed with
+        ":<weight>"
+    :param batch_size: data items packed into each request
+    :return: (name, body, headers) per data file and their weights
+    """
+    payloads, weights = [], []
+    for arg in data_args:
+        path, weight = arg, 1.0
+        if ":" in arg:
+            head, tail = arg.rsplit(":", 1)
+            try:
+                path, weight = head, float(tail)
+            except ValueError:
+                pass
+        payload = create_payload(path, schema_path, batch_size)
+        body, headers = encode_request_body(payload, binary)
+        payloads.append((path, body, headers))
+        weights.append(weight)
+    return payloads, weights
+
+
+class OpenLoopRun:
+    """
+    Sends requests on a fixed schedule and records their latencies.
+    :param url: inference endpoint
+    :param payloads: (name, body, headers) to choose from
+    :param weights: relative frequency of each payload
+    :param max_connections: size of the HTTP connection pool
+    :param timeout: seconds before a request counts as an error
+    """
+
+    def __init__(
+        self,
+        url: str,
+        payloads: List[Tuple[str, bytes, dict]],
+        weights: List[float],
+        max_connections: int = 100,
+        timeout: float = 600,
+        seed: int = 0,
+    ):
+        self.url = url
+        self.payloads = payloads
+        self.weights = weights
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.corrected = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.failed = LatencyHistogram()
+        self.sent = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.per_payload = {name: 0 for name, _, _ in payloads}
+        self.max_send_lag = 0.0
+
+    async def _send(self, session, payload, scheduled: float):
+        _, body, headers = payload
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        try:
+            async with session.post(self.url, data=body, headers=headers) as response:
+                await response.read()
+                ok = response.status == 200
+        except asyncio.TimeoutError:
+            ok = False
+            self.timeouts += 1
+        except aiohttp.ClientError:
+            ok = False
+        done = loop.time()
+        # A timed-out request is recorded at about the timeout
+        self.corrected.record(done - scheduled)
+        if not ok:
+            self.errors += 1
+            self.failed.record(done - scheduled)
+            return
+        self.service.record(done - sent_at)
+
+    async def run(self, schedule: List[float]) -> float:
+        """
+        Send one request per scheduled time.
+        :return: wall time taken, in seconds
+        """
+        loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            start = loop.time()
+            tasks = []
+            for offset in schedule:
+                scheduled = start + offset
+                delay = scheduled - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.max_send_lag = max(self.max_send_lag, loop.time() - scheduled)
+                payload = self.rng.choices(self.payloads, self.weights)[0]
+                self.per_payload[payload[0]] += 1
+                self.sent += 1
+                tasks.append(asyncio.create_task(self._send(session, payload, scheduled)))
+            await asyncio.gather(*tasks)
+            return loop.time() - start
+
+    def report(self, duration: float, elapsed: float) -> dict:
+        return {
+            "sent": self.sent,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "offered_rps": self.sent / duration if duration else 0.0,
+            "completed_rps": (self.sent - self.errors) / elapsed if elapsed else 0.0,
+            "max_send_lag_s": self.max_send_lag,
+            "per_payload": self.per_payload,
+            "latency_s": self.corrected.summary(),
+            "service_time_s": self.service.summary(),
+            "error_latency_s": self.failed.summary(),
+        }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--schema", required=True, help="Path to the model's config.pbtxt")
+    parser.add_argument("--host", required=True, help="Inference endpoint URL")
+    parser.add_argument(
+        "--data", nargs="+", required=True, help="Data files, each optionally path:weight"
+    )
+    parser.add_argument("--arrivals", choices=["poisson", "bursty", "trace"], default="poisson")
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of load")
+    parser.add_argument("--burst-factor", type=float, default=5.0)
+    parser.add_argument("--burst-seconds", type=float, default=5.0)
+    parser.add_argument("--burst-period", type=float, default=30.0)
+    parser.add_argument("--trace", help="File of send timestamps for --arrivals trace")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Replay the trace faster")
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--binary", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=1, help="Data items per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the report as JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.arrivals == "poisson":
+        schedule = poisson_arrivals(args.rate, args.duration, rng)
+    elif args.arrivals == "bursty":
+        schedule = bursty_arrivals(
+            args.rate,
+            args.duration,
+            rng,
+            burst_factor=args.burst_factor,
+            burst_seconds=args.burst_seconds,
+            burst_period=args.burst_period,
+        )
+    else:
+        schedule = trace_arrivals(args.trace, args.speedup)
+    duration = schedule[-1] if args.arrivals == "trace" and schedule else args.duration
+
+    payloads, weights = load_payloads(args.data, args.schema, args.binary, args.batch_size)
+    load_run = OpenLoopRun(
+        args.host, payloads, weights, args.max_connections, args.timeout, args.seed
+    )
+    print(f"Sending {len(schedule)} requests over {duration:.0f}s ({args.arrivals})")
+    elapsed = asyncio.run(load_run.run(schedule))
+    report = load_run.report(duration, elapsed)
+
+    print(f"Sent {report['sent']}, errors {report['errors']} ({report['timeouts']} timed out), "
+          f"offered {report['offered_rps']:.2f} req/s, completed {report['completed_rps']:.2f} req/s")
+    print(f"Max send lag: {report['max_send_lag_s'] * 1000:.1f} ms")
+    print(f"{'':<22}{'p50':>9}{'p90':>9}{'p99':>9}{'p99.9':>9}{'max':>9}  (ms)")
+    rows = [("latency (corrected)", "latency_s"), ("service time", "service_time_s")]
+    if report["errors"]:
+        rows.append(("errors (corrected)", "error_latency_s"))
+    for label, key in rows:
+        s = report[key]
+        print(f"{label:<22}" + "".join(
+            f"{s[p] * 1000:>9.0f}" for p in ("p50", "p90", "p99", "p99.9", "max")
+        ))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -7,62 +7,90 @@ generate load tests
 """
 
 import base64
+import json
+import struct
+from dataclasses import asdict
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 import numpy as np
 
+from model_config import as_list, field_spans, load_config_dict, load_model_config
+
+# Data types whose content is a path to a file rather than the value itself
+FILE_DATA_TYPES = ("image", "image_bytes", "pixels")
+
 def parse_pbtxt_to_dict(filepath):
     """
     This function takes a defined .pbtxt file and parses it into a dictionary.
     This dictionary can be used to populate the load testing class automatically.
+    Repeated fields such as "input" are lists, and nested messages such as
+    "dynamic_batching" are dictionaries. See model_config.py for typed access.
     """
-    config = {}
-    current_list = None
-    current_dict = None
-
-    with open(filepath, 'r') as file:
-        for line in file:
-            stripped_line = line.strip()
-            if not stripped_line:
-                continue  # Skip empty lines
-            if stripped_line.endswith('['):
-                key = stripped_line.split('[')[0].strip()
-                config[key] = []
-                current_list = config[key]
-            elif stripped_line == ']':
-                current_list = None
-                current_dict = None
-            elif current_list is not None and stripped_line.endswith('{'):
-                current_dict = {}
-                current_list.append(current_dict)
-            elif current_dict is not None and stripped_line == '}':
-                current_dict = None
-            elif current_dict is not None:
-                if ':' in stripped_line:
-                    key, value = stripped_line.split(':', 1)
-                    key = key.strip()
-                    value = value.strip().strip('"')  # Remove any potential quotes
-                    if value.isdigit():  # Handle numeric values
-                        value = int(value)
-                    elif value.replace('.', '', 1).isdigit() and value.count('.') < 2:  # Handle float values
-                        value = float(value)
-                    current_dict[key] = value
-                else:
-                    continue  # Skip malformed lines within dictionaries
-            else:
-                if ':' in stripped_line:
-                    key, value = stripped_line.split(':', 1)
-                    key = key.strip()
-                    value = value.strip().strip('"')  # Remove any potential quotes
-                    if value.isdigit():  # Handle numeric values
-                        value = int(value)
-                    elif value.replace('.', '', 1).isdigit() and value.count('.') < 2:  # Handle float values
-                        value = float(value)
-                    config[key] = value
-                else:
-                    continue  # Skip malformed lines
-
-    return config
+    return load_config_dict(filepath)
+
+def read_dynamic_batching(filepath):
+    """
+    Read the dynamic_batching block of a .pbtxt file.
+    :return: dict with the preferred batch sizes and the max queue delay,
+        or None if the model doesn't use dynamic batching
+    """
+    batching = load_model_config(filepath).dynamic_batching
+    return asdict(batching) if batching is not None else None
+
+def format_dynamic_batching(preferred_batch_size:List[int], max_queue_delay_microseconds:int):
+    """
+    Render a dynamic_batching block in the style of the model configs.
+    """
+    sizes = ", ".join(str(size) for size in preferred_batch_size)
+    return (
+        "dynamic_batching {\n"
+        f"    preferred_batch_size: [{sizes}]\n"
+        f"    max_queue_delay_microseconds: {max_queue_delay_microseconds}\n"
+        "}"
+    )
+
+def _message_body(block:str) -> str:
+    """
+    The text between the outer braces of a message block.
+    """
+    start = min(i for i in (block.find("{"), block.find("<")) if i >= 0)
+    return block[start + 1 : len(block.rstrip()) - 1]
+
+def _merge_dynamic_batching(old_block:str, block:str) -> str:
+    """
+    `block` plus the fields of `old_block` it doesn't set, e.g. a
+    priority_queue_policy { ... } sub-message, each kept as written.
+    """
+    new_fields = {name for name, _, _ in field_spans(_message_body(block))}
+    old_body = _message_body(old_block)
+    kept = [
+        old_body[start:end]
+        for name, start, end in field_spans(old_body)
+        if name not in new_fields
+    ]
+    if not kept:
+        return block
+    closing = block.rstrip().rindex("}")
+    return block[:closing] + "".join(f"    {field}\n" for field in kept) + block[closing:]
+
+def write_dynamic_batching(filepath, block:str):
+    """
+    Replace the dynamic_batching block of a .pbtxt file, or append one.
+    Fields of the existing block that `block` doesn't set are kept.
+    """
+    path = Path(filepath)
+    text = path.read_text()
+    span = next(
+        ((start, end) for name, start, end in field_spans(text) if name == "dynamic_batching"),
+        None,
+    )
+    if span is not None:
+        start, end = span
+        block = _merge_dynamic_batching(text[start:end], block)
+        text = text[:start] + block + text[end:]
+    else:
+        text = text.rstrip("\n") + "\n\n" + block + "\n"
+    path.write_text(text)
 
 def map_data_type_to_request_type(data_type:str):
     """
@@ -76,19 +104,27 @@ def map_data_type_to_request_type(data_type:str):
     else:
         return data_type.replace("TYPE_", "")
 
-def convert_input_schema_into_request_data_dict(schema:dict):
+def convert_input_schema_into_request_data_dict(schema:dict, data:dict=None, batch_size:int=1):
     """
     Parse the schema dictionary into a dictionary that can be used to send requests.
 
     :param schema: dict,
+    :param data: dict, optional data dictionary. Optional inputs missing from it are left out.
+    :param batch_size: int, number of data items the request will carry along its first dimension
     :return: dict,
     """
+    max_batch_size = int(schema.get("max_batch_size", 0))
+    if batch_size > max(max_batch_size, 1):
+        raise ValueError(f"Batch size {batch_size} is above the model's max_batch_size {max_batch_size}")
     base_dict = {"inputs": []}
-    input_dict = schema["input"] # list of dictionaries
-    for input_item in input_dict:
+    # A single input { } block parses to a dict and scalar dims to an int
+    for input_item in as_list(schema["input"]):
+        optional = bool(input_item.get("optional", False))
+        if optional and data is not None and input_item["name"] not in data:
+            continue
         input_data = {
             "name": input_item["name"],
-            "shape": [1]+eval(input_item["dims"]), # converts string to list of ints
+            "shape": [batch_size]+list(as_list(input_item["dims"])),
             "datatype": map_data_type_to_request_type(input_item["data_type"]),
             "data": []
         }
@@ -110,10 +146,34 @@ def parse_data_for_request(data:dict):
                     with open(content, "rb") as f:
                         image_base64 = base64.b64encode(f.read()).decode("utf-8")
                         output_data[key] = image_base64
+            case "image_bytes":
+                # Raw encoded image, only sendable with the binary tensor extension
+                with open(content, "rb") as f:
+                    output_data[key] = f.read()
+            case "pixels":
+                from PIL import Image
+                output_data[key] = np.asarray(Image.open(content).convert("RGB"))
             case _:
                 output_data[key] = eval(content)
     return output_data
 
+def add_data_to_request(request_dict:dict, data_item:dict):
+    """
+    Append one parsed data item to each input of the request dictionary.
+    Array values (e.g. decoded pixels) also set the input's shape, and every
+    item batched into the request must then have the same array shape.
+    """
+    for sub_dict in request_dict["inputs"]:
+        key = sub_dict["name"]
+        value = data_item[key]
+        if isinstance(value, np.ndarray):
+            if sub_dict["data"] and sub_dict["shape"][1:] != list(value.shape):
+                raise ValueError(f"Input {key} has shape {list(value.shape)}, "
+                                 f"other items in the batch have {sub_dict['shape'][1:]}")
+            sub_dict["shape"] = [len(sub_dict["data"]) + 1] + list(value.shape)
+        sub_dict["data"].append([value])
+    return request_dict
+
 def is_correct_type(value, type_str:str):
     """
     Check input data type against the expected type.
@@ -132,7 +192,7 @@ def is_correct_type(value, type_str:str):
         "FLOAT16": np.float16,
         "FLOAT": float,
         "DOUBLE": float,
-        "BYTES": str
+        "BYTES": (str, bytes)
     }
 
     expected_type = type_mapping.get(type_str.strip().upper(), None)
@@ -153,6 +213,147 @@ def validate_request_data_against_schema(schema_dict:dict, data:dict):
         value = data.get(name, None)
         if value is None:
             raise ValueError(f"Input {name} not found in data dictionary")
+        if value["type"] in FILE_DATA_TYPES:
+            continue  # content is a file path, checked when the file is read
         if not is_correct_type(value["content"], data_type):
             raise ValueError(f"Input {name} is not of the correct type {data_type}")
     return True
+
+def map_request_type_to_numpy(datatype:str):
+    """
+    Map a KServe v2 datatype to the numpy dtype of its binary representation.
+    """
+    if datatype == "BYTES":
+        return np.object_
+    if datatype == "FP16":
+        return np.float16
+    if datatype == "FP32":
+        return np.float32
+    if datatype == "FP64":
+        return np.float64
+    if datatype == "BOOL":
+        return np.bool_
+    return np.dtype(datatype.lower())
+
+def serialize_tensor_data(data, datatype:str) -> bytes:
+    """
+    Serialize tensor data into the binary tensor format. BYTES elements are
+    each prefixed with their length as a little-endian uint32, everything
+    else is the row-major array buffer.
+    See: https://github.com/triton-inference-server/server/blob/main/docs/protocol/extension_binary_data.md
+    """
+    if datatype == "BYTES":
+        chunks = []
+        for item in np.array(data, dtype=np.object_).flatten():
+            if isinstance(item, str):
+                item = item.encode("utf-8")
+            chunks.append(struct.pack("<I", len(item)))
+            chunks.append(item)
+        return b"".join(chunks)
+    return np.ascontiguousarray(data, dtype=map_request_type_to_numpy(datatype)).tobytes()
+
+def deserialize_tensor_data(buffer, datatype:str, shape:List[int]) -> np.ndarray:
+    """
+    Read tensor data in the binary tensor format. Fixed-size types are
+    returned as a view of the buffer, without copying.
+    """
+    count = int(np.prod(shape))
+    if datatype == "BYTES":
+        view = memoryview(buffer)
+        items = []
+        offset = 0
+        for _ in range(count):
+            (length,) = struct.unpack_from("<I", view, offset)
+            items.append(bytes(view[offset + 4 : offset + 4 + length]))
+            offset += 4 + length
+        return np.array(items, dtype=np.object_).reshape(shape)
+    return np.frombuffer(buffer, dtype=map_request_type_to_numpy(datatype), count=count).reshape(shape)
+
+def encode_binary_request(request_dict:dict) -> Tuple[bytes, dict]:
+    """
+    Encode a request dictionary using the binary tensor extension: a JSON
+    header without the tensor data, followed by the raw tensor bytes.
+    This avoids base64 and JSON-encoding large inputs such as images.
+
+    :param request_dict: dict, request with "data" for each input
+    :return: request body and the HTTP headers to send with it
+    """
+    header = {key: value for key, value in request_dict.items() if key != "inputs"}
+    header["inputs"] = []
+    buffers = []
+    for input_dict in request_dict["inputs"]:
+        buffer = serialize_tensor_data(input_dict["data"], input_dict["datatype"])
+        header_input = {key: value for key, value in input_dict.items() if key != "data"}
+        header_input["parameters"] = {
+            **input_dict.get("parameters", {}),
+            "binary_data_size": len(buffer),
+        }
+        header["inputs"].append(header_input)
+        buffers.append(buffer)
+
+    json_header = json.dumps(header).encode("utf-8")
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Inference-Header-Content-Length": str(len(json_header)),
+    }
+    return json_header + b"".join(buffers), headers
+
+def encode_request_body(request_dict:dict, binary:bool=False) -> Tuple[bytes, dict]:
+    """
+    Serialize a request dictionary once, so the same bytes can be posted
+    many times without re-encoding.
+
+    :param request_dict: dict, request with "data" for each input
+    :param binary: bool, use the binary tensor extension instead of JSON
+    :return: request body and the HTTP headers to send with it
+    """
+    if binary:
+        return encode_binary_request(request_dict)
+    body = json.dumps(request_dict).encode("utf-8")
+    return body, {"Content-Type": "application/json"}
+
+# Tensors in a shared memory region start on this boundary
+SHARED_MEMORY_ALIGNMENT = 64
+
+def encode_shared_memory_request(request_dict:dict, region_name:str, output_byte_sizes:dict=None):
+    """
+    Lay a request's input tensors out in one shared memory region, followed
+    by space for the outputs, so that the request only carries references.
+    See: https://github.com/triton-inference-server/server/blob/main/docs/protocol/extension_shared_memory.md
+
+    :param request_dict: dict, request with "data" for each input
+    :param region_name: str, name the region is registered under
+    :param output_byte_sizes: dict, bytes to reserve for each output written
+        to the region; other outputs come back in the response body
+    :return: the request header, the (offset, bytes) to write into the
+        region, and the region's total size
+    """
+    header = {key: value for key, value in request_dict.items() if key != "inputs"}
+    header["inputs"] = []
+    writes = []
+    offset = 0
+
+    def place(byte_size):
+        nonlocal offset
+        start = offset
+        offset += -(-byte_size // SHARED_MEMORY_ALIGNMENT) * SHARED_MEMORY_ALIGNMENT
+        return {
+            "shared_memory_region": region_name,
+            "shared_memory_byte_size": byte_size,
+            "shared_memory_offset": start,
+        }
+
+    for input_dict in request_dict["inputs"]:
+        buffer = serialize_tensor_data(input_dict["data"], input_dict["datatype"])
+        header_input = {key: value for key, value in input_dict.items() if key != "data"}
+        parameters = place(len(buffer))
+        header_input["parameters"] = {**input_dict.get("parameters", {}), **parameters}
+        header["inputs"].append(header_input)
+        writes.append((parameters["shared_memory_offset"], buffer))
+
+    if output_byte_sizes:
+        outputs = {output["name"]: output for output in header.get("outputs", [])}
+        for name, byte_size in output_byte_sizes.items():
+            outputs[name] = {"name": name, "parameters": place(byte_size)}
+        header["outputs"] = list(outputs.values())
+    return header, writes, max(offset, 1)
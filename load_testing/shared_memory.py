@@ -0,0 +1,138 @@
+# coding=utf-8
+
+"""
+System shared memory transport for clients on the same host as the
+server.
+
+The client writes a request's input tensors into a POSIX shared memory
+segment once and registers it with the server; every request then only
+carries a small JSON header with references into the region. Outputs can
+be written back into the region too. The server must see the client's
+/dev/shm, e.g. run the container with --ipc=host.
+
+See: https://github.com/triton-inference-server/server/blob/main/docs/protocol/extension_shared_memory.md
+"""
+
+import itertools
+import json
+import os
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict
+
+import numpy as np
+import requests
+
+from request_schema import deserialize_tensor_data, encode_shared_memory_request
+
+_region_ids = itertools.count()
+
+
+def region_name(prefix: str = "loadtest") -> str:
+    """
+    A region name unique to this process.
+    """
+    return f"{prefix}_{os.getpid()}_{next(_region_ids)}"
+
+
+class SharedMemoryRegion:
+    """
+    A system shared memory segment created by the client.
+    :param name: name the region is registered under, also used for the
+        segment's key
+    :param byte_size: size of the segment
+    """
+
+    def __init__(self, name: str, byte_size: int):
+        self.name = name
+        self.byte_size = byte_size
+        self.shm = SharedMemory(name=name, create=True, size=byte_size)
+
+    @property
+    def key(self) -> str:
+        return f"/{self.name}"
+
+    def write(self, offset: int, data: bytes):
+        self.shm.buf[offset : offset + len(data)] = data
+
+    def read(self, offset: int, byte_size: int) -> memoryview:
+        return self.shm.buf[offset : offset + byte_size]
+
+    def register(self, host: str, session: requests.Session = None):
+        session = session or requests.Session()
+        response = session.post(
+            f"{host}/v2/systemsharedmemory/region/{self.name}/register",
+            json={"key": self.key, "offset": 0, "byte_size": self.byte_size},
+        )
+        response.raise_for_status()
+
+    def unregister(self, host: str, session: requests.Session = None):
+        session = session or requests.Session()
+        session.post(f"{host}/v2/systemsharedmemory/region/{self.name}/unregister")
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedMemoryRequest:
+    """
+    A request whose tensors live in a shared memory region. The region is
+    written once, so the same `body` can be posted any number of times,
+    but requests writing outputs to the region must not overlap.
+    :param request_dict: request with "data" for each input
+    :param output_byte_sizes: bytes to reserve for each output written
+        to the region, e.g. {"generated_text": 65536}
+    """
+
+    def __init__(self, request_dict: dict, output_byte_sizes: Dict[str, int] = None):
+        name = region_name()
+        header, writes, byte_size = encode_shared_memory_request(
+            request_dict, name, output_byte_sizes
+        )
+        self.region = SharedMemoryRegion(name, byte_size)
+        for offset, data in writes:
+            self.region.write(offset, data)
+        self.output_parameters = {
+            output["name"]: output["parameters"]
+            for output in header.get("outputs", [])
+            if "parameters" in output
+        }
+        self.body = json.dumps(header).encode("utf-8")
+        self.headers = {"Content-Type": "application/json"}
+        self.host = None
+
+    def register(self, host: str, session: requests.Session = None):
+        self.region.register(host, session)
+        self.host = host
+
+    def outputs(self, response_json: dict) -> dict:
+        """
+        The response's outputs, read from the region for those that were
+        written there and taken from the response body otherwise.
+        """
+        outputs = {}
+        for output in response_json.get("outputs", []):
+            name = output["name"]
+            parameters = self.output_parameters.get(name)
+            if parameters is None:
+                outputs[name] = output.get("data")
+                continue
+            buffer = self.region.read(
+                parameters["shared_memory_offset"], parameters["shared_memory_byte_size"]
+            )
+            # Copied out, the region can't be closed while views of it exist
+            outputs[name] = np.array(
+                deserialize_tensor_data(buffer, output["datatype"], output["shape"])
+            )
+        return outputs
+
+    def close(self):
+        if self.host is not None:
+            self.region.unregister(self.host)
+        self.region.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
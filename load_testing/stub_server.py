@@ -0,0 +1,403 @@
+# coding=utf-8
+
+"""
+Local stand-in for a Triton server, for exercising the load testing and
+batching tuning tools without a GPU. Requests to the model's infer
+endpoint are grouped by a dynamic batcher that follows the model's
+dynamic_batching block, and each batch takes
+base_latency + per_item_latency * batch_size to "execute".
+
+Loading the model through the repository API re-reads its config, like
+Triton in explicit model control mode. System shared memory regions can
+be registered, and the infer endpoint reads inputs from them and writes
+the generated_text output into them, so the shared memory transport can
+be checked too.
+
+    python load_testing/stub_server.py --config model_repository/trocr/config.pbtxt \\
+        --port 8000 --base-latency-ms 20 --per-item-latency-ms 2
+"""
+
+import json
+import queue
+import re
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, List, Optional
+
+from model_config import DynamicBatching, load_model_config
+from request_schema import deserialize_tensor_data, serialize_tensor_data
+
+
+class PendingRequest:
+    def __init__(self, payload=None, rows: int = 1):
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.payload = payload
+        self.rows = rows
+        self.batch_size = 0
+        self.started = 0.0
+        self.finished = 0.0
+        self.result = None
+        self.error: Optional[Exception] = None
+
+
+class DynamicBatcher:
+    """
+    Forms batches the way Triton's dynamic batcher does: a batch is sent as
+    soon as the queued requests fill a preferred batch size, otherwise once
+    the oldest request has waited max_queue_delay. Sizes count request
+    rows, and a batch never exceeds max_batch_size rows.
+    :param base_latency: seconds each batch takes regardless of its size
+    :param per_item_latency: additional seconds per row in the batch
+    :param instances: batches executed concurrently
+    :param execute: runs a batch, given the requests' payloads, and returns
+        a result per request; without it a batch only sleeps
+    """
+
+    def __init__(
+        self,
+        base_latency: float,
+        per_item_latency: float,
+        instances: int = 1,
+        execute: Optional[Callable[[List], List]] = None,
+    ):
+        self.base_latency = base_latency
+        self.per_item_latency = per_item_latency
+        self.execute = execute
+        self.queue: "queue.Queue[PendingRequest]" = queue.Queue()
+        # Taken off the queue but too large for the batch being formed
+        self._held: Optional[PendingRequest] = None
+        self.preferred_batch_size = []
+        self.max_queue_delay = 0.0
+        self.max_batch_size = 1
+        self.inference_count = 0
+        self.execution_count = 0
+        # Cumulative nanoseconds over all requests, as in Triton's statistics
+        self.queue_ns = 0
+        self.compute_ns = 0
+        self.success_ns = 0
+        self._lock = threading.Lock()
+        self._forming = threading.Lock()
+        for _ in range(instances):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def configure(self, config_path: str):
+        config = load_model_config(config_path)
+        batching = config.dynamic_batching or DynamicBatching()
+        with self._lock:
+            self.max_batch_size = max(config.max_batch_size, 1)
+            self.preferred_batch_size = batching.preferred_batch_size
+            self.max_queue_delay = batching.max_queue_delay_microseconds / 1e6
+
+    def enqueue(self, payload=None, rows: int = 1) -> PendingRequest:
+        """
+        Queue a request without waiting for it; its `done` event is set
+        once its batch has finished.
+        """
+        request = PendingRequest(payload, rows)
+        self.queue.put(request)
+        return request
+
+    def submit(self, payload=None, rows: int = 1) -> PendingRequest:
+        """
+        Queue a request and wait for its batch to finish.
+        """
+        request = self.enqueue(payload, rows)
+        request.done.wait()
+        return request
+
+    def _next_batch(self):
+        first, self._held = self._held or self.queue.get(), None
+        batch = [first]
+        rows = first.rows
+        with self._lock:
+            preferred = self.preferred_batch_size
+            target = max(preferred) if preferred else self.max_batch_size
+            target = min(target, self.max_batch_size)
+            deadline = first.arrival + self.max_queue_delay
+        while rows < target:
+            # Requests that are already queued join without waiting
+            try:
+                request = self.queue.get_nowait()
+            except queue.Empty:
+                if rows in preferred:
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if rows + request.rows > self.max_batch_size:
+                self._held = request
+                break
+            batch.append(request)
+            rows += request.rows
+        return batch
+
+    def _execute(self, batch: List[PendingRequest], rows: int):
+        if self.execute is None:
+            time.sleep(self.base_latency + self.per_item_latency * rows)
+            return
+        try:
+            results = self.execute([request.payload for request in batch])
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+
+    def _run(self):
+        while True:
+            # One instance forms a batch at a time, like Triton's scheduler
+            with self._forming:
+                batch = self._next_batch()
+            rows = sum(request.rows for request in batch)
+            started = time.perf_counter()
+            self._execute(batch, rows)
+            finished = time.perf_counter()
+            with self._lock:
+                self.inference_count += rows
+                self.execution_count += 1
+                for request in batch:
+                    self.queue_ns += int((started - request.arrival) * 1e9)
+                    self.compute_ns += int((finished - started) * 1e9)
+                    self.success_ns += int((finished - request.arrival) * 1e9)
+            for request in batch:
+                request.batch_size = rows
+                request.started = started
+                request.finished = finished
+                request.done.set()
+
+
+class SharedMemoryRegistry:
+    """
+    System shared memory regions registered by clients, attached by key.
+    """
+
+    def __init__(self):
+        self.regions = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, key: str, offset: int, byte_size: int):
+        with self._lock:
+            if name in self.regions:
+                raise ValueError(f"shared memory region '{name}' already in manager")
+            shm = SharedMemory(name=key.lstrip("/"))
+            # The client owns the segment, don't unlink it when we exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+            self.regions[name] = (shm, offset, byte_size)
+
+    def unregister(self, name: str = None):
+        with self._lock:
+            names = [name] if name is not None else list(self.regions)
+            for region in names:
+                entry = self.regions.pop(region, None)
+                if entry is not None:
+                    entry[0].close()
+
+    def status(self) -> list:
+        with self._lock:
+            return [
+                {"name": name, "key": f"/{shm.name}", "offset": offset, "byte_size": byte_size}
+                for name, (shm, offset, byte_size) in self.regions.items()
+            ]
+
+    def view(self, parameters: dict) -> memoryview:
+        name = parameters["shared_memory_region"]
+        offset = int(parameters.get("shared_memory_offset", 0))
+        byte_size = int(parameters["shared_memory_byte_size"])
+        with self._lock:
+            if name not in self.regions:
+                raise ValueError(f"Unable to find shared memory region: '{name}'")
+            shm, region_offset, region_size = self.regions[name]
+        if offset + byte_size > region_size:
+            raise ValueError(f"shared memory region '{name}' is too small")
+        start = region_offset + offset
+        return shm.buf[start : start + byte_size]
+
+
+def read_inputs(body: bytes, header_length: int, registry: SharedMemoryRegistry):
+    """
+    Decode an infer request sent as JSON, with the binary tensor extension
+    or with inputs in shared memory.
+    :return: the request header and the inputs as arrays
+    """
+    header = json.loads(body[:header_length] if header_length else body)
+    binary = body[header_length:] if header_length else b""
+    position = 0
+    inputs = {}
+    for tensor in header.get("inputs", []):
+        parameters = tensor.get("parameters", {})
+        if "shared_memory_region" in parameters:
+            data = registry.view(parameters)
+            inputs[tensor["name"]] = deserialize_tensor_data(
+                data, tensor["datatype"], tensor["shape"]
+            ).copy()
+            data.release()
+        elif "binary_data_size" in parameters:
+            size = int(parameters["binary_data_size"])
+            inputs[tensor["name"]] = deserialize_tensor_data(
+                binary[position : position + size], tensor["datatype"], tensor["shape"]
+            )
+            position += size
+        else:
+            inputs[tensor["name"]] = tensor.get("data")
+    return header, inputs
+
+
+def make_handler(
+    model_name: str,
+    config_path: str,
+    batcher: DynamicBatcher,
+    registry: SharedMemoryRegistry,
+):
+    infer_path = re.compile(rf"^/v2/models/{re.escape(model_name)}(/versions/\d+)?/infer$")
+    region_path = re.compile(r"^/v2/systemsharedmemory(/region/([^/]+))?/(register|unregister)$")
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, body: dict, status: int = 200):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path in ("/v2/health/ready", f"/v2/models/{model_name}/ready"):
+                self._send_json({})
+            elif self.path == "/v2/systemsharedmemory/status":
+                self._send_json(registry.status())
+            elif self.path == f"/v2/models/{model_name}/stats":
+                self._send_json(
+                    {
+                        "model_stats": [
+                            {
+                                "name": model_name,
+                                "version": "1",
+                                "inference_count": batcher.inference_count,
+                                "execution_count": batcher.execution_count,
+                                "inference_stats": {
+                                    "success": {
+                                        "count": batcher.inference_count,
+                                        "ns": batcher.success_ns,
+                                    },
+                                    "queue": {
+                                        "count": batcher.inference_count,
+                                        "ns": batcher.queue_ns,
+                                    },
+                                    "compute_infer": {
+                                        "count": batcher.inference_count,
+                                        "ns": batcher.compute_ns,
+                                    },
+                                },
+                            }
+                        ]
+                    }
+                )
+            else:
+                self._send_json({"error": "not found"}, status=404)
+
+        def _infer(self, body: bytes):
+            try:
+                header, inputs = read_inputs(
+                    body, int(self.headers.get("Inference-Header-Content-Length", 0)), registry
+                )
+            except (ValueError, KeyError) as e:
+                self._send_json({"error": str(e)}, status=400)
+                return
+            first = next(iter(inputs.values()), None)
+            rows = len(first) if first is not None else 1
+            batch_size = batcher.submit(rows=rows).batch_size
+            texts = [f"stub response from a batch of {batch_size}"] * rows
+            output = {"name": "generated_text", "datatype": "BYTES", "shape": [rows, 1]}
+            requested = {o["name"]: o for o in header.get("outputs", [])}
+            parameters = requested.get("generated_text", {}).get("parameters", {})
+            if "shared_memory_region" in parameters:
+                data = serialize_tensor_data(texts, "BYTES")
+                try:
+                    view = registry.view(parameters)
+                    if len(data) > len(view):
+                        raise ValueError(
+                            f"generated_text needs {len(data)} bytes of shared memory, "
+                            f"{len(view)} were given"
+                        )
+                except (ValueError, KeyError) as e:
+                    self._send_json({"error": str(e)}, status=400)
+                    return
+                view[: len(data)] = data
+                view.release()
+                output["parameters"] = {
+                    "shared_memory_region": parameters["shared_memory_region"],
+                    "shared_memory_byte_size": len(data),
+                }
+            else:
+                output["data"] = texts
+            self._send_json({"model_name": model_name, "outputs": [output]})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            region = region_path.match(self.path)
+            if infer_path.match(self.path):
+                self._infer(body)
+            elif region is not None:
+                name, action = region.group(2), region.group(3)
+                try:
+                    if action == "register":
+                        request = json.loads(body)
+                        registry.register(
+                            name,
+                            request["key"],
+                            int(request.get("offset", 0)),
+                            int(request["byte_size"]),
+                        )
+                    else:
+                        registry.unregister(name)
+                except (ValueError, KeyError, OSError) as e:
+                    self._send_json({"error": str(e)}, status=400)
+                    return
+                self._send_json({})
+            elif self.path == f"/v2/repository/models/{model_name}/load":
+                batcher.configure(config_path)
+                self._send_json({})
+            else:
+                self._send_json({"error": "not found"}, status=404)
+
+        def log_message(self, format, *args):
+            pass  # one line per request would swamp the load test output
+
+    return Handler
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 refuses connections under load
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="Path to the model's config.pbtxt")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--base-latency-ms", type=float, default=20)
+    parser.add_argument("--per-item-latency-ms", type=float, default=2)
+    parser.add_argument("--instances", type=int, default=1)
+    args = parser.parse_args()
+
+    model_name = load_model_config(args.config).name
+    batcher = DynamicBatcher(
+        args.base_latency_ms / 1000, args.per_item_latency_ms / 1000, args.instances
+    )
+    batcher.configure(args.config)
+    registry = SharedMemoryRegistry()
+    server = StubHTTPServer(
+        ("0.0.0.0", args.port), make_handler(model_name, args.config, batcher, registry)
+    )
+    print(f"Stub server for {model_name} on port {args.port}")
+    server.serve_forever()
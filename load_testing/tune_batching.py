@@ -0,0 +1,202 @@
+# coding=utf-8
+
+"""
+Sweep a model's dynamic batching settings against a running server.
+
+For every combination of preferred batch sizes and max queue delay, the
+model's config.pbtxt is rewritten, the model is reloaded through the
+repository API (start tritonserver with --model-control-mode=explicit)
+and locustfile.py is run headless with its CustomLoadShape. Latency
+percentiles, throughput and the mean executed batch size are recorded
+per configuration, and the best configuration is printed as a
+dynamic_batching block. The original config is restored afterwards.
+
+Try the whole loop locally against stub_server.py:
+
+    python load_testing/stub_server.py --config model_repository/trocr/config.pbtxt &
+    python load_testing/tune_batching.py --config model_repository/trocr/config.pbtxt \\
+        --data load_testing/data/<data>.json --host http://localhost:8000 \\
+        --preferred-batch-sizes 4 8 4,8,16 --delays-us 200 5000 --run-time 30
+"""
+
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import requests
+
+from model_config import load_model_config
+from request_schema import format_dynamic_batching, write_dynamic_batching
+
+LOCUSTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locustfile.py")
+
+
+def reload_model(host: str, model: str, timeout: float = 600):
+    """
+    Ask the server to reload the model, which re-reads its config.
+    """
+    response = requests.post(f"{host}/v2/repository/models/{model}/load", timeout=timeout)
+    response.raise_for_status()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        ready = requests.get(f"{host}/v2/models/{model}/ready", timeout=5)
+        if ready.status_code == 200:
+            return
+        time.sleep(1)
+    raise TimeoutError(f"{model} did not become ready")
+
+
+def model_counts(host: str, model: str):
+    """
+    Requests and batch executions the server has run for the model so far.
+    """
+    response = requests.get(f"{host}/v2/models/{model}/stats", timeout=5)
+    response.raise_for_status()
+    stats = response.json()["model_stats"][0]
+    return int(stats["inference_count"]), int(stats["execution_count"])
+
+
+def run_locust(args, csv_prefix: str) -> dict:
+    """
+    Run the locust harness headless and read its aggregated statistics.
+    """
+    command = [
+        sys.executable, "-m", "locust",
+        "-f", LOCUSTFILE,
+        "--headless", "--only-summary",
+        "--host", f"{args.host}/v2/models/{args.model}/infer",
+        "--schema", args.config,
+        "--data", args.data,
+        "--run-time", f"{args.run_time}s",
+        "--csv", csv_prefix,
+        "--starting-users", str(args.starting_users),
+        "--bulk-ramp", str(args.bulk_ramp),
+        "--bulk-interval", str(args.bulk_interval),
+        "--user-throughput", str(args.user_throughput),
+    ]
+    if args.binary:
+        command.append("--binary")
+    subprocess.run(command, check=False, cwd=os.path.dirname(LOCUSTFILE))
+
+    with open(f"{csv_prefix}_stats.csv") as f:
+        row = next(r for r in csv.DictReader(f) if r["Name"] == "Aggregated")
+    return {
+        "requests": int(row["Request Count"]),
+        "failures": int(row["Failure Count"]),
+        "throughput_rps": float(row["Requests/s"]),
+        "p50_ms": float(row["50%"]),
+        "p95_ms": float(row["95%"]),
+        "p99_ms": float(row["99%"]),
+    }
+
+
+def recommend(results: list, p95_slo_ms: float = None, max_failure_ratio: float = 0.01) -> dict:
+    """
+    Highest-throughput configuration whose p95 latency meets the SLO, or
+    the lowest-p95 one when none does. Configurations with more failed
+    requests than `max_failure_ratio` are only considered if all have.
+    """
+    candidates = [
+        r for r in results if r["failures"] <= max_failure_ratio * max(r["requests"], 1)
+    ] or results
+    if p95_slo_ms is not None:
+        within_slo = [r for r in candidates if r["p95_ms"] <= p95_slo_ms]
+        if within_slo:
+            return max(within_slo, key=lambda r: r["throughput_rps"])
+        return min(candidates, key=lambda r: r["p95_ms"])
+    return max(candidates, key=lambda r: r["throughput_rps"])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", required=True, help="Path to the model's config.pbtxt")
+    parser.add_argument("--data", required=True, help="Path to the data file")
+    parser.add_argument("--host", default="http://localhost:8000", help="Server URL")
+    parser.add_argument("--model", help="Model name, read from the config by default")
+    parser.add_argument(
+        "--preferred-batch-sizes",
+        nargs="+",
+        default=["2", "4", "8", "2,4,8"],
+        help="Comma-separated preferred_batch_size lists to try",
+    )
+    parser.add_argument(
+        "--delays-us",
+        nargs="+",
+        type=int,
+        default=[200, 5000, 50000],
+        help="max_queue_delay_microseconds values to try",
+    )
+    parser.add_argument("--run-time", type=int, default=60, help="Seconds per configuration")
+    parser.add_argument("--starting-users", type=int, default=8)
+    parser.add_argument("--bulk-ramp", type=int, default=8)
+    parser.add_argument("--bulk-interval", type=float, default=15)
+    parser.add_argument("--user-throughput", type=float, default=1.0)
+    parser.add_argument("--binary", action="store_true")
+    parser.add_argument("--p95-slo-ms", type=float, help="Latency target for the recommendation")
+    parser.add_argument(
+        "--max-failure-ratio",
+        type=float,
+        default=0.01,
+        help="Largest share of failed requests a recommended configuration may have",
+    )
+    parser.add_argument("--output", default="batching_sweep.json", help="Where to save the results")
+    args = parser.parse_args()
+    # locust runs from this directory
+    args.config = os.path.abspath(args.config)
+    args.data = os.path.abspath(args.data)
+
+    config = load_model_config(args.config)
+    args.model = args.model or config.name
+    max_batch_size = config.max_batch_size
+    original_config = Path(args.config).read_text()
+
+    results = []
+    try:
+        for sizes, delay_us in itertools.product(args.preferred_batch_sizes, args.delays_us):
+            preferred = [int(size) for size in sizes.split(",")]
+            if max(preferred) > max_batch_size:
+                print(f"Skipping {preferred}: above max_batch_size {max_batch_size}")
+                continue
+            block = format_dynamic_batching(preferred, delay_us)
+            write_dynamic_batching(args.config, block)
+            reload_model(args.host, args.model)
+            print(f"Running preferred_batch_size={preferred}, max_queue_delay_microseconds={delay_us}")
+
+            inferences, executions = model_counts(args.host, args.model)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                stats = run_locust(args, os.path.join(tmp_dir, "sweep"))
+            inferences_after, executions_after = model_counts(args.host, args.model)
+            executed = executions_after - executions
+            result = {
+                "preferred_batch_size": preferred,
+                "max_queue_delay_microseconds": delay_us,
+                **stats,
+                "mean_batch_size": (inferences_after - inferences) / executed if executed else 0.0,
+            }
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        Path(args.config).write_text(original_config)
+        reload_model(args.host, args.model)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'preferred':<16}{'delay_us':>10}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'batch':>7}")
+    for r in results:
+        print(
+            f"{str(r['preferred_batch_size']):<16}{r['max_queue_delay_microseconds']:>10}"
+            f"{r['throughput_rps']:>9.1f}{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+            f"{r['p99_ms']:>9.0f}{r['mean_batch_size']:>7.1f}"
+        )
+    if results:
+        best = recommend(results, args.p95_slo_ms, args.max_failure_ratio)
+        print("\nRecommended:\n")
+        print(format_dynamic_batching(best["preferred_batch_size"], best["max_queue_delay_microseconds"]))
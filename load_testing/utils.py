@@ -1,10 +1,11 @@
 from request_schema import (
     parse_pbtxt_to_dict,
     parse_data_for_request,
+    add_data_to_request,
     validate_request_data_against_schema,
     convert_input_schema_into_request_data_dict,
 )
-from typing import Dict
+from typing import Dict, List
 import json
 
 
@@ -12,26 +13,86 @@ def format_data(input_data, model_conf):
     """
     Parse the data dictionary into a format that can be sent in the request.
     """
-    data_item = parse_data_for_request(input_data)
-    payload = model_conf.copy()
-    for sub_dict in payload["inputs"]:
-        key = sub_dict["name"]
-        data = [data_item[key]]
-        sub_dict["data"].append(data)
+    return format_batch([input_data], model_conf)
 
-    if not validate_request_data_against_schema(model_conf, input_data):
-        raise ValueError("Data dictionary does not conform to schema")
 
+def format_batch(data_items: List[dict], model_conf) -> Dict:
+    """
+    Pack several data items into one request, one item per row of each
+    input tensor.
+    """
+    payload = model_conf
+    for input_data in data_items:
+        if not validate_request_data_against_schema(model_conf, input_data):
+            raise ValueError("Data dictionary does not conform to schema")
+        payload = add_data_to_request(payload, parse_data_for_request(input_data))
     return payload
 
 
-def create_payload(data_path, model_conf_path) -> Dict:
+def vary_data_item(data_item: dict, variant: int) -> dict:
+    """
+    Copy of a data item whose last string input is marked with the variant
+    number, so repeated items still make distinct requests (e.g. to keep
+    them out of a response cache).
+    """
+    data_item = {key: dict(value) for key, value in data_item.items()}
+    string_keys = [key for key, value in data_item.items() if value["type"] == "string"]
+    if string_keys:
+        data_item[string_keys[-1]]["content"] += f" ({variant})"
+    return data_item
 
-    model_conf = parse_pbtxt_to_dict(model_conf_path)
-    schema = convert_input_schema_into_request_data_dict(model_conf)
+
+def _read_data_items(data_path) -> List[dict]:
     with open(data_path, "r") as f:
         data = json.load(f)
+    return data if isinstance(data, list) else [data]
 
-    payload = format_data(data, schema)
 
-    return payload
+def _cycle_data_items(items: List[dict], count: int) -> List[dict]:
+    """
+    `count` data items cycling through `items`; repeats of an item are
+    varied with `vary_data_item`.
+    """
+    cycled = []
+    for i in range(count):
+        item = items[i % len(items)]
+        if i >= len(items):
+            item = vary_data_item(item, i // len(items))
+        cycled.append(item)
+    return cycled
+
+
+def create_payload(data_path, model_conf_path, batch_size: int = 1) -> Dict:
+    """
+    Build one request from a data file.
+    :param batch_size: data items packed into the request, cycling through
+        the items of the data file
+    """
+    model_conf = parse_pbtxt_to_dict(model_conf_path)
+    items = _cycle_data_items(_read_data_items(data_path), batch_size)
+    schema = convert_input_schema_into_request_data_dict(model_conf, items[0], batch_size)
+    return format_batch(items, schema)
+
+
+def create_payload_corpus(
+    data_path, model_conf_path, size: int = 0, batch_size: int = 1
+) -> List[Dict]:
+    """
+    Build a payload for every item of a data file, which holds either one
+    data item or a list of them.
+    :param size: number of payloads to build, cycling through the items;
+        repeats of an item are varied with `vary_data_item`. 0 builds
+        enough payloads to cover every item once.
+    :param batch_size: data items packed into each payload
+    """
+    model_conf = parse_pbtxt_to_dict(model_conf_path)
+    items = _read_data_items(data_path)
+    size = size or -(-len(items) // batch_size)
+    items = _cycle_data_items(items, size * batch_size)
+
+    payloads = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start : start + batch_size]
+        schema = convert_input_schema_into_request_data_dict(model_conf, batch[0], batch_size)
+        payloads.append(format_batch(batch, schema))
+    return payloads
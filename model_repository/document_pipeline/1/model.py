@@ -0,0 +1,148 @@
+# coding=utf-8
+
+"""
+Triton Backend reading a scanned page with TrOCR and summarising it with
+Llama 3, in one request.
+
+The page's crops go to `trocr` in one batched BLS request, and the text
+of every crop becomes the user message of a `llama3_8b` request. Both
+calls stay inside the server, so the client makes one round trip and the
+intermediate text never goes back over the network.
+"""
+
+import asyncio
+import json
+from typing import List
+
+import numpy as np
+import triton_python_backend_utils as pb_utils
+
+# Image inputs in order of preference, passed on to the OCR model as they are
+IMAGE_INPUTS = ("image_bytes", "image")
+
+
+class StepError(Exception):
+    """
+    A model the pipeline called answered with an error.
+    """
+
+    def __init__(self, model_name: str, error):
+        super().__init__(f"{model_name}: {error.message()}")
+        self.code = error.code() if hasattr(error, "code") else None
+
+
+def _text(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+class TritonPythonModel:
+    def initialize(self, args):
+        self.model_config = json.loads(args["model_config"])
+        self.model_params = self.model_config.get("parameters", {})
+        self.ocr_model = self._param("ocr_model", "trocr")
+        self.llm_model = self._param("llm_model", "llama3_8b")
+        # Pages with more crops than the OCR model's max_batch_size are sent
+        # as several requests, all at once
+        self.ocr_batch_size = int(self._param("ocr_batch_size", "32"))
+        self.system_message = self._param("system_message", "")
+
+    def _param(self, key, default):
+        return self.model_params.get(key, {}).get("string_value", default)
+
+    def _error_response(self, message, code_name="INVALID_ARG", code=None):
+        """
+        An error response with the given or named TritonError code, on
+        Triton releases that have error codes.
+        """
+        if code is None:
+            code = getattr(pb_utils.TritonError, code_name, None)
+        error = (
+            pb_utils.TritonError(message)
+            if code is None
+            else pb_utils.TritonError(message, code)
+        )
+        return pb_utils.InferenceResponse(output_tensors=[], error=error)
+
+    async def _call(self, model_name: str, inputs: List, output_name: str) -> np.ndarray:
+        request = pb_utils.InferenceRequest(
+            model_name=model_name,
+            requested_output_names=[output_name],
+            inputs=inputs,
+        )
+        response = await request.async_exec()
+        if response.has_error():
+            raise StepError(model_name, response.error())
+        return pb_utils.get_output_tensor_by_name(response, output_name).as_numpy()
+
+    async def read_page(self, input_name: str, crops: np.ndarray) -> List[str]:
+        """
+        OCR every crop of a page.
+        :param crops: one encoded image per element
+        :return: the text of each crop, in order
+        """
+        rows = crops.reshape(-1, 1)
+        chunks = [
+            rows[start : start + self.ocr_batch_size]
+            for start in range(0, len(rows), self.ocr_batch_size)
+        ]
+        outputs = await asyncio.gather(
+            *[
+                self._call(self.ocr_model, [pb_utils.Tensor(input_name, chunk)], "generated_text")
+                for chunk in chunks
+            ]
+        )
+        return [_text(text) for output in outputs for text in output.reshape(-1)]
+
+    async def summarise(self, system_message: str, texts: List[str], max_new_tokens=None) -> str:
+        """
+        Ask the LLM for a summary of the page, one line of text per crop.
+        """
+        inputs = [
+            pb_utils.Tensor(
+                "system_message", np.array([[system_message.encode("utf-8")]], dtype=np.object_)
+            ),
+            pb_utils.Tensor(
+                "user_message", np.array([["\n".join(texts).encode("utf-8")]], dtype=np.object_)
+            ),
+        ]
+        if max_new_tokens is not None:
+            inputs.append(
+                pb_utils.Tensor("max_new_tokens", np.asarray(max_new_tokens, dtype=np.int32).reshape(1, 1))
+            )
+        output = await self._call(self.llm_model, inputs, "generated_text")
+        return _text(output.reshape(-1)[0])
+
+    async def _run(self, request):
+        for input_name in IMAGE_INPUTS:
+            tensor = pb_utils.get_input_tensor_by_name(request, input_name)
+            if tensor is not None:
+                break
+        if tensor is None or tensor.as_numpy().size == 0:
+            return self._error_response(
+                "DOCUMENT: request has no crops in 'image_bytes' or 'image'"
+            )
+        system_message = self.system_message
+        system_tensor = pb_utils.get_input_tensor_by_name(request, "system_message")
+        if system_tensor is not None:
+            system_message = _text(system_tensor.as_numpy().reshape(-1)[0])
+        max_new_tokens = pb_utils.get_input_tensor_by_name(request, "max_new_tokens")
+
+        try:
+            texts = await self.read_page(input_name, tensor.as_numpy())
+            summary = await self.summarise(
+                system_message,
+                texts,
+                None if max_new_tokens is None else max_new_tokens.as_numpy().reshape(-1)[0],
+            )
+        except StepError as e:
+            return self._error_response(f"DOCUMENT: {e}", "INTERNAL", e.code)
+        return pb_utils.InferenceResponse(
+            output_tensors=[
+                pb_utils.Tensor("generated_text", np.array([summary], dtype=np.object_)),
+                pb_utils.Tensor("ocr_text", np.array(texts, dtype=np.object_)),
+            ]
+        )
+
+    async def execute(self, requests):
+        # Pages run concurrently: one page's OCR overlaps another's summary
+        return list(await asyncio.gather(*[self._run(request) for request in requests]))
@@ -0,0 +1,178 @@
+# coding=utf-8
+
+"""
+Token-budget admission control.
+
+Every request row reserves the KV cache it can grow to, its prompt tokens
+plus max_new_tokens, until it finishes. Rows are only run while the
+reservations fit the budget, and a row arriving when the budget is taken
+is rejected straight away, with a retryable error, if the wait for
+enough of it to free up would exceed the queue-time SLO. The wait is
+estimated from the rate at which reserved tokens have been released
+while the model was busy. Until rows have finished to measure it, the
+rate is assumed to be a whole budget per queue limit, so at most one
+budget's worth of rows queues behind a full budget at cold start.
+
+This module has no Triton dependency so it can be exercised with a fake
+model and clock.
+"""
+
+import threading
+import time
+from typing import Callable, Optional
+
+
+def kv_cache_bytes_per_token(config, dtype_bytes: int = 2) -> int:
+    """
+    Bytes of KV cache one token takes in every layer, from a HF model config.
+    """
+    heads = config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    # A key and a value vector per layer and KV head
+    return 2 * config.num_hidden_layers * kv_heads * head_dim * dtype_bytes
+
+
+class AdmissionRejected(Exception):
+    """
+    :param retry_after: seconds after which the same request is expected
+        to be admitted, or None when it can never fit the budget
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.retry_after is not None
+
+
+class AdmissionController:
+    """
+    :param token_budget: KV cache tokens that may be reserved at once, 0 for
+        no limit
+    :param max_queue_seconds: longest estimated wait for the budget that is
+        accepted, 0 to queue whatever the wait
+    :param smoothing: how fast older releases are forgotten in the drain rate
+    :param clock: monotonic time source, replaceable in tests
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 0,
+        max_queue_seconds: float = 0.0,
+        smoothing: float = 0.2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.token_budget = token_budget
+        self.max_queue_seconds = max_queue_seconds
+        self.smoothing = smoothing
+        self.clock = clock
+        # Tokens reserved by admitted rows, queued or running
+        self.outstanding_tokens = 0
+        self.outstanding_rows = 0
+        # Decayed sums of released tokens and of the busy time they took,
+        # seeded with a budget per queue limit that measurements decay away
+        self._released_tokens = 0.0
+        self._busy_seconds = 0.0
+        if token_budget > 0 and max_queue_seconds > 0:
+            self._released_tokens = float(token_budget)
+            self._busy_seconds = float(max_queue_seconds)
+        self.admitted = 0
+        self.rejected = {"too_large": 0, "queue_slo": 0}
+        self._busy_since = 0.0
+        self._last_release = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.token_budget > 0
+
+    @property
+    def drain_rate(self) -> float:
+        """
+        Reserved tokens released per second while busy; the seeded rate
+        until measured, 0 without a queue limit.
+        """
+        if self._busy_seconds <= 0:
+            return 0.0
+        return self._released_tokens / self._busy_seconds
+
+    @staticmethod
+    def footprint(prompt_tokens: int, max_new_tokens: int) -> int:
+        return prompt_tokens + max_new_tokens
+
+    def _estimated_wait(self, tokens: int) -> Optional[float]:
+        excess = self.outstanding_tokens + tokens - self.token_budget
+        if excess <= 0:
+            return 0.0
+        if self.drain_rate <= 0:
+            return None  # no queue limit to seed from and nothing finished yet
+        return excess / self.drain_rate
+
+    def estimated_wait(self, tokens: int) -> Optional[float]:
+        """
+        Seconds until `tokens` more would fit the budget, or None when it
+        can't be estimated yet.
+        """
+        with self._lock:
+            return self._estimated_wait(tokens)
+
+    def admit(self, tokens: int) -> int:
+        """
+        Reserve `tokens` of the budget, or raise AdmissionRejected.
+        :return: the tokens reserved, to hand back to `release`
+        """
+        with self._lock:
+            if not self.enabled:
+                return 0
+            if tokens > self.token_budget:
+                self.rejected["too_large"] += 1
+                raise AdmissionRejected(
+                    f"Request needs {tokens} KV cache tokens (prompt plus "
+                    f"max_new_tokens), above the budget of {self.token_budget}"
+                )
+            wait = self._estimated_wait(tokens)
+            if self.max_queue_seconds > 0 and wait is not None and wait > self.max_queue_seconds:
+                self.rejected["queue_slo"] += 1
+                raise AdmissionRejected(
+                    f"Server busy: {self.outstanding_tokens} of {self.token_budget} KV cache "
+                    f"tokens reserved, estimated wait {wait:.1f}s is above the "
+                    f"{self.max_queue_seconds:g}s queue limit",
+                    retry_after=wait - self.max_queue_seconds,
+                )
+            if self.outstanding_rows == 0:
+                self._busy_since = self.clock()
+            self.outstanding_tokens += tokens
+            self.outstanding_rows += 1
+            self.admitted += 1
+            return tokens
+
+    def release(self, tokens: int):
+        """
+        Hand back a reservation once its row has finished, successfully or not.
+        """
+        with self._lock:
+            if not self.enabled:
+                return
+            now = self.clock()
+            # Only time spent busy counts; rows finishing together share it
+            elapsed = now - max(self._last_release, self._busy_since)
+            decay = 1 - self.smoothing
+            self._released_tokens = decay * self._released_tokens + tokens
+            self._busy_seconds = decay * self._busy_seconds + max(elapsed, 0.0)
+            self._last_release = now
+            self.outstanding_tokens -= tokens
+            self.outstanding_rows -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "token_budget": self.token_budget,
+                "outstanding_tokens": self.outstanding_tokens,
+                "outstanding_rows": self.outstanding_rows,
+                "drain_tokens_per_second": round(self.drain_rate, 1),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+            }
@@ -0,0 +1,77 @@
+# coding=utf-8
+
+"""
+Length-aware bucketing of prompts within a dynamic batch.
+
+Padding every prompt to the longest one in the batch wastes most of the
+compute when short and long prompts arrive together, so prompts are
+sorted by tokenized length and split into sub-batches that each pad to
+their own longest prompt.
+"""
+
+from typing import List, Sequence
+
+
+def bucket_by_length(
+    lengths: Sequence[int],
+    max_padding: float = 0.1,
+    max_bucket_size: int = 0,
+    max_bucket_tokens: int = 0,
+    new_tokens: int = 0,
+    max_length: int = 0,
+) -> List[List[int]]:
+    """
+    Group prompt indices into buckets of similar length.
+    :param lengths: tokenized length of each prompt
+    :param max_padding: largest fraction of a bucket's token slots that may
+        be spent on padding before a new bucket is started
+    :param max_bucket_size: cap on prompts per bucket, 0 for no cap
+    :param max_bucket_tokens: cap on the KV cache a bucket can grow to,
+        (longest prompt + new_tokens) * prompts, 0 for no cap
+    :param new_tokens: tokens each prompt may generate
+    :param max_length: with new_tokens 0, the length every prompt in a
+        bucket may grow to, counting the padding to the longest one
+    :return: lists of indices into `lengths`, shortest prompts first
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets: List[List[int]] = []
+    bucket: List[int] = []
+    bucket_tokens = 0
+    for i in order:
+        # Sorted ascending, so the candidate is the bucket's new longest prompt
+        slots = lengths[i] * (len(bucket) + 1)
+        tokens = bucket_tokens + lengths[i]
+        full = (max_bucket_size and len(bucket) >= max_bucket_size) or (
+            max_bucket_tokens
+            and _grown_length(lengths[i], new_tokens, max_length) * (len(bucket) + 1)
+            > max_bucket_tokens
+        )
+        if bucket and (full or (slots - tokens) > max_padding * slots):
+            buckets.append(bucket)
+            bucket, tokens = [], lengths[i]
+        bucket.append(i)
+        bucket_tokens = tokens
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def _grown_length(longest: int, new_tokens: int, max_length: int) -> int:
+    """
+    Length the rows of a bucket grow to, padded to its longest prompt.
+    """
+    if new_tokens > 0:
+        return longest + new_tokens
+    return max(max_length, longest + 1)
+
+
+def padding_tokens(lengths: Sequence[int], buckets: List[List[int]]) -> int:
+    """
+    Number of pad tokens processed when each bucket is padded to its
+    longest prompt.
+    """
+    total = 0
+    for bucket in buckets:
+        longest = max(lengths[i] for i in bucket)
+        total += sum(longest - lengths[i] for i in bucket)
+    return total
@@ -0,0 +1,492 @@
+# coding=utf-8
+
+"""
+Continuous (iteration-level) batching for HF causal LMs.
+
+Instead of running a whole batch of prompts to completion, the engine
+runs one decode step at a time over the set of running sequences.
+Between steps new sequences are admitted (prefilled on their own, so
+no prompt is ever padded to another one's length) and finished ones
+are retired, so short prompts don't wait behind long generations.
+The running sequences share one KV cache with a row per sequence
+(kv_cache.py), written in place at every step.
+
+This module has no Triton dependency so it can be exercised on CPU
+with a tiny randomly-initialised model.
+"""
+
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+import torch
+
+from kv_cache import SlotKVCache
+
+# Per-layer (key, value) tensors of shape [batch, heads, seq_len, head_dim]
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def to_legacy_cache(past) -> PastKeyValues:
+    """
+    Normalise a model's returned cache into the legacy tuple format.
+    """
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+@dataclass(frozen=True)
+class GenerationParams:
+    """
+    Per-request decoding settings. Instances are hashable so requests with
+    identical settings can share one generation call.
+    :param max_new_tokens: 0 generates until the prompt plus completion
+        reach the model's max_length, see `for_prompt`
+    :param temperature: None, like top_k and top_p, leaves the setting to
+        the model's generation_config, see `with_defaults`
+    :param seed: makes sampling reproducible; None draws from the global RNG
+    """
+
+    max_new_tokens: int = 1024
+    do_sample: bool = True
+    temperature: Optional[float] = None
+    top_k: Optional[int] = 10
+    top_p: Optional[float] = None
+    seed: Optional[int] = None
+
+    @property
+    def deterministic(self) -> bool:
+        return not self.do_sample
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def for_prompt(self, prompt_tokens: int, max_length: int) -> "GenerationParams":
+        """
+        The settings for a prompt of `prompt_tokens`, with a max_new_tokens
+        of 0 replaced by what is left of `max_length`, at least one token.
+        """
+        if self.max_new_tokens > 0:
+            return self
+        return replace(self, max_new_tokens=max(max_length - prompt_tokens, 1))
+
+    def with_defaults(self, generation_config) -> "GenerationParams":
+        """
+        The settings with the sampling knobs left at None taken from a
+        model's generation_config, as `generate` would.
+        """
+        defaults = {
+            name: getattr(generation_config, name, None)
+            for name in ("temperature", "top_k", "top_p")
+            if getattr(self, name) is None
+        }
+        return replace(self, **defaults) if defaults else self
+
+    def generate_kwargs(self) -> dict:
+        """
+        Keyword arguments for HF `generate`. Sampling knobs are only passed
+        when sampling, to keep greedy decoding free of warnings, and when
+        set, so that `generate` falls back to the model's generation_config.
+        """
+        kwargs = {"max_new_tokens": self.max_new_tokens, "do_sample": self.do_sample}
+        if self.do_sample:
+            for name in ("temperature", "top_k", "top_p"):
+                if getattr(self, name) is not None:
+                    kwargs[name] = getattr(self, name)
+        return kwargs
+
+
+def sample_next_token(
+    logits: torch.Tensor,
+    params: GenerationParams,
+    generator: Optional[torch.Generator] = None,
+) -> int:
+    """
+    Pick the next token from one row of [vocab] logits, with the same
+    temperature -> top-k -> top-p order as HF `generate`. Knobs left at
+    None are skipped; see `GenerationParams.with_defaults`.
+    """
+    if not params.do_sample:
+        return int(torch.argmax(logits))
+    logits = logits.float()
+    if params.temperature is not None:
+        logits = logits / params.temperature
+    if params.top_k:
+        top_k = min(params.top_k, logits.shape[-1])
+        kth = torch.topk(logits, top_k).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if params.top_p is not None and params.top_p < 1.0:
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        # Drop tokens once the more likely tokens before them cover top_p
+        remove = sorted_probs.cumsum(dim=-1) - sorted_probs >= params.top_p
+        logits[sorted_ids[remove]] = float("-inf")
+    probs = torch.softmax(logits, dim=-1)
+    return int(torch.multinomial(probs, num_samples=1, generator=generator))
+
+
+@dataclass
+class GenerationStats:
+    """
+    Token counts and timing for one completion, as produced by generation
+    (no re-tokenization of the output text).
+    """
+
+    prompt_tokens: int
+    completion_tokens: int
+    seconds: float
+    # Time to the first generated token, the rest of `seconds` is decoding
+    prefill_seconds: Optional[float] = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "seconds": self.seconds,
+            "prefill_seconds": self.prefill_seconds,
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+
+@dataclass
+class Sequence:
+    """
+    A single generation request tracked by the engine.
+    :param input_ids: tokenized prompt
+    :param params: decoding settings, including when to stop
+    :param prefix_length: number of leading prompt tokens that may be served
+        from the prefix cache (e.g. the system message)
+    :param on_token: called from the engine thread with each new token id
+    :param on_finish: called from the engine thread once the sequence retires
+    :param stop_check: polled before every step; a non-None return (e.g.
+        "cancelled") retires the sequence with that finish_reason
+    """
+
+    input_ids: List[int]
+    params: GenerationParams = field(default_factory=GenerationParams)
+    prefix_length: int = 0
+    on_token: Optional[Callable[["Sequence", int], None]] = None
+    on_finish: Optional[Callable[["Sequence"], None]] = None
+    stop_check: Optional[Callable[[], Optional[str]]] = None
+    generated: List[int] = field(default_factory=list)
+    # Row of the engine's KV cache, while running
+    slot: Optional[int] = None
+    cached_tokens: int = 0
+    finished: bool = False
+    finish_reason: Optional[str] = None
+    error: Optional[Exception] = None
+    started_at: float = 0.0
+    first_token_at: float = 0.0
+    finished_at: float = 0.0
+    done: threading.Event = field(default_factory=threading.Event)
+
+    _generator: Optional[torch.Generator] = field(default=None, init=False, repr=False)
+
+    @property
+    def length(self) -> int:
+        return len(self.input_ids) + len(self.generated)
+
+    @property
+    def max_length(self) -> int:
+        """
+        Tokens the KV cache can grow to, what the sequence reserves of the
+        engine's token budget.
+        """
+        return len(self.input_ids) + self.params.max_new_tokens
+
+    def generator(self, device) -> Optional[torch.Generator]:
+        """
+        Per-sequence RNG so seeded requests sample the same tokens whatever
+        else is in the batch.
+        """
+        if self.params.seed is None:
+            return None
+        if self._generator is None:
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(self.params.seed)
+        return self._generator
+
+    @property
+    def stats(self) -> GenerationStats:
+        return GenerationStats(
+            prompt_tokens=len(self.input_ids),
+            completion_tokens=len(self.generated),
+            seconds=self.finished_at - self.started_at,
+            prefill_seconds=self.first_token_at - self.started_at,
+        )
+
+
+class ContinuousBatchingEngine:
+    """
+    Step-level decode loop over a changing set of sequences, each with
+    its own row of a shared KV cache.
+    :param model: HF causal LM returning logits and past_key_values
+    :param eos_token_id: id (or ids) that end a sequence
+    :param max_running: maximum number of sequences decoded together
+    :param prefix_cache: optional PrefixCache used to skip prefilling
+        prompt prefixes that have been seen before
+    :param token_budget: cap on the summed `max_length` of the running
+        sequences, 0 for no cap; a sequence that doesn't fit waits, and
+        holds up the ones behind it, until enough others have retired
+    """
+
+    def __init__(
+        self,
+        model,
+        eos_token_id: Union[int, Iterable[int]],
+        max_running: int = 8,
+        prefix_cache=None,
+        token_budget: int = 0,
+    ):
+        self.model = model
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+        self.max_running = max_running
+        self.prefix_cache = prefix_cache
+        self.token_budget = token_budget
+        self.kv_cache = SlotKVCache(max_running)
+
+        self.waiting: "queue.Queue[Sequence]" = queue.Queue()
+        self.running: List[Sequence] = []
+        # Taken off the queue but not admitted yet, for lack of budget
+        self._next: Optional[Sequence] = None
+        self.num_steps = 0
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def submit(self, seq: Sequence) -> Sequence:
+        """
+        Queue a sequence for admission at the next step. Sampling settings
+        it leaves unset come from the model's generation_config.
+        """
+        generation_config = getattr(self.model, "generation_config", None)
+        if generation_config is not None:
+            seq.params = seq.params.with_defaults(generation_config)
+        self.waiting.put(seq)
+        self._wakeup.set()
+        return seq
+
+    def has_work(self) -> bool:
+        return bool(self.running) or self._next is not None or not self.waiting.empty()
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Sequences submitted but not running yet.
+        """
+        return self.waiting.qsize() + (self._next is not None)
+
+    @property
+    def reserved_tokens(self) -> int:
+        return sum(seq.max_length for seq in self.running)
+
+    def _sample(self, logits: torch.Tensor, seqs: List[Sequence]) -> List[int]:
+        """
+        Pick the next token for each row of [batch, vocab] logits, using
+        each sequence's own decoding settings.
+        """
+        return [
+            sample_next_token(row, seq.params, seq.generator(logits.device))
+            for row, seq in zip(logits, seqs)
+        ]
+
+    def _append(self, seq: Sequence, token: int):
+        seq.generated.append(token)
+        if len(seq.generated) == 1:
+            seq.first_token_at = time.perf_counter()
+        if seq.on_token is not None:
+            seq.on_token(seq, token)
+        if token in self.eos_token_ids:
+            seq.finished, seq.finish_reason = True, "stop"
+        elif len(seq.generated) >= seq.params.max_new_tokens:
+            seq.finished, seq.finish_reason = True, "length"
+
+    def _stopped(self, seq: Sequence) -> bool:
+        """
+        Whether the sequence's stop check asks for it to be dropped, e.g.
+        because its client has gone away.
+        """
+        if seq.stop_check is None:
+            return False
+        reason = seq.stop_check()
+        if reason is None:
+            return False
+        seq.finish_reason = reason
+        return True
+
+    def _retire(self, seq: Sequence):
+        seq.finished = True
+        seq.finished_at = time.perf_counter()
+        self.kv_cache.remove(seq)
+        if seq.on_finish is not None:
+            seq.on_finish(seq)
+        seq.done.set()
+
+    def _prefix_past(self, seq: Sequence) -> Optional[PastKeyValues]:
+        """
+        Look up (or build and store) the KV cache for the sequence's prefix.
+        At least one prompt token is always left over for the prefill to
+        produce logits from.
+        """
+        prefix_length = min(seq.prefix_length, len(seq.input_ids) - 1)
+        if self.prefix_cache is None or prefix_length <= 0:
+            return None
+        prefix_ids = seq.input_ids[:prefix_length]
+        past = self.prefix_cache.get(prefix_ids)
+        if past is None:
+            input_ids = torch.tensor([prefix_ids], device=self.device)
+            out = self.model(input_ids=input_ids, use_cache=True)
+            past = to_legacy_cache(out.past_key_values)
+            self.prefix_cache.put(prefix_ids, past)
+        else:
+            seq.cached_tokens = prefix_length
+        return past
+
+    def _prefill(self, seq: Sequence):
+        """
+        Run the prompt through the model to build the sequence's KV cache
+        and pick its first token. A cached prefix is reused as-is, only the
+        remainder of the prompt is run.
+        """
+        seq.started_at = time.perf_counter()
+        past = self._prefix_past(seq)
+        start = past[0][0].shape[2] if past is not None else 0
+        input_ids = torch.tensor([seq.input_ids[start:]], device=self.device)
+        out = self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+        token = self._sample(out.logits[:, -1, :], [seq])[0]
+        self._append(seq, token)
+        if not seq.finished:
+            self.kv_cache.add(seq, to_legacy_cache(out.past_key_values))
+
+    def _decode(self, seqs: List[Sequence]):
+        """
+        One decode step for all running sequences, which hold every slot
+        of the KV cache. Shorter caches are masked out up to the longest one.
+        """
+        seqs = sorted(seqs, key=lambda seq: seq.slot)
+        lengths = self.kv_cache.lengths[: len(seqs)]
+        attention_mask = self.kv_cache.begin_step(len(seqs))
+        position_ids = torch.tensor(lengths, device=self.device).unsqueeze(-1)
+        input_ids = torch.tensor(
+            [[seq.generated[-1]] for seq in seqs], device=self.device
+        )
+
+        out = self.model(
+            input_ids=input_ids,
+            past_key_values=self.kv_cache,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        self.kv_cache.end_step()
+        tokens = self._sample(out.logits[:, -1, :], seqs)
+        for seq, token in zip(seqs, tokens):
+            self._append(seq, token)
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        Admit waiting sequences, run one decode step over everything
+        running and retire whatever finished.
+        """
+        # Stopped sequences are dropped first, so their slots and budget
+        # go to waiting sequences in this very step
+        still_running = []
+        for seq in self.running:
+            if self._stopped(seq):
+                self._retire(seq)
+            else:
+                still_running.append(seq)
+        self.running = still_running
+
+        admitted = []
+        reserved = self.reserved_tokens
+        while len(self.running) + len(admitted) < self.max_running:
+            if self._next is None:
+                try:
+                    self._next = self.waiting.get_nowait()
+                except queue.Empty:
+                    break
+            seq = self._next
+            if self._stopped(seq):
+                # Never prefilled, e.g. expired while waiting
+                self._next = None
+                self._retire(seq)
+                continue
+            over_budget = self.token_budget and reserved + seq.max_length > self.token_budget
+            # A sequence larger than the whole budget still runs on its own
+            if over_budget and (self.running or admitted):
+                break
+            admitted.append(seq)
+            reserved += seq.max_length
+            self._next = None
+
+        decoding = [seq for seq in self.running if not seq.finished]
+        try:
+            # Decode first: the sequences prefilled next join the KV cache
+            # at the column the decode step ends on
+            if decoding:
+                self._decode(decoding)
+            for seq in admitted:
+                self._prefill(seq)
+        except Exception as e:
+            for seq in self.running + admitted:
+                seq.error = e
+                self._retire(seq)
+            self.running = []
+            raise
+
+        self.num_steps += 1
+        still_running = []
+        for seq in self.running + admitted:
+            if seq.finished:
+                self._retire(seq)
+            else:
+                still_running.append(seq)
+        self.running = still_running
+
+    def run_until_complete(self):
+        """
+        Step until every submitted sequence has finished.
+        """
+        while self.has_work():
+            self.step()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not self.has_work():
+                self._wakeup.wait(timeout=0.1)
+                self._wakeup.clear()
+                continue
+            try:
+                self.step()
+            except Exception:
+                # The failing sequences have already been retired with the error.
+                continue
+
+    def start(self):
+        """
+        Run the step loop on a background thread.
+        """
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,149 @@
+# coding=utf-8
+
+"""
+The KV cache of the sequences the continuous batching engine decodes
+together, one row (slot) per sequence.
+
+Keys and values live in per-layer buffers of shape
+[slots, heads, capacity, head_dim] that are allocated once and grown by
+doubling. Every sequence ends at the same column, the one its next token
+is written to, and the columns before a shorter sequence are masked out.
+A decode step writes that column in place and attends over a view of the
+buffers, so nothing is padded, concatenated or sliced back out per step.
+"""
+
+from typing import List
+
+import torch
+from transformers.cache_utils import Cache
+
+
+class SlotKVCache(Cache):
+    """
+    Occupied slots are always the first ones: a sequence that leaves is
+    replaced by the one in the last slot.
+    :param num_slots: sequences cached at once, the engine's max_running
+    """
+
+    def __init__(self, num_slots: int):
+        self.num_slots = num_slots
+        self.keys: List[torch.Tensor] = []
+        self.values: List[torch.Tensor] = []
+        # Sequence in each occupied slot and the tokens cached for it
+        self.sequences: list = []
+        self.lengths: List[int] = []
+        # The column the next token of every sequence is written to
+        self.end = 0
+        # Slots and first column the running decode step attends over
+        self._rows = 0
+        self._start = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.keys[0].shape[2] if self.keys else 0
+
+    def _reserve(self, before: int, after: int):
+        """
+        Make room for `before` columns up to the write column and `after`
+        from it on, moving the cached tokens over when needed. Columns no
+        sequence uses any more are dropped on the way.
+        """
+        if before <= self.end and self.end + after <= self.capacity:
+            return
+        live = max(self.lengths, default=0)
+        end = max(live, before)
+        capacity = self.capacity
+        if end + after > capacity:
+            capacity = 2 * (end + after)
+        rows = len(self.sequences)
+        for buffers in (self.keys, self.values):
+            for layer, old in enumerate(buffers):
+                block = old[:rows, :, self.end - live : self.end]
+                if capacity == old.shape[2]:
+                    new, block = old, block.clone()
+                else:
+                    # Zeros, as masked columns still get multiplied with
+                    new = old.new_zeros(old.shape[0], old.shape[1], capacity, old.shape[3])
+                new[:rows, :, end - live : end] = block
+                buffers[layer] = new
+        self.end = end
+
+    def add(self, seq, past):
+        """
+        Copy the legacy-format KV cache of a prefilled sequence into the
+        next free slot.
+        """
+        if len(self.sequences) >= self.num_slots:
+            raise RuntimeError(f"All {self.num_slots} KV cache slots are in use")
+        if not self.keys:
+            for key, value in past:
+                shape = (self.num_slots, key.shape[1], 0, key.shape[3])
+                self.keys.append(key.new_zeros(shape))
+                self.values.append(value.new_zeros(shape))
+        length = past[0][0].shape[2]
+        self._reserve(before=length, after=1)
+        slot = len(self.sequences)
+        for layer, (key, value) in enumerate(past):
+            self.keys[layer][slot, :, self.end - length : self.end] = key[0]
+            self.values[layer][slot, :, self.end - length : self.end] = value[0]
+        self.sequences.append(seq)
+        self.lengths.append(length)
+        seq.slot = slot
+
+    def remove(self, seq):
+        """
+        Free the sequence's slot, if it holds one.
+        """
+        if seq.slot is None:
+            return
+        slot, last = seq.slot, len(self.sequences) - 1
+        if slot != last:
+            moved, length = self.sequences[last], self.lengths[last]
+            for buffer in self.keys + self.values:
+                buffer[slot, :, self.end - length : self.end] = buffer[
+                    last, :, self.end - length : self.end
+                ]
+            self.sequences[slot], self.lengths[slot] = moved, length
+            moved.slot = slot
+        self.sequences.pop()
+        self.lengths.pop()
+        seq.slot = None
+        if not self.sequences:
+            self.end = 0
+
+    def begin_step(self, rows: int) -> torch.Tensor:
+        """
+        Set up a decode step over the first `rows` slots.
+        :return: the [rows, past + 1] attention mask for the step
+        """
+        self._reserve(before=0, after=1)
+        lengths = self.lengths[:rows]
+        live = max(lengths)
+        self._rows, self._start = rows, self.end - live
+        attention_mask = torch.zeros(
+            rows, live + 1, dtype=torch.long, device=self.keys[0].device
+        )
+        for i, length in enumerate(lengths):
+            attention_mask[i, live - length :] = 1
+        return attention_mask
+
+    def end_step(self):
+        """
+        Account for the column written by the decode step.
+        """
+        self.end += 1
+        for i in range(self._rows):
+            self.lengths[i] += 1
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        keys, values = self.keys[layer_idx], self.values[layer_idx]
+        keys[: self._rows, :, self.end] = key_states[:, :, -1]
+        values[: self._rows, :, self.end] = value_states[:, :, -1]
+        window = slice(self._start, self.end + 1)
+        return keys[: self._rows, :, window], values[: self._rows, :, window]
+
+    def get_seq_length(self, layer_idx=0) -> int:
+        return self.end - self._start
+
+    def get_max_length(self):
+        return None
@@ -1,122 +1,1116 @@
 import os
-from typing import List
+from typing import List, Optional
 import json
+import time
+from dataclasses import replace
+from functools import lru_cache
+from threading import Thread
 import triton_python_backend_utils as pb_utils
 import numpy as np
 import torch
 
 os.environ["HF_HOME"] = "/opt/tritonserver/.hf-cache"
 from transformers import (
-    pipeline,
+    AutoConfig,
     AutoTokenizer,
     AutoModelForCausalLM,
     TextIteratorStreamer,
-    BitsAndBytesConfig
 )
 import huggingface_hub
 
-huggingface_hub.login(token=os.environ.get("HF_TOKEN"))  ## Add your HF credentials
+from backend_common.metrics import metrics_from_parameters
+from backend_common.response_cache import response_cache_from_parameters
+from backend_common.startup import (
+    SNAPSHOT_DIR,
+    StartupTimer,
+    load_snapshot,
+    quantization_kwargs,
+    snapshot_info,
+)
+from admission import AdmissionController, AdmissionRejected, kv_cache_bytes_per_token
+from batching import bucket_by_length, padding_tokens
+from engine import (
+    ContinuousBatchingEngine,
+    GenerationParams,
+    GenerationStats,
+    Sequence,
+)
+from prefix_cache import PrefixCache
+from speculative import SpeculativeDecoder
+from stopping import CANCELLED, STOP_REASONS, StopCheck, stop_criteria
+
+# Optional outputs, only built when the client asks for them
+STATS_OUTPUTS = ("prompt_tokens", "completion_tokens", "tokens_per_second")
+# Optional per-request inputs overriding the default generation settings
+PARAM_INPUTS = ("max_new_tokens", "temperature", "top_k", "top_p", "seed", "greedy")
+
+
+class FirstTokenTimer:
+    """
+    Notes when the first completion token comes out of generation, which
+    splits prefill from decode time. Passed to model.generate as its
+    streamer, which is given the prompt first and then each new token.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.first_token_at = None
+
+    def put(self, value):
+        self.calls += 1
+        if self.calls == 2:
+            self.first_token_at = time.perf_counter()
+
+    def end(self):
+        pass
+
+    def on_token(self, token):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def seconds_since(self, start: float):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - start
 
 
 class TritonPythonModel:
     def initialize(self, args):
         cur_path = os.path.abspath(__file__)
+        timer = StartupTimer("llama3_8b")
         self.model_config = json.loads(args["model_config"])
         self.model_params = self.model_config.get("parameters", {})
+        # Defaults for requests that don't set their own generation inputs. A
+        # max_new_tokens of 0 generates until prompt plus completion reach
+        # max_length, so longer prompts get shorter completions. Temperature
+        # and top_p come from the model's generation_config.
+        self.default_params = GenerationParams(
+            max_new_tokens=int(
+                self.model_params.get("max_new_tokens", {}).get("string_value", "0")
+            ),
+            do_sample=True,
+            top_k=10,
+        )
         self.max_length = int(
-            self.model_params.get("max_length", {}).get("string_value", "1024")
+            self.model_params.get("max_length", {}).get("string_value", "8000")
         )
-        quant_map = {
-            "4bit": {"load_in_4bit": True},
-            "8bit": {"load_in_8bit": True},
-            "full": {},
-        }
         logger = pb_utils.Logger
         quant_level = self.model_params.get("quantize", {}).get("string_value", "")
         logger.log_info(f"Quant level: {quant_level}")
-        quant_arg = quant_map.get(quant_level, {})
-        if quant_arg and quant_level == "4bit":
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True
-            )
-            quant_arg = {"quantization_config": bnb_config}
         hf_model = "meta-llama/Meta-Llama-3-8B-Instruct"
-        self.tokenizer = AutoTokenizer.from_pretrained(hf_model)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            hf_model,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            cache_dir=os.environ["HF_HOME"],
-            **quant_arg,
-        )
-        self.model.resize_token_embeddings(len(self.tokenizer))
-        self.pipeline = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            torch_dtype=torch.float16,
-            device_map="auto",
-        )
-        self.pipeline.tokenizer.pad_token_id = self.model.config.eos_token_id
-
-    def generate(self, prompts: List[List[dict]]):
+        self._load_model(hf_model, quant_level, os.path.dirname(cur_path), timer)
+        self.tokenizer.pad_token_id = self.model.config.eos_token_id
+        self.tokenizer.padding_side = "left"
+
+        # Prompts in a dynamic batch are split into sub-batches of similar
+        # length, each of which wastes at most this fraction on padding.
+        self.max_padding = float(
+            self.model_params.get("max_padding", {}).get("string_value", "0.1")
+        )
+
+        # Each request row reserves its prompt plus max_new_tokens of KV
+        # cache. Rows beyond the budget wait their turn, or are turned away
+        # with a retryable error when the wait would exceed the queue limit.
+        self.admission = self._admission_controller()
+
+        # Rows stop between decode steps once their client has cancelled, or
+        # once past their deadline: the request's own timeout, else
+        # request_timeout_s. Their responses are errors saying which.
+        self.check_cancellation = (
+            self.model_params.get("check_cancellation", {}).get("string_value", "true")
+            == "true"
+        )
+        self.request_timeout_s = float(
+            self.model_params.get("request_timeout_s", {}).get("string_value", "0")
+        )
+
+        # Streaming needs the decoupled transaction policy so that each request
+        # can receive many responses through its response sender.
+        self.decoupled = pb_utils.using_decoupled_model_transaction_policy(
+            self.model_config
+        )
+        self.streaming = (
+            self.model_params.get("streaming", {}).get("string_value", "false").lower()
+            == "true"
+        )
+        if self.streaming and not self.decoupled:
+            raise pb_utils.TritonModelException(
+                "llama3_8b: 'streaming' requires model_transaction_policy { decoupled: true }"
+            )
+        logger.log_info(f"Streaming: {self.streaming}, decoupled: {self.decoupled}")
+
+        # "static" runs each dynamic batch through model.generate to completion,
+        # "continuous" hands sequences to a step-level decode loop that admits
+        # and retires them every iteration.
+        self.scheduler = self.model_params.get("scheduler", {}).get(
+            "string_value", "static"
+        )
+        self.engine = None
+        self.prefix_cache = None
+        prefix_cache_mb = float(
+            self.model_params.get("prefix_cache_mb", {}).get("string_value", "0")
+        )
+        if self.scheduler == "continuous":
+            if prefix_cache_mb > 0:
+                self.prefix_cache = PrefixCache(int(prefix_cache_mb * 1024 * 1024))
+            max_running = int(
+                self.model_params.get("max_running_sequences", {}).get(
+                    "string_value", "8"
+                )
+            )
+            self.engine = ContinuousBatchingEngine(
+                self.model,
+                eos_token_id=self.tokenizer.eos_token_id,
+                max_running=max_running,
+                prefix_cache=self.prefix_cache,
+                token_budget=self.admission.token_budget,
+            )
+            self.engine.start()
+        elif prefix_cache_mb > 0:
+            logger.log_warn(
+                "llama3_8b: prefix_cache_mb only applies to the continuous scheduler"
+            )
+        logger.log_info(f"Scheduler: {self.scheduler}")
+
+        # A small draft model sharing the tokenizer proposes tokens that the
+        # 8B model verifies in one forward pass. Greedy requests only, so
+        # the output is unchanged.
+        self.speculative = None
+        draft_model = self.model_params.get("draft_model", {}).get("string_value", "")
+        if draft_model and self.engine is not None:
+            logger.log_warn(
+                "llama3_8b: draft_model only applies to the static scheduler"
+            )
+        elif draft_model:
+            with timer.phase("draft_model"):
+                draft = AutoModelForCausalLM.from_pretrained(
+                    draft_model,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    cache_dir=os.environ["HF_HOME"],
+                )
+            num_draft_tokens = int(
+                self.model_params.get("num_draft_tokens", {}).get("string_value", "4")
+            )
+            self.speculative = SpeculativeDecoder(
+                self.model,
+                draft,
+                eos_token_id=self.tokenizer.eos_token_id,
+                num_draft_tokens=num_draft_tokens,
+            )
+            logger.log_info(
+                f"Speculative decoding: {draft_model}, {num_draft_tokens} draft tokens"
+            )
+        self._prefix_ids = lru_cache(maxsize=64)(self._tokenize_system_prefix)
+
+        # Identical prompts are answered from the cache, but only when
+        # decoding is deterministic; sampled outputs are never reused.
+        self.response_cache = response_cache_from_parameters(self.model_params)
+        self.cache_params = {"quantize": quant_level, "max_length": self.max_length}
+
+        # Batch sizes, phase timings and token counts go to the server's
+        # metrics endpoint; the per-batch log lines are opt-in.
+        self.metrics = metrics_from_parameters(pb_utils, args, self.model_params)
+        self.log_requests = (
+            self.model_params.get("log_requests", {}).get("string_value", "false")
+            == "true"
+        )
+        logger.log_info(json.dumps(timer.as_dict()))
+
+    def _load_model(self, hf_model: str, quant_level: str, version_dir: str, timer):
+        """
+        Load the tokenizer and model from the snapshot written by
+        backend_common/prepare_snapshot.py when there is one, without
+        touching the network. Otherwise log in and load from the hub.
+        """
         logger = pb_utils.Logger
-        batches = self.pipeline(
-            prompts,
-            do_sample=True,
-            top_k=10,
+        snapshot_path = os.path.join(version_dir, SNAPSHOT_DIR)
+        info = snapshot_info(snapshot_path)
+        if info is not None and info.get("quantize") != (quant_level or "full"):
+            logger.log_warn(
+                f"llama3_8b: ignoring snapshot prepared with quantize="
+                f"{info.get('quantize')}, the model is configured with {quant_level}"
+            )
+            info = None
+
+        if info is None:
+            with timer.phase("login"):
+                huggingface_hub.login(token=os.environ.get("HF_TOKEN"))
+            with timer.phase("tokenizer"):
+                self.tokenizer = AutoTokenizer.from_pretrained(hf_model)
+            with timer.phase("model"):
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    hf_model,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    cache_dir=os.environ["HF_HOME"],
+                    **quantization_kwargs(quant_level),
+                )
+                self.model.resize_token_embeddings(len(self.tokenizer))
+            return
+
+        logger.log_info(f"Loading snapshot {snapshot_path}")
+        with timer.phase("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(snapshot_path)
+        with timer.phase("model"):
+            config = AutoConfig.from_pretrained(snapshot_path)
+            if getattr(config, "quantization_config", None):
+                # bitsandbytes weights need the quantizer's own loading path
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    snapshot_path, torch_dtype=torch.float16, device_map="auto"
+                )
+            else:
+                workers = self.model_params.get("snapshot_workers", {})
+                self.model = load_snapshot(
+                    snapshot_path,
+                    AutoModelForCausalLM.from_config,
+                    config,
+                    device="cuda" if torch.cuda.is_available() else "cpu",
+                    num_workers=int(workers.get("string_value", "4")),
+                )
+
+    def _admission_controller(self) -> AdmissionController:
+        """
+        The token budget is the smaller of admission_token_budget and the
+        tokens that fit in admission_kv_cache_mb, 0 for no limit.
+        """
+        budget = int(
+            self.model_params.get("admission_token_budget", {}).get("string_value", "0")
+        )
+        kv_cache_mb = float(
+            self.model_params.get("admission_kv_cache_mb", {}).get("string_value", "0")
+        )
+        if kv_cache_mb > 0:
+            per_token = kv_cache_bytes_per_token(self.model.config)
+            memory_budget = int(kv_cache_mb * 1024 * 1024) // per_token
+            budget = min(budget, memory_budget) if budget else memory_budget
+        max_queue_s = float(
+            self.model_params.get("admission_max_queue_s", {}).get("string_value", "0")
+        )
+        pb_utils.Logger.log_info(
+            f"Admission token budget: {budget or 'unlimited'}, queue limit: {max_queue_s}s"
+        )
+        return AdmissionController(token_budget=budget, max_queue_seconds=max_queue_s)
+
+    def _tokenize(self, prompt: List[dict]) -> List[int]:
+        return self.tokenizer.apply_chat_template(prompt, add_generation_prompt=True)
+
+    def generate(
+        self,
+        input_ids: List[List[int]],
+        params: List[GenerationParams],
+        checks: List[Optional[StopCheck]] = None,
+    ):
+        """
+        Generate a completion for each tokenized prompt. Prompts with the
+        same generation settings share a call, and within those groups
+        prompts are bucketed by length and each bucket is run as its own
+        sub-batch, so short prompts aren't padded out to the longest one in
+        the batch. Buckets are also kept within the admission token budget.
+        Results are returned in the original prompt order.
+        :param checks: each prompt's StopCheck, polled between decode steps;
+            a stopped prompt is padded until the rest of its bucket is done
+        :return: completion texts and their GenerationStats
+        """
+        if checks is None:
+            checks = [None] * len(input_ids)
+        logger = pb_utils.Logger
+        lengths = [len(ids) for ids in input_ids]
+        groups = {}
+        for i, prompt_params in enumerate(params):
+            groups.setdefault(prompt_params, []).append(i)
+        buckets = []
+        for group_params, indices in groups.items():
+            group_buckets = bucket_by_length(
+                [lengths[i] for i in indices],
+                max_padding=self.max_padding,
+                max_bucket_tokens=self.admission.token_budget,
+                new_tokens=group_params.max_new_tokens,
+                max_length=self.max_length,
+            )
+            buckets += [
+                (group_params, [indices[j] for j in bucket]) for bucket in group_buckets
+            ]
+        if self.log_requests:
+            logger.log_info(
+                f"(Llama) Parameter groups: {len(groups)}, "
+                f"buckets: {[len(bucket) for _, bucket in buckets]}, "
+                f"pad tokens: {padding_tokens(lengths, [bucket for _, bucket in buckets])} "
+                f"(unbucketed: {padding_tokens(lengths, [list(range(len(lengths)))])})"
+            )
+
+        texts = [None] * len(input_ids)
+        stats = [None] * len(input_ids)
+        for bucket_params, bucket in buckets:
+            bucket_checks = [checks[i] for i in bucket]
+            if all(check is not None and check() for check in bucket_checks):
+                # Stopped while earlier buckets ran
+                for i in bucket:
+                    texts[i], stats[i] = "", GenerationStats(lengths[i], 0, 0.0)
+                continue
+            # Like generate's max_length, a max_new_tokens of 0 counts the
+            # padding to the bucket's longest prompt
+            bucket_params = bucket_params.for_prompt(
+                max(lengths[i] for i in bucket), self.max_length
+            )
+            if self.speculative is not None and bucket_params.deterministic:
+                for i in bucket:
+                    texts[i], stats[i] = self._generate_speculative(
+                        input_ids[i], bucket_params, checks[i]
+                    )
+                continue
+            batch = self.tokenizer.pad(
+                {"input_ids": [input_ids[i] for i in bucket]},
+                padding=True,
+                return_tensors="pt",
+            ).to(self.model.device)
+            if bucket_params.seed is not None:
+                torch.manual_seed(bucket_params.seed)
+            first_token = FirstTokenTimer()
+            start = time.perf_counter()
+            output_ids = self.model.generate(
+                **batch,
+                **bucket_params.generate_kwargs(),
+                num_return_sequences=1,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.eos_token_id,
+                streamer=first_token,
+                stopping_criteria=stop_criteria(
+                    bucket_checks, self.tokenizer.eos_token_id
+                ),
+            )
+            seconds = time.perf_counter() - start
+            completion_ids = output_ids[:, batch["input_ids"].shape[1] :]
+            completions = self.tokenizer.batch_decode(
+                completion_ids, skip_special_tokens=True
+            )
+            completion_lengths = self._completion_lengths(completion_ids)
+            for i, text, length in zip(bucket, completions, completion_lengths):
+                texts[i] = text
+                stats[i] = GenerationStats(
+                    prompt_tokens=lengths[i],
+                    completion_tokens=length,
+                    seconds=seconds,
+                    prefill_seconds=first_token.seconds_since(start),
+                )
+
+        return texts, stats
+
+    def _generate_speculative(
+        self, input_ids: List[int], params: GenerationParams, check: StopCheck = None
+    ):
+        """
+        Greedily generate one completion with the draft model.
+        :return: completion text and its GenerationStats
+        """
+        params = params.for_prompt(len(input_ids), self.max_length)
+        first_token = FirstTokenTimer()
+        start = time.perf_counter()
+        completion_ids, _ = self.speculative.generate(
+            input_ids,
+            params.max_new_tokens,
+            on_token=first_token.on_token,
+            should_stop=check,
+        )
+        stats = GenerationStats(
+            prompt_tokens=len(input_ids),
+            completion_tokens=len(completion_ids),
+            seconds=time.perf_counter() - start,
+            prefill_seconds=first_token.seconds_since(start),
+        )
+        text = self.tokenizer.decode(completion_ids, skip_special_tokens=True)
+        return text, stats
+
+    def _completion_lengths(self, completion_ids: torch.Tensor) -> List[int]:
+        """
+        Generated tokens per row, up to and including the first EOS. Rows
+        that finished early are padded with EOS after it.
+        """
+        is_eos = completion_ids == self.tokenizer.eos_token_id
+        first_eos = is_eos.int().argmax(dim=1) + 1
+        full_length = torch.full_like(first_eos, completion_ids.shape[1])
+        return torch.where(is_eos.any(dim=1), first_eos, full_length).tolist()
+
+    def stream(
+        self,
+        prompt_ids: List[int],
+        params: GenerationParams,
+        response_sender,
+        requested=(),
+        check: StopCheck = None,
+    ):
+        """
+        Generate a completion for a single prompt, sending each decoded
+        chunk of tokens as a partial response as soon as it is produced.
+        The final response only carries the requested token-count outputs,
+        or the error when the request was stopped.
+        :param prompt_ids: tokenized chat messages for one request
+        :param params: generation settings for the request
+        :param response_sender: the request's decoupled response sender
+        :param requested: names of the outputs the client asked for
+        :param check: the request's StopCheck, polled between decode steps
+        """
+        params = params.for_prompt(len(prompt_ids), self.max_length)
+        input_ids = torch.tensor([prompt_ids], device=self.model.device)
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        generation_kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            streamer=streamer,
+            **params.generate_kwargs(),
             num_return_sequences=1,
             eos_token_id=self.tokenizer.eos_token_id,
             pad_token_id=self.tokenizer.eos_token_id,
-            max_length=self.max_length,
-            batch_size=len(prompts),
+            stopping_criteria=stop_criteria([check], self.tokenizer.eos_token_id),
         )
-        output_tensors = []
+        if params.seed is not None:
+            torch.manual_seed(params.seed)
+        result = {}
 
-        for i, batch in enumerate(batches):
-            texts = []
-            for i, seq in enumerate(batch):
-                text = seq["generated_text"][-1]["content"]
-                tokens = self.tokenizer.encode(text)
-                logger.log_info(
-                    f"Processed item. Number of output tokens: {len(tokens)}"
+        def run():
+            try:
+                if self.speculative is None or not params.deterministic:
+                    result["output_ids"] = self.model.generate(**generation_kwargs)
+                    return
+                # Feed the streamer the way generate does: prompt first, then
+                # each token as it's accepted.
+                streamer.put(input_ids.cpu())
+                completion_ids, _ = self.speculative.generate(
+                    prompt_ids,
+                    params.max_new_tokens,
+                    on_token=lambda token: streamer.put(torch.tensor([token])),
+                    should_stop=check,
                 )
-                texts.append(text)
+                result["output_ids"] = torch.tensor([prompt_ids + completion_ids])
+            except Exception as e:
+                result["error"] = e
+            finally:
+                # generate ends the streamer itself, but not when it raises;
+                # without the end marker the loop below would wait forever.
+                # A second marker is never read.
+                streamer.end()
+
+        start = time.perf_counter()
+        first_chunk_at = None
+        thread = Thread(target=run)
+        thread.start()
+        for chunk in streamer:
+            # Nobody is left to read the text of a stopped request
+            if not chunk or (check is not None and check.reason is not None):
+                continue
+            if first_chunk_at is None:
+                first_chunk_at = time.perf_counter()
+            response_sender.send(self._response(chunk))
+        thread.join()
+        final_flag = pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+        if "error" in result:
+            response_sender.send(
+                self._error_response(f"Generation failed: {result['error']}", "INTERNAL"),
+                flags=final_flag,
+            )
+            return
+        completion_ids = result["output_ids"][:, input_ids.shape[1] :]
+        stats = GenerationStats(
+            prompt_tokens=input_ids.shape[1],
+            completion_tokens=self._completion_lengths(completion_ids)[0],
+            seconds=time.perf_counter() - start,
+            prefill_seconds=(
+                first_chunk_at - start if first_chunk_at is not None else None
+            ),
+        )
+        self._record_stats([stats])
+        if check is not None and check.reason is not None:
+            final = self._stopped_response(check.reason, stats.completion_tokens)
+        else:
+            final = pb_utils.InferenceResponse(
+                output_tensors=self._stats_tensors(stats, requested)
+            )
+        response_sender.send(final, flags=final_flag)
+
+    def _make_sequence(
+        self,
+        prompt: List[dict],
+        input_ids: List[int],
+        params: GenerationParams,
+        response_sender=None,
+        requested=(),
+        cache_key=None,
+        reserved: int = 0,
+        check: StopCheck = None,
+    ) -> Sequence:
+        """
+        Wrap a tokenized prompt in an engine sequence, which hands its
+        `reserved` tokens back to the admission budget when it finishes.
+        With a response sender the sequence answers its request itself,
+        token by token when streaming, and stores its result in the
+        response cache under `cache_key`. The engine drops the sequence
+        once `check` says it was cancelled or has expired.
+        """
+        seq = Sequence(
+            input_ids=input_ids,
+            params=params.for_prompt(len(input_ids), self.max_length),
+            prefix_length=self._prefix_length(prompt, input_ids),
+            stop_check=check,
+        )
+        if response_sender is None:
+            seq.on_finish = lambda seq: self.admission.release(reserved)
+            return seq
 
-            tensor = pb_utils.Tensor("generated_text", np.array(text, dtype=np.object_))
-            output_tensors.append(tensor)
+        emitted = {"chars": 0}
 
-        return output_tensors
+        def send_new_text(seq):
+            text = self._decode(seq)
+            # Hold back incomplete multi-byte characters until the next token
+            if text.endswith("\ufffd") and not seq.finished:
+                return
+            if len(text) > emitted["chars"]:
+                response_sender.send(self._response(text[emitted["chars"] :]))
+                emitted["chars"] = len(text)
+
+        def on_finish(seq):
+            self.admission.release(reserved)
+            final = pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+            if seq.error is not None:
+                error = pb_utils.TritonError(f"Generation failed: {seq.error}")
+                response_sender.send(
+                    pb_utils.InferenceResponse(output_tensors=[], error=error),
+                    flags=final,
+                )
+            elif seq.finish_reason in STOP_REASONS:
+                response_sender.send(
+                    self._stopped_response(seq.finish_reason, len(seq.generated)),
+                    flags=final,
+                )
+            elif self.streaming:
+                send_new_text(seq)
+                stats_tensors = self._stats_tensors(seq.stats, requested)
+                response_sender.send(
+                    pb_utils.InferenceResponse(output_tensors=stats_tensors),
+                    flags=final,
+                )
+            else:
+                response_sender.send(
+                    self._response(self._decode(seq), seq.stats, requested),
+                    flags=final,
+                )
+            if seq.error is None and seq.generated:
+                self._record_stats([seq.stats])
+            if seq.error is None and seq.finish_reason not in STOP_REASONS:
+                response = self._response(self._decode(seq), seq.stats, STATS_OUTPUTS)
+                self._cache_put(cache_key, response)
+
+        if self.streaming:
+            seq.on_token = lambda seq, token: send_new_text(seq)
+        seq.on_finish = on_finish
+        return seq
+
+    def _tokenize_system_prefix(self, system_message: str) -> tuple:
+        return tuple(
+            self.tokenizer.apply_chat_template(
+                [{"role": "system", "content": system_message}],
+                add_generation_prompt=False,
+            )
+        )
+
+    def _prefix_length(self, prompt: List[dict], input_ids: List[int]) -> int:
+        """
+        Number of leading prompt tokens covered by the templated system
+        message, which is what the prefix cache is keyed on.
+        """
+        if self.prefix_cache is None or prompt[0]["role"] != "system":
+            return 0
+        prefix_ids = self._prefix_ids(prompt[0]["content"])
+        if tuple(input_ids[: len(prefix_ids)]) != prefix_ids:
+            return 0
+        return len(prefix_ids)
+
+    def _decode(self, seq: Sequence) -> str:
+        return self.tokenizer.decode(seq.generated, skip_special_tokens=True)
+
+    def _stats_tensors(self, stats: GenerationStats, requested=()) -> List:
+        values = {
+            "prompt_tokens": np.array([stats.prompt_tokens], dtype=np.int32),
+            "completion_tokens": np.array([stats.completion_tokens], dtype=np.int32),
+            "tokens_per_second": np.array([stats.tokens_per_second], dtype=np.float32),
+        }
+        return [
+            pb_utils.Tensor(name, values[name])
+            for name in STATS_OUTPUTS
+            if name in requested
+        ]
+
+    def _response(self, text: str, stats: GenerationStats = None, requested=()):
+        tensors = [pb_utils.Tensor("generated_text", np.array(text, dtype=np.object_))]
+        if stats is not None:
+            tensors += self._stats_tensors(stats, requested)
+        return pb_utils.InferenceResponse(output_tensors=tensors)
+
+    def _record_stats(self, stats: List[GenerationStats]):
+        """
+        Record each completion in the metrics and, with log_requests on,
+        emit one structured log record per batch.
+        """
+        for completion in stats:
+            self.metrics.observe_completion(
+                completion.completion_tokens,
+                completion.seconds,
+                completion.prefill_seconds,
+            )
+        self.metrics.flush()
+        if not self.log_requests:
+            return
+        record = {
+            "model": "llama3_8b",
+            "completions": len(stats),
+            "prompt_tokens": sum(s.prompt_tokens for s in stats),
+            "completion_tokens": sum(s.completion_tokens for s in stats),
+            "tokens_per_second": [round(s.tokens_per_second, 2) for s in stats],
+        }
+        pb_utils.Logger.log_info(json.dumps(record))
+
+    def _cache_key(self, request, row: int, params: GenerationParams):
+        arrays = [
+            pb_utils.get_input_tensor_by_name(request, name).as_numpy()[row : row + 1]
+            for name in ("system_message", "user_message")
+        ]
+        return self.response_cache.key(
+            arrays, {**self.cache_params, **params.as_dict()}
+        )
+
+    def _cache_put(self, key, response):
+        if key is None or response.has_error():
+            return
+        self.response_cache.put(
+            key, {t.name(): t.as_numpy() for t in response.output_tensors()}
+        )
+
+    def _cached_responses(
+        self, requests: List, rows: List[int], params: List[GenerationParams]
+    ) -> tuple:
+        """
+        Look every deterministic request row up in the response cache.
+        :param requests: the request of each row
+        :param rows: each row's index within its request
+        :return: cache keys (None when caching doesn't apply) and the
+            cached responses by row index
+        """
+        keys = [None] * len(requests)
+        cached = {}
+        if self.response_cache is None:
+            return keys, cached
+        for i, (request, row, request_params) in enumerate(zip(requests, rows, params)):
+            if not request_params.deterministic:
+                continue
+            keys[i] = self._cache_key(request, row, request_params)
+            outputs = self.response_cache.get(keys[i])
+            if outputs is not None:
+                requested = request.requested_output_names()
+                tensors = [
+                    pb_utils.Tensor(name, value)
+                    for name, value in outputs.items()
+                    if name == "generated_text" or name in requested
+                ]
+                cached[i] = pb_utils.InferenceResponse(output_tensors=tensors)
+        if self.log_requests:
+            pb_utils.Logger.log_info(
+                f"(Llama) Response cache: {self.response_cache.stats()}"
+            )
+        return keys, cached
+
+    def execute_continuous(
+        self,
+        requests: List,
+        prompts: List[List[dict]],
+        input_ids: List[List[int]],
+        params: List[GenerationParams],
+        keys: List,
+        reserved: List[int],
+        checks: List[Optional[StopCheck]],
+    ):
+        """
+        Hand every request to the continuous batching engine. Decoupled
+        models return straight away and the engine answers each request as
+        it finishes, so new requests can join while others are decoding.
+        """
+        if self.decoupled:
+            for request, prompt, ids, request_params, key, tokens, check in zip(
+                requests, prompts, input_ids, params, keys, reserved, checks
+            ):
+                seq = self._make_sequence(
+                    prompt,
+                    ids,
+                    request_params,
+                    request.get_response_sender(),
+                    request.requested_output_names(),
+                    cache_key=key,
+                    reserved=tokens,
+                    check=check,
+                )
+                self.engine.submit(seq)
+            return None
+
+        seqs = [
+            self.engine.submit(
+                self._make_sequence(
+                    prompt, ids, request_params, reserved=tokens, check=check
+                )
+            )
+            for prompt, ids, request_params, tokens, check in zip(
+                prompts, input_ids, params, reserved, checks
+            )
+        ]
+        responses = []
+        for request, seq in zip(requests, seqs):
+            seq.done.wait()
+            if seq.error is not None:
+                error = pb_utils.TritonError(f"Generation failed: {seq.error}")
+                responses.append(
+                    pb_utils.InferenceResponse(output_tensors=[], error=error)
+                )
+            elif seq.finish_reason in STOP_REASONS:
+                responses.append(
+                    self._stopped_response(seq.finish_reason, len(seq.generated))
+                )
+            else:
+                responses.append(
+                    self._response(
+                        self._decode(seq), seq.stats, request.requested_output_names()
+                    )
+                )
+        self._record_stats(
+            [seq.stats for seq in seqs if seq.error is None and seq.generated]
+        )
+        for key, seq in zip(keys, seqs):
+            if seq.error is None and seq.finish_reason not in STOP_REASONS:
+                response = self._response(self._decode(seq), seq.stats, STATS_OUTPUTS)
+                self._cache_put(key, response)
+        return responses
 
     def _read_tensor(self, request, tensor_name):
+        """
+        Decode a string input, one message per row of the request.
+        """
         msgs = pb_utils.get_input_tensor_by_name(request, tensor_name).as_numpy()
-        msgs = msgs[0][0].decode("utf-8")
-        return msgs
-
-    def _make_prompt(self, request):
-        sys_msg = self._read_tensor(request, "system_message")
-        user_msg = self._read_tensor(request, "user_message")
-        prompt_dict = [
-            {"role": "system", "content": sys_msg},
-            {"role": "user", "content": user_msg},
+        return [row[0].decode("utf-8") for row in msgs]
+
+    def _make_prompts(self, request):
+        sys_msgs = self._read_tensor(request, "system_message")
+        user_msgs = self._read_tensor(request, "user_message")
+        return [
+            [
+                {"role": "system", "content": sys_msg},
+                {"role": "user", "content": user_msg},
+            ]
+            for sys_msg, user_msg in zip(sys_msgs, user_msgs)
         ]
-        return prompt_dict
+
+    def _read_scalars(self, request, name):
+        """
+        One value per row of an optional input, or None when it's absent.
+        """
+        tensor = pb_utils.get_input_tensor_by_name(request, name)
+        if tensor is None:
+            return None
+        return [row.flatten()[0].item() for row in tensor.as_numpy()]
+
+    def _read_params(self, request, num_rows: int) -> List[GenerationParams]:
+        """
+        Apply the request's optional generation inputs to the model defaults,
+        row by row. `greedy` (or a temperature of 0) switches to
+        deterministic decoding, which ignores the sampling settings.
+        """
+        overrides = [{} for _ in range(num_rows)]
+        for name in PARAM_INPUTS:
+            values = self._read_scalars(request, name)
+            if values is not None:
+                for row_overrides, value in zip(overrides, values):
+                    row_overrides[name] = value
+        return [self._apply_overrides(row_overrides) for row_overrides in overrides]
+
+    def _apply_overrides(self, overrides: dict) -> GenerationParams:
+        greedy = overrides.pop("greedy", False)
+        if "max_new_tokens" in overrides:
+            overrides["max_new_tokens"] = max(1, overrides["max_new_tokens"])
+        params = replace(self.default_params, **overrides)
+        if greedy or (params.temperature is not None and params.temperature <= 0):
+            # Normalised so every greedy request groups and caches together
+            return GenerationParams(
+                max_new_tokens=params.max_new_tokens, do_sample=False
+            )
+        return params
+
+    def _admit(self, indices: List[int], input_ids: dict, params: List[GenerationParams]):
+        """
+        Reserve the KV cache footprint of each row in the token budget.
+        :return: error responses for the rows turned away and the tokens
+            reserved for the others, both by row index
+        """
+        rejected, reserved = {}, {}
+        for i in indices:
+            row_params = params[i].for_prompt(len(input_ids[i]), self.max_length)
+            tokens = self.admission.footprint(len(input_ids[i]), row_params.max_new_tokens)
+            try:
+                reserved[i] = self.admission.admit(tokens)
+            except AdmissionRejected as e:
+                rejected[i] = self._rejection_response(e)
+        return rejected, reserved
+
+    def _rejection_response(self, rejection: AdmissionRejected):
+        """
+        Busy rejections are UNAVAILABLE (HTTP 503), which clients retry;
+        requests that can never fit are INVALID_ARG.
+        """
+        message = str(rejection)
+        if rejection.retryable:
+            message += f", retry after {rejection.retry_after:.1f}s"
+        return self._error_response(
+            message, "UNAVAILABLE" if rejection.retryable else "INVALID_ARG"
+        )
+
+    def _error_response(self, message: str, code_name: str):
+        """
+        An error response with the named TritonError code, on Triton
+        releases that have error codes.
+        """
+        code = getattr(pb_utils.TritonError, code_name, None)
+        error = (
+            pb_utils.TritonError(message)
+            if code is None
+            else pb_utils.TritonError(message, code)
+        )
+        return pb_utils.InferenceResponse(output_tensors=[], error=error)
+
+    def _stop_check(self, request, received: float) -> Optional[StopCheck]:
+        """
+        The request's StopCheck, None when there is nothing to check. The
+        deadline counts from when execute() received the request; time it
+        spent in Triton's queue before that isn't known here.
+        """
+        timeout_s = self.request_timeout_s
+        # The request's timeout parameter, in microseconds, 0 when unset
+        request_timeout = getattr(request, "timeout", None)
+        if request_timeout is not None and request_timeout() > 0:
+            timeout_s = request_timeout() / 1e6
+        is_cancelled = None
+        if self.check_cancellation:
+            is_cancelled = getattr(request, "is_cancelled", None)
+        if is_cancelled is None and timeout_s <= 0:
+            return None
+        deadline = received + timeout_s if timeout_s > 0 else None
+        return StopCheck(is_cancelled, deadline)
+
+    def _stopped_response(self, reason: str, completion_tokens: int):
+        """
+        Cancelled rows get CANCELLED, which nobody is left to read; expired
+        ones UNAVAILABLE (HTTP 503), like requests that time out in Triton's
+        own queue.
+        """
+        self.metrics.record_stopped(reason)
+        if reason == CANCELLED:
+            message = f"Request cancelled after {completion_tokens} generated tokens"
+            return self._error_response(message, "CANCELLED")
+        message = f"Request deadline expired after {completion_tokens} generated tokens"
+        return self._error_response(message, "UNAVAILABLE")
+
+    def _record_admission(self):
+        queue_depth = self.engine.queue_depth if self.engine is not None else 0
+        stats = self.admission.stats()
+        self.metrics.record_admission(queue_depth, stats)
+        if self.log_requests:
+            pb_utils.Logger.log_info(
+                f"(Llama) Queue depth: {queue_depth}, admission: {json.dumps(stats)}"
+            )
+
+    def _record_caches(self):
+        if self.prefix_cache is not None:
+            self.metrics.record_cache("prefix", self.prefix_cache.stats())
+        if self.response_cache is not None:
+            self.metrics.record_cache("response", self.response_cache.stats())
+        if self.speculative is not None:
+            self.metrics.record_speculative(self.speculative.stats())
+
+    def _record_memory(self):
+        gpu_bytes = None
+        if self.model.device.type == "cuda":
+            gpu_bytes = torch.cuda.max_memory_allocated(self.model.device)
+        self.metrics.record_memory(gpu_bytes)
+        self.metrics.flush()
+
+    def _merge_responses(self, responses: List):
+        """
+        Combine the responses to the rows of one request, stacking each
+        output along the batch dimension.
+        """
+        if len(responses) == 1:
+            return responses[0]
+        for response in responses:
+            if response.has_error():
+                return response
+        outputs = [
+            {t.name(): t.as_numpy() for t in response.output_tensors()}
+            for response in responses
+        ]
+        tensors = [
+            pb_utils.Tensor(
+                name, np.stack([output[name].reshape(-1) for output in outputs])
+            )
+            for name in outputs[0]
+        ]
+        return pb_utils.InferenceResponse(output_tensors=tensors)
 
     def execute(self, requests: List):
+        received = time.monotonic()
         logger = pb_utils.Logger
-        logger.log_info("Llama Received request")
-        logger.log_info(f"(Llama) Num prompts in batch: {len(requests)}")
-        prompts = [self._make_prompt(request) for request in requests]
-        tensor_results = self.generate(prompts)
-        responses = [
-            pb_utils.InferenceResponse(output_tensors=[tensor])
-            for tensor in tensor_results
-        ]
+        if self.log_requests:
+            logger.log_info("Llama Received request")
+            logger.log_info(f"(Llama) Num prompts in batch: {len(requests)}")
+            if self.prefix_cache is not None:
+                logger.log_info(f"(Llama) Prefix cache: {self.prefix_cache.stats()}")
+            if self.speculative is not None:
+                logger.log_info(
+                    f"(Llama) Speculative decoding: {self.speculative.stats()}"
+                )
+
+        # Requests may hold several prompts, one per row; every row is
+        # scheduled on its own and the answers are merged per request.
+        row_requests, rows, owners, prompts, params = [], [], [], [], []
+        for i, request in enumerate(requests):
+            request_prompts = self._make_prompts(request)
+            if self.decoupled and len(request_prompts) > 1:
+                error = pb_utils.TritonError(
+                    "Decoupled mode answers one prompt per request, "
+                    f"got {len(request_prompts)}"
+                )
+                request.get_response_sender().send(
+                    pb_utils.InferenceResponse(output_tensors=[], error=error),
+                    flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL,
+                )
+                continue
+            params += self._read_params(request, len(request_prompts))
+            for row, prompt in enumerate(request_prompts):
+                row_requests.append(request)
+                rows.append(row)
+                owners.append(i)
+                prompts.append(prompt)
+
+        self.metrics.observe_batch(len(row_requests))
+        keys, cached = self._cached_responses(row_requests, rows, params)
+        pending = [i for i in range(len(row_requests)) if i not in cached]
+        # The rows of a request share its StopCheck
+        request_checks = {}
+        for i in pending:
+            if owners[i] not in request_checks:
+                request_checks[owners[i]] = self._stop_check(row_requests[i], received)
+        checks = {i: request_checks[owners[i]] for i in pending}
+        stopped = {
+            i: self._stopped_response(checks[i].reason, 0)
+            for i in pending
+            if checks[i] is not None and checks[i]() is not None
+        }
+        pending = [i for i in pending if i not in stopped]
+        with self.metrics.time("tokenize"):
+            input_ids = {i: self._tokenize(prompts[i]) for i in pending}
+        rejected, reserved = self._admit(pending, input_ids, params)
+        # Cache hits, rows already stopped and rejections are answered
+        # without running anything
+        answered = {**cached, **stopped, **rejected}
+        if self.decoupled:
+            for i, response in answered.items():
+                row_requests[i].get_response_sender().send(
+                    response, flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+                )
+        pending = [i for i in pending if i not in rejected]
+        results = []
+        try:
+            if pending:
+                results = self._execute(
+                    [row_requests[i] for i in pending],
+                    [prompts[i] for i in pending],
+                    [input_ids[i] for i in pending],
+                    [params[i] for i in pending],
+                    [keys[i] for i in pending],
+                    [reserved[i] for i in pending],
+                    [checks[i] for i in pending],
+                )
+        finally:
+            if self.engine is None:
+                # The continuous engine's sequences release their own
+                for i in pending:
+                    self.admission.release(reserved[i])
+        self._record_admission()
+        self._record_caches()
+        self._record_memory()
+        if self.decoupled:
+            return None
+
+        row_responses = [answered.get(i) for i in range(len(row_requests))]
+        for i, response in zip(pending, results):
+            row_responses[i] = response
+        by_request = [[] for _ in requests]
+        for owner, response in zip(owners, row_responses):
+            by_request[owner].append(response)
+        return [self._merge_responses(responses) for responses in by_request]
+
+    def _execute(
+        self,
+        requests: List,
+        prompts: List[List[dict]],
+        input_ids: List[List[int]],
+        params: List[GenerationParams],
+        keys: List,
+        reserved: List[int],
+        checks: List[Optional[StopCheck]],
+    ):
+        if self.engine is not None:
+            return self.execute_continuous(
+                requests, prompts, input_ids, params, keys, reserved, checks
+            )
+
+        if self.streaming:
+            for request, ids, request_params, check in zip(
+                requests, input_ids, params, checks
+            ):
+                self.stream(
+                    ids,
+                    request_params,
+                    request.get_response_sender(),
+                    request.requested_output_names(),
+                    check,
+                )
+            return None
+
+        texts, stats = self.generate(input_ids, params, checks)
+        # Buckets skipped because every row had stopped produced nothing
+        self._record_stats([text_stats for text_stats in stats if text_stats.seconds > 0])
+        responses = []
+        for request, text, text_stats, key, check in zip(
+            requests, texts, stats, keys, checks
+        ):
+            if check is not None and check.reason is not None:
+                responses.append(
+                    self._stopped_response(check.reason, text_stats.completion_tokens)
+                )
+                continue
+            responses.append(
+                self._response(text, text_stats, request.requested_output_names())
+            )
+            self._cache_put(key, self._response(text, text_stats, STATS_OUTPUTS))
+
+        if self.decoupled:
+            # One-shot generation on a decoupled model: a single response per
+            # request, sent together with the FINAL flag.
+            for request, response in zip(requests, responses):
+                request.get_response_sender().send(
+                    response, flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+                )
+            return None
 
         return responses
 
     def finalize(self):
         print("Cleaning up...")
+        if self.engine is not None:
+            self.engine.stop()
+        self.metrics.flush(force=True)
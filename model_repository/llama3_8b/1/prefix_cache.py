@@ -0,0 +1,85 @@
+# coding=utf-8
+
+"""
+LRU cache of past key/values for tokenized prompt prefixes.
+
+Requests from the same product share a long system message, so the
+engine can prefill it once and start later requests from the cached
+state, only running the prefill over the rest of their prompt.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+from engine import PastKeyValues
+
+
+def past_key_values_bytes(past: PastKeyValues) -> int:
+    """
+    Memory held by a legacy-format KV cache.
+    """
+    return sum(
+        tensor.numel() * tensor.element_size() for layer in past for tensor in layer
+    )
+
+
+class PrefixCache:
+    """
+    Maps token-id prefixes to their KV cache, evicting the least recently
+    used entries once the memory budget is exceeded.
+    :param max_bytes: memory budget for all cached key/values
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[int, ...], PastKeyValues]" = OrderedDict()
+        self._sizes: Dict[Tuple[int, ...], int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, prefix_ids: Sequence[int]) -> Optional[PastKeyValues]:
+        key = tuple(prefix_ids)
+        with self._lock:
+            past = self._entries.get(key)
+            if past is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return past
+
+    def put(self, prefix_ids: Sequence[int], past: PastKeyValues):
+        key = tuple(prefix_ids)
+        size = past_key_values_bytes(past)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            while self._entries and self.bytes + size > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self.bytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+            self._entries[key] = past
+            self._sizes[key] = size
+            self.bytes += size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
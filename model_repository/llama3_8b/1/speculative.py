@@ -0,0 +1,195 @@
+# coding=utf-8
+
+"""
+Greedy speculative decoding with a small draft model.
+
+Decoding the 8B model is memory-bandwidth bound: each forward pass reads
+every weight to produce a single token. A small draft model that shares
+the tokenizer proposes a few tokens at a time, and the target model
+scores all of them in one forward pass. Proposals are kept up to the
+first one the target disagrees with, where the target's own token is
+used instead, so the output is exactly what greedy decoding of the
+target alone would produce.
+
+Like engine.py, this module has no Triton dependency so it can be
+checked on CPU with two tiny randomly-initialised models.
+"""
+
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+import torch
+
+from engine import PastKeyValues, to_legacy_cache
+
+
+def crop_past(past: PastKeyValues, length: int) -> PastKeyValues:
+    """
+    Keep the first `length` positions of a legacy KV cache.
+    """
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past)
+
+
+@dataclass
+class SpeculativeStats:
+    """
+    Draft acceptance for one or more generations.
+    :param drafted_tokens: tokens proposed by the draft model
+    :param accepted_tokens: proposals the target model agreed with
+    :param generated_tokens: tokens produced
+    :param target_forwards: forward passes of the target model
+    """
+
+    drafted_tokens: int = 0
+    accepted_tokens: int = 0
+    generated_tokens: int = 0
+    target_forwards: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        if not self.drafted_tokens:
+            return 0.0
+        return self.accepted_tokens / self.drafted_tokens
+
+    @property
+    def target_forwards_saved(self) -> int:
+        """
+        Forward passes saved against plain decoding, which needs one per
+        generated token.
+        """
+        return self.generated_tokens - self.target_forwards
+
+    def add(self, other: "SpeculativeStats"):
+        self.drafted_tokens += other.drafted_tokens
+        self.accepted_tokens += other.accepted_tokens
+        self.generated_tokens += other.generated_tokens
+        self.target_forwards += other.target_forwards
+
+    def as_dict(self) -> dict:
+        return {
+            "drafted_tokens": self.drafted_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.acceptance_rate,
+            "generated_tokens": self.generated_tokens,
+            "target_forwards": self.target_forwards,
+            "target_forwards_saved": self.target_forwards_saved,
+        }
+
+
+class SpeculativeDecoder:
+    """
+    Greedy generation of one sequence at a time, drafted by `draft_model`
+    and verified by `model`.
+    :param model: target HF causal LM
+    :param draft_model: smaller causal LM with the same vocabulary
+    :param eos_token_id: id (or ids) that end a sequence
+    :param num_draft_tokens: tokens proposed per target forward pass
+    """
+
+    def __init__(
+        self,
+        model,
+        draft_model,
+        eos_token_id: Union[int, Iterable[int]],
+        num_draft_tokens: int = 4,
+    ):
+        self.model = model
+        self.draft_model = draft_model
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+        self.num_draft_tokens = num_draft_tokens
+        self.totals = SpeculativeStats()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _forward(
+        model, input_ids: List[int], past: Optional[PastKeyValues]
+    ) -> Tuple[torch.Tensor, PastKeyValues]:
+        device = next(model.parameters()).device
+        out = model(
+            input_ids=torch.tensor([input_ids], device=device),
+            past_key_values=past,
+            use_cache=True,
+        )
+        return out.logits[0], to_legacy_cache(out.past_key_values)
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        on_token: Optional[Callable[[int], None]] = None,
+        should_stop: Optional[Callable[[], object]] = None,
+    ) -> Tuple[List[int], SpeculativeStats]:
+        """
+        Greedily generate a completion for one tokenized prompt.
+        :param input_ids: tokenized prompt
+        :param max_new_tokens: maximum number of tokens to generate
+        :param on_token: called with each token as soon as it is accepted
+        :param should_stop: polled before every draft-and-verify round;
+            generation ends early once it returns something truthy
+        :return: generated token ids (including a final EOS) and the
+            draft acceptance for this generation
+        """
+        stats = SpeculativeStats()
+        tokens = list(input_ids)
+        generated: List[int] = []
+        # Both caches cover a prefix of `tokens`, never its last token
+        target_past, target_length = None, 0
+        draft_past, draft_length = None, 0
+
+        finished = False
+        while not finished:
+            if should_stop is not None and should_stop():
+                break
+            # Leave room for the token the target adds after the proposals
+            num_draft = min(self.num_draft_tokens, max_new_tokens - len(generated) - 1)
+            proposal: List[int] = []
+            feed = tokens[draft_length:]
+            for _ in range(num_draft):
+                logits, draft_past = self._forward(self.draft_model, feed, draft_past)
+                draft_length += len(feed)
+                token = int(torch.argmax(logits[-1]))
+                proposal.append(token)
+                if token in self.eos_token_ids:
+                    break
+                feed = [token]
+
+            # One target pass scores the pending tokens and every proposal
+            feed = tokens[target_length:] + proposal
+            logits, target_past = self._forward(self.model, feed, target_past)
+            stats.target_forwards += 1
+            first = len(feed) - len(proposal) - 1
+            predicted = torch.argmax(logits[first:], dim=-1).tolist()
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == predicted[accepted]:
+                accepted += 1
+            stats.drafted_tokens += len(proposal)
+            stats.accepted_tokens += accepted
+
+            for token in proposal[:accepted] + [predicted[accepted]]:
+                tokens.append(token)
+                generated.append(token)
+                if on_token is not None:
+                    on_token(token)
+                if token in self.eos_token_ids or len(generated) >= max_new_tokens:
+                    finished = True
+                    break
+
+            # Drop cache entries for rejected proposals
+            target_length = len(tokens) - 1
+            target_past = crop_past(target_past, target_length)
+            if draft_past is not None:
+                draft_length = min(draft_length, len(tokens) - 1)
+                draft_past = crop_past(draft_past, draft_length)
+
+        stats.generated_tokens = len(generated)
+        with self._lock:
+            self.totals.add(stats)
+        return generated, stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            return self.totals.as_dict()
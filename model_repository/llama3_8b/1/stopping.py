@@ -0,0 +1,95 @@
+# coding=utf-8
+
+"""
+Stopping generation for requests nobody is waiting for.
+
+A request whose client has disconnected or timed out keeps generating
+up to max_new_tokens unless something checks. A StopCheck is polled
+between decode steps, by the HF `generate` stopping criterion, the
+continuous batching engine and the speculative decoder alike, and
+reports when its request was cancelled or is past its deadline, so the
+row stops within a step and its slot goes to the rest of the batch.
+
+Like engine.py, this module has no Triton dependency so it can be
+checked on CPU with a tiny model.
+"""
+
+import time
+from typing import Callable, Optional, Sequence
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+STOP_REASONS = (CANCELLED, EXPIRED)
+
+
+class StopCheck:
+    """
+    Whether a request should stop generating. Once it has said so it
+    keeps saying so, and `reason` tells why.
+    :param is_cancelled: returns True once the client has gone away
+    :param deadline: `clock()` time after which the request has expired,
+        None for no deadline
+    :param clock: monotonic time source, replaceable in tests
+    """
+
+    def __init__(
+        self,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+        deadline: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.is_cancelled = is_cancelled
+        self.deadline = deadline
+        self.clock = clock
+        self.reason: Optional[str] = None
+        # Times polled, i.e. decode steps seen
+        self.checks = 0
+
+    def __call__(self) -> Optional[str]:
+        """
+        :return: CANCELLED, EXPIRED, or None to carry on
+        """
+        if self.reason is None:
+            self.checks += 1
+            if self.is_cancelled is not None and self.is_cancelled():
+                self.reason = CANCELLED
+            elif self.deadline is not None and self.clock() >= self.deadline:
+                self.reason = EXPIRED
+        return self.reason
+
+
+class StopCriteria(StoppingCriteria):
+    """
+    Stopping criterion for HF `generate`, with one StopCheck (or None)
+    per row of the batch. A stopped row is padded from then on, and
+    generation ends once every row has finished or stopped.
+    :param eos_token_id: rows that generated it have finished and aren't
+        checked again, so they can't expire while the others decode
+    """
+
+    def __init__(self, checks: Sequence[Optional[StopCheck]], eos_token_id: int):
+        self.checks = list(checks)
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        finished = (input_ids[:, -1] == self.eos_token_id).tolist()
+        for row, done in enumerate(finished):
+            if done:
+                self.checks[row] = None
+        stop = [check is not None and check() is not None for check in self.checks]
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+def stop_criteria(
+    checks: Sequence[Optional[StopCheck]], eos_token_id: int
+) -> StoppingCriteriaList:
+    """
+    The `stopping_criteria` argument for `generate`, empty when no row
+    has anything to check.
+    """
+    if all(check is None for check in checks):
+        return StoppingCriteriaList()
+    return StoppingCriteriaList([StopCriteria(checks, eos_token_id)])
@@ -5,77 +5,323 @@ Triton Backend for inference with HF TrOCR model.
 """
 
 import os
-import base64
-import torch
-import io
-from PIL import Image
+import json
+import time
 import numpy as np
+import torch
 import triton_python_backend_utils as pb_utils
 
-import torchvision.transforms as transforms
-from torchvision.transforms import Resize, PILToTensor
-
 os.environ["HF_HOME"] = "/opt/tritonserver/.hf-cache"
-from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+from transformers import (
+    AutoConfig,
+    TrOCRProcessor,
+    VisionEncoderDecoderModel,
+)
 import huggingface_hub
 
-huggingface_hub.login(token=os.environ.get("HF_TOKEN"))  ## Add your HF credentials
 cache_dir = os.environ["HF_HOME"]
 
+from backend_common.metrics import metrics_from_parameters
+from backend_common.response_cache import response_cache_from_parameters
+from backend_common.startup import (
+    SNAPSHOT_DIR,
+    StartupTimer,
+    load_snapshot,
+    snapshot_fingerprint,
+    snapshot_info,
+)
+from pipeline import ChunkPipeline, HostBuffers, split_rows
+from preprocessing import BASE64, PIXELS, RAW, BatchPreprocessor
+from shared_weights import load_shared_model
+
+# Image inputs in order of preference, with how each is encoded
+IMAGE_INPUTS = (("pixels", PIXELS), ("image_bytes", RAW), ("image", BASE64))
+
 
 class TritonPythonModel:
     def initialize(self, args):
         cur_path = os.path.abspath(__file__)
+        timer = StartupTimer("trocr")
+        self.model_config = json.loads(args["model_config"])
+        self.model_params = self.model_config.get("parameters", {})
+        logger = pb_utils.Logger
         hf_model = "microsoft/trocr-small-printed"
-        self.processor = TrOCRProcessor.from_pretrained(hf_model, cache_dir=cache_dir)
-        self.model = VisionEncoderDecoderModel.from_pretrained(
-            hf_model, cache_dir=cache_dir
-        ).cuda()
-        self.transforms = transforms.Compose(
-            [
-                transforms.RandomInvert(p=1),
-                transforms.Grayscale(num_output_channels=3),
-                Resize((50, 50)),
-                PILToTensor(),
-            ]
+        # A snapshot from backend_common/prepare_snapshot.py is loaded
+        # locally; without one, log in and load from the hub.
+        self.snapshot_path = os.path.join(os.path.dirname(cur_path), SNAPSHOT_DIR)
+        if snapshot_info(self.snapshot_path) is None:
+            self.snapshot_path = None
+            with timer.phase("login"):
+                huggingface_hub.login(token=os.environ.get("HF_TOKEN"))
+        with timer.phase("processor"):
+            self.processor = TrOCRProcessor.from_pretrained(
+                self.snapshot_path or hf_model, cache_dir=cache_dir
+            )
+
+        # The instance_group kind decides where this instance runs
+        if args.get("model_instance_kind", "GPU") == "GPU":
+            self.device = torch.device(f"cuda:{args['model_instance_device_id']}")
+        else:
+            self.device = torch.device("cpu")
+            cpu_threads = int(self._param("cpu_threads", "0"))
+            if cpu_threads > 0:
+                torch.set_num_threads(cpu_threads)
+        logger.log_info(f"TROCR: running on {self.device}")
+
+        with timer.phase("model"):
+            self.model = self._load_model(hf_model)
+        quantize_decoder = self._param("quantize_decoder", "false") == "true"
+        if self.device.type == "cpu" and quantize_decoder:
+            # Generation time is dominated by the autoregressive decoder
+            self.model.decoder = torch.ao.quantization.quantize_dynamic(
+                self.model.decoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            logger.log_info("TROCR: decoder quantized to int8")
+        self.model.to(self.device).eval()
+
+        # Decode, invert, grayscale and resize the whole batch in one pass,
+        # producing the processor's pixel values directly.
+        num_workers = int(self._param("preprocess_workers", "4"))
+        self.preprocessor = BatchPreprocessor.from_image_processor(
+            self.processor.image_processor, num_workers=num_workers
+        )
+
+        # Batches run in chunks of up to pipeline_batch_size rows, so that
+        # one chunk is preprocessed while the model runs the previous one.
+        # Chunks are written into reusable host buffers, pinned on GPU for
+        # asynchronous copies on the instance's own stream.
+        self.pipeline_rows = int(self._param("pipeline_batch_size", "0"))
+        if self.pipeline_rows > 0 and self.device.type == "cpu":
+            # The model and preprocessing share the same cores, so there is
+            # nothing to overlap and every extra chunk costs a generate call
+            logger.log_warn(
+                "TROCR: pipeline_batch_size only helps on GPU instances, "
+                "it makes CPU instances slower"
+            )
+        self.pipeline = ChunkPipeline(depth=int(self._param("pipeline_depth", "1")))
+        self.buffers = HostBuffers(
+            self.pipeline.slots,
+            (self.preprocessor.mean.shape[1], *self.preprocessor.image_size),
+            pin=self.device.type == "cuda",
         )
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
 
-    def generate(self, images):
+        # Byte-identical crops are answered from the cache before batching
+        self.response_cache = response_cache_from_parameters(self.model_params)
+        self.cache_params = {"model": hf_model, "quantize_decoder": quantize_decoder}
+
+        # Batch sizes and phase timings go to the server's metrics endpoint;
+        # the per-batch log lines are opt-in.
+        self.metrics = metrics_from_parameters(pb_utils, args, self.model_params)
+        self.log_requests = self._param("log_requests", "false") == "true"
+        logger.log_info(json.dumps(timer.as_dict()))
+
+    def _param(self, key, default):
+        return self.model_params.get(key, {}).get("string_value", default)
+
+    def _load_model(self, hf_model):
         """
-        Generate batch responses from input images.
-        :param images: BCWH pt Tensor
+        Load the model, from the snapshot when there is one. CPU instances
+        share one memory-mapped copy of the weights when 'share_weights' is
+        set, instead of one copy each.
         """
-        inputs = self.processor(images=images, return_tensors="pt").pixel_values
-        ids = self.model.generate(inputs.cuda())
-        results = self.processor.batch_decode(ids, skip_special_tokens=True)
-        tensors = [
-            pb_utils.Tensor("generated_text", np.array(result, dtype=np.object_))
-            for result in results
-        ]
-        responses = [
-            pb_utils.InferenceResponse(output_tensors=[tensor]) for tensor in tensors
-        ]
-        return responses
+        config = AutoConfig.from_pretrained(
+            self.snapshot_path or hf_model, cache_dir=cache_dir
+        )
+
+        def load():
+            if self.snapshot_path is not None:
+                return load_snapshot(
+                    self.snapshot_path,
+                    VisionEncoderDecoderModel,
+                    config,
+                    num_workers=int(self._param("snapshot_workers", "4")),
+                )
+            return VisionEncoderDecoderModel.from_pretrained(hf_model, cache_dir=cache_dir)
+
+        share_weights = self._param("share_weights", "true") == "true"
+        if self.device.type != "cpu" or not share_weights:
+            return load()
+        # A file left by an earlier server from other weights is made again
+        fingerprint = snapshot_fingerprint(self.snapshot_path) if self.snapshot_path else None
+        return load_shared_model(
+            self._param("shared_weights_path", "/dev/shm/trocr-small-printed.pt"),
+            build_model=lambda: VisionEncoderDecoderModel(config),
+            load_model=load,
+            source=json.dumps({"model": hf_model, "snapshot": fingerprint}),
+        )
+
+    @torch.inference_mode()
+    def generate(self, pixel_values):
+        """
+        Generate token ids for a chunk of input images.
+        :param pixel_values: BCHW pt Tensor, already normalised
+        :return: [batch, length] ids on the CPU
+        """
+        start = time.perf_counter()
+        if self.stream is None:
+            ids = self.model.generate(pixel_values.to(self.device))
+        else:
+            with torch.cuda.stream(self.stream):
+                ids = self.model.generate(pixel_values.to(self.device, non_blocking=True))
+                # Waits for the stream, after which the host buffer is free
+                ids = ids.cpu()
+        seconds = time.perf_counter() - start
+        self.metrics.observe_phase("generate", seconds)
+        # The first position is the decoder start token, padding follows EOS
+        lengths = (ids[:, 1:] != self.model.generation_config.pad_token_id).sum(dim=1)
+        for length in lengths.tolist():
+            self.metrics.observe_completion(length, seconds)
+        return ids
+
+    def decode(self, ids):
+        """
+        :return: one string per image
+        """
+        with self.metrics.time("postprocess"):
+            return self.processor.batch_decode(ids, skip_special_tokens=True)
+
+    def _response(self, texts):
+        """
+        One response holding the text of every image in a request. Requests
+        with several images get one row per image.
+        """
+        if len(texts) == 1:
+            text = np.array(texts[0], dtype=np.object_)
+        else:
+            text = np.array(texts, dtype=np.object_).reshape(-1, 1)
+        return pb_utils.InferenceResponse(
+            output_tensors=[pb_utils.Tensor("generated_text", text)]
+        )
+
+    def _cache_key(self, request):
+        arrays = []
+        for tensor_name, _ in IMAGE_INPUTS:
+            tensor = pb_utils.get_input_tensor_by_name(request, tensor_name)
+            if tensor is not None:
+                arrays.append(tensor.as_numpy())
+        return self.response_cache.key(arrays, self.cache_params)
+
+    def _read_image_tensors(self, request):
+        """
+        Return the request's images and their encoding, one per row of the
+        input tensor; decoding happens in the preprocessor. Raw bytes and
+        pixels are passed on as views of the input tensor, without copying.
+        :return: None when the request has none of the image inputs
+        """
+        for tensor_name, encoding in IMAGE_INPUTS:
+            tensor = pb_utils.get_input_tensor_by_name(request, tensor_name)
+            if tensor is None:
+                continue
+            img = tensor.as_numpy()
+            if encoding == PIXELS:
+                return [(row, encoding) for row in img]
+            return [(row[0], encoding) for row in img]
+        return None
 
-    def _read_image_tensor(self, request, tensor_name):
-        img = pb_utils.get_input_tensor_by_name(request, tensor_name).as_numpy()
-        img = img[0][0].decode("utf-8")
-        img = base64.b64decode(img)
-        img = Image.open(io.BytesIO(img))
-        img = img.convert("RGB")
-        img = self.transforms(img)
-        img = img.unsqueeze_(0)
-        return img
+    def _error_response(self, message):
+        """
+        An INVALID_ARG error response, on Triton releases that have error codes.
+        """
+        code = getattr(pb_utils.TritonError, "INVALID_ARG", None)
+        error = (
+            pb_utils.TritonError(message)
+            if code is None
+            else pb_utils.TritonError(message, code)
+        )
+        return pb_utils.InferenceResponse(output_tensors=[], error=error)
 
     def execute(self, requests):
         logger = pb_utils.Logger
-        logger.log_info("TROCR: Received request")
-        logger.log_info(f"Num prompts in batch: {len(requests)}")
-        responses = []
-        images = [self._read_image_tensor(request, "image") for request in requests]
-        batch_images = torch.cat(images, dim=0)
-        responses = self.generate(batch_images)
+        if self.log_requests:
+            logger.log_info("TROCR: Received request")
+            logger.log_info(f"Num prompts in batch: {len(requests)}")
+        responses = [None] * len(requests)
+        keys = [None] * len(requests)
+        if self.response_cache is not None:
+            for i, request in enumerate(requests):
+                keys[i] = self._cache_key(request)
+                outputs = self.response_cache.get(keys[i])
+                if outputs is not None:
+                    tensors = [pb_utils.Tensor(k, v) for k, v in outputs.items()]
+                    responses[i] = pb_utils.InferenceResponse(output_tensors=tensors)
+            if self.log_requests:
+                logger.log_info(f"TROCR: Response cache: {self.response_cache.stats()}")
+
+        # Requests may carry several images each, all run as one batch. A
+        # request without any image only fails itself, not the whole batch.
+        misses, rows = [], []
+        for i, response in enumerate(responses):
+            if response is not None:
+                continue
+            request_rows = self._read_image_tensors(requests[i])
+            if request_rows is None:
+                responses[i] = self._error_response(
+                    "TROCR: request has none of the inputs 'image', 'image_bytes' or 'pixels'"
+                )
+                continue
+            misses.append(i)
+            rows.append(request_rows)
+        if not misses:
+            self._record_metrics()
+            return responses
+        images, encodings = zip(*[row for request_rows in rows for row in request_rows])
+        self.metrics.observe_batch(len(images))
+
+        # Images that can't be decoded only fail their own request
+        failed = {}
+
+        def prepare(chunk, slot):
+            start, end = chunk
+            errors = {}
+            with self.metrics.time("preprocess"):
+                pixel_values = self.preprocessor(
+                    list(images[start:end]),
+                    list(encodings[start:end]),
+                    out=self.buffers.get(slot, end - start),
+                    errors=errors,
+                )
+            failed.update({start + i: error for i, error in errors.items()})
+            return pixel_values
+
+        chunks = split_rows(len(images), self.pipeline_rows)
+        texts = [
+            text
+            for chunk_texts in self.pipeline.map(chunks, prepare, self.generate, self.decode)
+            for text in chunk_texts
+        ]
+        # Preprocessing the model had to wait for, i.e. not hidden by the overlap
+        self.metrics.observe_phase("preprocess_wait", self.pipeline.stall_seconds)
+        end = 0
+        for i, request_rows in zip(misses, rows):
+            start, end = end, end + len(request_rows)
+            bad = [row for row in range(start, end) if row in failed]
+            if bad:
+                responses[i] = self._error_response(
+                    f"TROCR: image {bad[0] - start} could not be decoded: {failed[bad[0]]}"
+                )
+                continue
+            response = self._response(texts[start:end])
+            responses[i] = response
+            if self.response_cache is not None:
+                self.response_cache.put(
+                    keys[i],
+                    {t.name(): t.as_numpy() for t in response.output_tensors()},
+                )
+        self._record_metrics()
         return responses
 
+    def _record_metrics(self):
+        if self.response_cache is not None:
+            self.metrics.record_cache("response", self.response_cache.stats())
+        gpu_bytes = None
+        if self.device.type == "cuda":
+            gpu_bytes = torch.cuda.max_memory_allocated(self.device)
+        self.metrics.record_memory(gpu_bytes)
+        self.metrics.flush()
+
     def finalize(self):
         print("Cleaning up...")
+        self.metrics.flush(force=True)
+        self.preprocessor.close()
+        self.pipeline.close()
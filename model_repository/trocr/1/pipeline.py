@@ -0,0 +1,129 @@
+# coding=utf-8
+
+"""
+Staged execution of a batch in chunks.
+
+A batch is split into chunks that go through three stages: preprocessing
+on a worker thread, the model on the calling thread (and the device
+stream it uses), then postprocessing back on the worker. While chunk k
+runs on the device, chunk k+1 is decoded and normalised, and chunk k-1
+decoded to text, so the device isn't left idle during host work.
+
+Preprocessed chunks are written into reusable host buffers, one per
+chunk in flight, pinned when the model runs on a GPU so that the copy
+to the device can be asynchronous. A buffer is only written again once
+the chunk it held has been run, so no copies are needed to hand chunks
+between stages.
+
+This module has no Triton dependency so it can be exercised on CPU.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence, Tuple
+
+import torch
+
+
+def split_rows(rows: int, chunk_rows: int) -> List[Tuple[int, int]]:
+    """
+    Split `rows` into (start, end) ranges of at most `chunk_rows`, as even
+    in size as possible so the last chunk isn't a straggler.
+    :param chunk_rows: largest chunk, 0 for a single chunk
+    """
+    if rows == 0:
+        return []
+    chunks = -(-rows // chunk_rows) if chunk_rows > 0 else 1
+    size, extra = divmod(rows, chunks)
+    ranges, start = [], 0
+    for i in range(chunks):
+        end = start + size + (i < extra)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class HostBuffers:
+    """
+    One reusable float buffer per pipeline slot, grown when a chunk needs
+    more rows than it holds and never shrunk.
+    :param slots: number of buffers
+    :param shape: shape of one row, e.g. (3, 384, 384)
+    :param pin: allocate page-locked memory, for asynchronous copies to a GPU
+    """
+
+    def __init__(self, slots: int, shape: Sequence[int], pin: bool = False):
+        self.shape = tuple(shape)
+        self.pin = pin
+        self._buffers = [None] * slots
+
+    def get(self, slot: int, rows: int) -> torch.Tensor:
+        buffer = self._buffers[slot]
+        if buffer is None or buffer.shape[0] < rows:
+            buffer = torch.empty((rows, *self.shape), dtype=torch.float32, pin_memory=self.pin)
+            self._buffers[slot] = buffer
+        return buffer[:rows]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.numel() * b.element_size() for b in self._buffers if b is not None)
+
+
+class ChunkPipeline:
+    """
+    :param depth: chunks preprocessed ahead of the one running; each chunk
+        in flight takes a host buffer, so there are depth + 1 of them
+    """
+
+    def __init__(self, depth: int = 1):
+        self.depth = max(depth, 1)
+        self.slots = self.depth + 1
+        # One thread keeps the stages of a chunk in order; the preprocessor
+        # has its own pool for decoding images in parallel.
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trocr-pipeline")
+        # Seconds the calling thread waited for preprocessing in the last map()
+        self.stall_seconds = 0.0
+
+    def map(
+        self,
+        chunks: Sequence,
+        prepare: Callable,
+        run: Callable,
+        finish: Callable,
+    ) -> List:
+        """
+        :param chunks: one item per chunk, handed to `prepare`
+        :param prepare: (chunk, slot) -> model input, on the worker thread;
+            `slot` picks the host buffer to write into
+        :param run: model input -> model output, on the calling thread
+        :param finish: model output -> result, on the worker thread
+        :return: the result of each chunk, in order
+        """
+        prepared, finished = deque(), []
+        self.stall_seconds = 0.0
+
+        def submit(k):
+            prepared.append(self.worker.submit(prepare, chunks[k], k % self.slots))
+
+        try:
+            for k in range(min(self.depth, len(chunks))):
+                submit(k)
+            for k in range(len(chunks)):
+                # Chunk k - 1 has run, so its buffer is free for chunk k + depth
+                if k + self.depth < len(chunks):
+                    submit(k + self.depth)
+                start = time.perf_counter()
+                inputs = prepared.popleft().result()
+                self.stall_seconds += time.perf_counter() - start
+                finished.append(self.worker.submit(finish, run(inputs)))
+            return [future.result() for future in finished]
+        except BaseException:
+            # Don't leave chunks writing into buffers the next call reuses
+            for future in prepared:
+                if not future.cancel():
+                    future.exception()  # waits for it to finish
+            raise
+
+    def close(self):
+        self.worker.shutdown(wait=False)
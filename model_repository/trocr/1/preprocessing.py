@@ -0,0 +1,147 @@
+# coding=utf-8
+
+"""
+Batched image preprocessing for the TrOCR backend.
+
+Images arrive base64-encoded, as raw encoded bytes or as decoded uint8
+pixels. They are decoded in parallel on a thread pool (base64 and PIL
+decoding release the GIL) and reduced to small grayscale thumbnails. The
+invert/resize/normalise steps then run once over the stacked batch,
+producing the pixel values the model expects without a second pass
+through TrOCRProcessor.
+"""
+
+import base64
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# How an image is encoded in its input tensor
+BASE64 = "base64"
+RAW = "raw"
+PIXELS = "pixels"
+
+
+class BatchPreprocessor:
+    """
+    :param image_size: (height, width) of the model's pixel values
+    :param image_mean: per-channel normalisation mean
+    :param image_std: per-channel normalisation std
+    :param rescale_factor: scale applied to uint8 pixels before normalising
+    :param thumbnail_size: (height, width) images are first reduced to
+    :param num_workers: threads used to decode images
+    """
+
+    def __init__(
+        self,
+        image_size: Tuple[int, int] = (384, 384),
+        image_mean: Sequence[float] = (0.5, 0.5, 0.5),
+        image_std: Sequence[float] = (0.5, 0.5, 0.5),
+        rescale_factor: float = 1 / 255,
+        thumbnail_size: Tuple[int, int] = (50, 50),
+        num_workers: int = 4,
+    ):
+        self.image_size = tuple(image_size)
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.rescale_factor = rescale_factor
+        self.mean = torch.tensor(image_mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(image_std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    @classmethod
+    def from_image_processor(cls, image_processor, **kwargs) -> "BatchPreprocessor":
+        """
+        Take the resize and normalisation settings from a HF image processor.
+        """
+        size = image_processor.size
+        return cls(
+            image_size=(size["height"], size["width"]),
+            image_mean=image_processor.image_mean,
+            image_std=image_processor.image_std,
+            rescale_factor=image_processor.rescale_factor,
+            **kwargs,
+        )
+
+    def decode(self, data: Union[bytes, str, np.ndarray], encoding: str = BASE64):
+        """
+        Decode one image into a uint8 grayscale thumbnail.
+        :param data: base64 text, raw encoded bytes or [height, width, 3]
+            uint8 pixels; numpy inputs are read without copying
+        :param encoding: one of BASE64, RAW or PIXELS
+        """
+        if encoding == PIXELS:
+            img = Image.fromarray(np.ascontiguousarray(data, dtype=np.uint8))
+        else:
+            if encoding == BASE64:
+                data = base64.b64decode(data)
+            img = Image.open(io.BytesIO(data))
+        img = img.convert("L")
+        height, width = self.thumbnail_size
+        img = img.resize((width, height), Image.BILINEAR)
+        return np.asarray(img)
+
+    def _try_decode(self, data, encoding: str):
+        """
+        :return: the thumbnail and None, or None and the decoding error
+        """
+        try:
+            return self.decode(data, encoding), None
+        except Exception as e:  # binascii, PIL and numpy all raise their own
+            return None, e
+
+    def __call__(
+        self,
+        images: List,
+        encodings: Optional[List[str]] = None,
+        out: Optional[torch.Tensor] = None,
+        errors: Optional[Dict[int, Exception]] = None,
+    ) -> torch.Tensor:
+        """
+        :param images: encoded images, see `decode`
+        :param encodings: encoding of each image, base64 by default
+        :param out: [batch, 3, height, width] float buffer to write into
+        :param errors: when given, images that can't be decoded don't fail
+            the batch: they are replaced by a blank image and their error
+            is stored here under their index
+        :return: [batch, 3, height, width] float pixel values
+        """
+        if encodings is None:
+            encodings = [BASE64] * len(images)
+        if errors is None:
+            thumbnails = np.stack(list(self.pool.map(self.decode, images, encodings)))
+            return self.transform(thumbnails, out)
+        thumbnails = []
+        decoded = self.pool.map(self._try_decode, images, encodings)
+        for i, (thumbnail, error) in enumerate(decoded):
+            if error is not None:
+                errors[i] = error
+                thumbnail = np.full(self.thumbnail_size, 255, dtype=np.uint8)
+            thumbnails.append(thumbnail)
+        return self.transform(np.stack(thumbnails), out)
+
+    def transform(
+        self, thumbnails: np.ndarray, out: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Invert, upscale and normalise a stack of grayscale thumbnails.
+        :param thumbnails: [batch, height, width] uint8
+        :param out: buffer for the result, e.g. reused pinned memory
+        """
+        pixels = torch.from_numpy(thumbnails).unsqueeze(1)
+        pixels = (255 - pixels).float()
+        pixels = F.interpolate(
+            pixels, size=self.image_size, mode="bilinear", align_corners=False
+        )
+        pixels = pixels.clamp_(0, 255).mul_(self.rescale_factor)
+        pixels = pixels.expand(-1, self.mean.shape[1], -1, -1)
+        if out is None:
+            return (pixels - self.mean) / self.std
+        return torch.sub(pixels, self.mean, out=out).div_(self.std)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,86 @@
+# coding=utf-8
+
+"""
+Share model weights between CPU instances of a Python backend.
+
+Every Triton model instance runs in its own stub process, so N CPU
+instances would normally hold N copies of the weights. Instead, the
+first instance saves its state dict to a file and every instance loads
+it memory-mapped: the tensors are backed by the same page-cache pages,
+so the weights are held in memory once.
+
+The file outlives the server (it sits in /dev/shm by default), so it is
+tagged with where the weights came from and made again when that changes,
+e.g. after a new snapshot was prepared.
+"""
+
+import fcntl
+import os
+from typing import Callable, Optional
+
+import torch
+
+
+def _write_atomic(path: str, write: Callable[[str], None]):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read_source(path: str) -> Optional[str]:
+    try:
+        with open(f"{path}.source") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def load_shared_state_dict(
+    path: str, load_model: Callable[[], torch.nn.Module], source: str = ""
+):
+    """
+    Return a memory-mapped state dict from `path`, creating it from
+    `load_model()` if this is the first instance to start, or if the file
+    was made from other weights than `source`.
+    :param path: file the state dict is shared through
+    :param load_model: loads the model the usual way (e.g. from_pretrained)
+    :param source: identifies the weights, e.g. the model name and the
+        fingerprint of its snapshot; recorded in `path`.source
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        # Instances start concurrently, only one of them writes the file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path) or _read_source(path) != source:
+            state_dict = load_model().state_dict()
+            # Instances still mapping a replaced file keep their copy of it
+            _write_atomic(path, lambda tmp_path: torch.save(state_dict, tmp_path))
+
+            def write_source(tmp_path):
+                with open(tmp_path, "w") as f:
+                    f.write(source)
+
+            _write_atomic(f"{path}.source", write_source)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return torch.load(path, mmap=True, weights_only=True)
+
+
+def load_shared_model(
+    path: str,
+    build_model: Callable[[], torch.nn.Module],
+    load_model: Callable[[], torch.nn.Module],
+    source: str = "",
+) -> torch.nn.Module:
+    """
+    Build a model whose parameters are views of the shared, memory-mapped
+    state dict rather than per-process copies.
+    :param path: file the state dict is shared through
+    :param build_model: constructs the model architecture from its config
+    :param load_model: loads the model the usual way (e.g. from_pretrained)
+    :param source: identifies the weights, see `load_shared_state_dict`
+    """
+    state_dict = load_shared_state_dict(path, load_model, source)
+    model = build_model()
+    model.load_state_dict(state_dict, assign=True)
+    model.tie_weights()
+    return model
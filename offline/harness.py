@@ -0,0 +1,378 @@
+# coding=utf-8
+
+"""
+Run a backend's model.py without a Triton server.
+
+The model directory's config.pbtxt is parsed and handed to initialize()
+the way Triton does, with the triton_python_backend_utils stand-in from
+this directory in place of the real module. Requests are built from the
+load test data files and batched by the stub server's dynamic batcher,
+following the config's preferred batch sizes and queue delay, so a
+change to a backend can be measured end to end on a laptop:
+
+    python offline/harness.py model_repository/trocr --tiny \\
+        --param share_weights=false --data image.json --requests 64 --rate 200
+
+With `--tiny` the model directory is copied to a temporary repository
+and given a tiny random snapshot (offline/tiny_models.py), which the
+backend loads instead of the real weights. Without it, the backend loads
+its model as it would in the server, from its snapshot or the hub.
+"""
+
+import asyncio
+import copy
+import importlib.util
+import inspect
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+OFFLINE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(OFFLINE_DIR)
+for path in (os.path.join(ROOT, "load_testing"), ROOT, OFFLINE_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from histogram import LatencyHistogram  # noqa: E402
+from model_config import ModelConfig, load_model_config  # noqa: E402
+from request_schema import map_request_type_to_numpy  # noqa: E402
+from stub_server import DynamicBatcher  # noqa: E402
+
+PERCENTILES = (50, 90, 99)
+
+
+def triton_model_config(config: ModelConfig, parameters: Dict[str, str] = None) -> dict:
+    """
+    The config as Triton passes it to initialize(): the ModelConfig
+    message as JSON, where repeated fields are lists and "parameters" is
+    a map of {"string_value": ...}.
+    :param parameters: values replacing or adding to the config's parameters
+    """
+    model_config = copy.deepcopy(config.raw)
+    for field in ("input", "output", "instance_group"):
+        value = model_config.get(field)
+        if isinstance(value, dict):
+            model_config[field] = [value]
+    merged = {**config.parameters, **(parameters or {})}
+    model_config["parameters"] = {
+        key: {"string_value": str(value)} for key, value in merged.items()
+    }
+    return model_config
+
+
+def request_from_payload(payload: dict) -> pb_utils.InferenceRequest:
+    """
+    Turn a request dict, as built by load_testing/utils.py, into an
+    InferenceRequest with numpy inputs shaped as the server would pass them.
+    """
+    tensors = []
+    for input_dict in payload["inputs"]:
+        datatype = input_dict["datatype"]
+        if datatype == "BYTES":
+            values = [
+                value.encode("utf-8") if isinstance(value, str) else value
+                for value in np.array(input_dict["data"], dtype=np.object_).reshape(-1)
+            ]
+            array = np.array(values, dtype=np.object_).reshape(input_dict["shape"])
+        else:
+            array = np.asarray(
+                input_dict["data"], dtype=map_request_type_to_numpy(datatype)
+            ).reshape(input_dict["shape"])
+        tensors.append(pb_utils.Tensor(input_dict["name"], array))
+    requested = [output["name"] for output in payload.get("outputs", [])]
+    timeout = int(payload.get("parameters", {}).get("timeout", 0))
+    return pb_utils.InferenceRequest(tensors, requested, timeout=timeout)
+
+
+def payload_rows(payload: dict) -> int:
+    return int(payload["inputs"][0]["shape"][0]) if payload["inputs"] else 1
+
+
+def _import_model(version_dir: str, module_name: str):
+    """
+    Import a version directory's model.py. Its directory goes on sys.path
+    so that it can import the modules next to it, as in the server.
+    """
+    if version_dir not in sys.path:
+        sys.path.insert(1, version_dir)
+    spec = importlib.util.spec_from_file_location(
+        module_name, os.path.join(version_dir, "model.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class OfflineBackend:
+    """
+    A backend loaded from its model directory and initialized in-process.
+    :param model_dir: directory with config.pbtxt and numbered versions
+    :param version: version directory to load
+    :param parameters: overrides for the config's parameters
+    :param instance_kind: "CPU" or "GPU", as the instance_group kind would set it
+    :param decoupled: override the config's model_transaction_policy
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        version: str = "1",
+        parameters: Dict[str, str] = None,
+        instance_kind: str = "CPU",
+        decoupled: Optional[bool] = None,
+    ):
+        self.model_dir = os.path.abspath(model_dir)
+        self.config_path = os.path.join(self.model_dir, "config.pbtxt")
+        self.config = load_model_config(self.config_path)
+        self.model_config = triton_model_config(self.config, parameters)
+        if decoupled is not None:
+            self.model_config["model_transaction_policy"] = {"decoupled": decoupled}
+        self.decoupled = pb_utils.using_decoupled_model_transaction_policy(
+            self.model_config
+        )
+        version_dir = os.path.join(self.model_dir, version)
+        self.module = _import_model(version_dir, f"{self.config.name}_model")
+        self.model = self.module.TritonPythonModel()
+        start = time.perf_counter()
+        self.model.initialize(
+            {
+                "model_config": json.dumps(self.model_config),
+                "model_name": self.config.name,
+                "model_version": version,
+                "model_repository": os.path.dirname(self.model_dir),
+                "model_instance_kind": instance_kind,
+                "model_instance_name": f"{self.config.name}_0",
+                "model_instance_device_id": "0",
+            }
+        )
+        self.initialize_seconds = time.perf_counter() - start
+
+    def execute(self, requests: List[pb_utils.InferenceRequest], wait: bool = True) -> List:
+        """
+        Run one batch of requests through execute(), which may be a coroutine.
+        :param wait: for a decoupled model, wait until every request got its
+            final response; otherwise return the response senders, which
+            keep filling up in the background
+        :return: one response per request; the streamed responses of a
+            decoupled model are joined into one
+        """
+        responses = self.model.execute(requests)
+        if inspect.iscoroutine(responses):
+            responses = asyncio.run(responses)
+        if not self.decoupled:
+            return responses
+        senders = [request.get_response_sender() for request in requests]
+        if not wait:
+            return senders
+        return [collect(sender) for sender in senders]
+
+    def execute_payloads(self, payloads: Sequence[dict]) -> List:
+        # A decoupled model's execute() may return before it has responded,
+        # so the batcher can move on to the next batch as Triton would
+        return self.execute([request_from_payload(payload) for payload in payloads], wait=False)
+
+    def serve_bls(self):
+        """
+        Take BLS requests for this model from other backends, one batch at
+        a time as a single model instance would.
+        """
+        lock = threading.Lock()
+
+        def execute(requests):
+            with lock:
+                return self.execute(requests)
+
+        pb_utils.bls_models[self.config.name] = execute
+
+    def finalize(self):
+        pb_utils.bls_models.pop(self.config.name, None)
+        if hasattr(self.model, "finalize"):
+            self.model.finalize()
+
+
+def collect(sender: pb_utils.ResponseSender) -> pb_utils.InferenceResponse:
+    """
+    Wait for a decoupled request's final response and join what was sent,
+    as a streaming client ends up with: the text chunks concatenated and
+    the other outputs from whichever response carried them.
+    """
+    sender.done.wait()
+    responses = sender.responses
+    for response in responses:
+        if response.has_error():
+            return response
+    text, outputs = [], {}
+    for response in responses:
+        for name, value in response.as_dict().items():
+            if name == "generated_text":
+                text.append(value.reshape(-1)[0])
+            else:
+                outputs[name] = value
+    tensors = [pb_utils.Tensor(name, value) for name, value in outputs.items()]
+    if text:
+        joined = "".join(t.decode("utf-8") if isinstance(t, bytes) else t for t in text)
+        tensors.insert(0, pb_utils.Tensor("generated_text", np.array(joined, dtype=np.object_)))
+    return pb_utils.InferenceResponse(output_tensors=tensors)
+
+
+def tiny_model_dir(model_dir: str, **kwargs) -> str:
+    """
+    Copy a model directory into a temporary repository, with a tiny random
+    snapshot in each version directory. The caller removes the copy.
+    :param kwargs: passed on to the tiny model's builder
+    """
+    from tiny_models import write_tiny_snapshot
+
+    model_dir = os.path.abspath(model_dir)
+    name = os.path.basename(model_dir)
+    copy_dir = os.path.join(tempfile.mkdtemp(prefix="offline-"), name)
+    shutil.copytree(
+        model_dir, copy_dir, ignore=shutil.ignore_patterns("snapshot", "__pycache__")
+    )
+    for entry in os.listdir(copy_dir):
+        if entry.isdigit():
+            write_tiny_snapshot(name, os.path.join(copy_dir, entry), **kwargs)
+    return copy_dir
+
+
+def simulate(
+    backend: OfflineBackend,
+    payloads: Sequence[dict],
+    arrivals: Optional[Sequence[float]] = None,
+) -> dict:
+    """
+    Send payloads through a dynamic batcher configured like the model,
+    into the backend, as Triton would with one model instance. A decoupled
+    request's latency runs until its final response.
+    :param arrivals: send time of each payload in seconds from the start;
+        all at once when None
+    :return: latency, queueing and batch size statistics, and the responses
+    """
+    batcher = DynamicBatcher(0.0, 0.0, instances=1, execute=backend.execute_payloads)
+    batcher.configure(backend.config_path)
+    if backend.config.dynamic_batching is None:
+        # Without a dynamic batcher Triton executes requests one by one
+        batcher.max_batch_size = 1
+
+    pending = []
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads):
+        if arrivals is not None:
+            delay = start + arrivals[i] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        pending.append(batcher.enqueue(payload, payload_rows(payload)))
+    results, finished = [], []
+    for request in pending:
+        request.done.wait()
+        result = request.error if request.error is not None else request.result
+        if isinstance(result, pb_utils.ResponseSender):
+            result, end = collect(result), result.finished
+        else:
+            end = request.finished
+        results.append(result)
+        finished.append(end)
+    elapsed = max(finished, default=start) - start
+
+    latency, queue_time = LatencyHistogram(), LatencyHistogram()
+    errors = 0
+    for request, result, end in zip(pending, results, finished):
+        if result is None or isinstance(result, Exception) or result.has_error():
+            errors += 1
+            continue
+        latency.record(end - request.arrival)
+        queue_time.record(request.started - request.arrival)
+    return {
+        "summary": {
+            "model": backend.config.name,
+            "requests": len(pending),
+            "errors": errors,
+            "executions": batcher.execution_count,
+            "mean_batch_rows": batcher.inference_count / max(batcher.execution_count, 1),
+            "elapsed_s": elapsed,
+            "throughput_rps": len(pending) / elapsed if elapsed else 0.0,
+            "latency_s": latency.summary(PERCENTILES) if latency.total else None,
+            "queue_s": queue_time.summary(PERCENTILES) if queue_time.total else None,
+            "initialize_s": backend.initialize_seconds,
+        },
+        "results": results,
+    }
+
+
+def _describe(result) -> str:
+    if isinstance(result, Exception):
+        return f"exception: {result!r}"
+    if result.has_error():
+        return f"error: {result.error().message()}"
+    return str({name: value.tolist() for name, value in result.as_dict().items()})
+
+
+if __name__ == "__main__":
+    from open_loop import poisson_arrivals
+    from utils import create_payload_corpus
+
+    parser = ArgumentParser()
+    parser.add_argument("model_dir", help="Model directory, e.g. model_repository/trocr")
+    parser.add_argument("--version", default="1")
+    parser.add_argument("--data", required=True, help="Data JSON, as for the load tests")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=1, help="Rows per request")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Poisson arrivals per second, 0 to send everything at once")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config parameter, may be repeated")
+    parser.add_argument("--instance-kind", default="CPU", choices=["CPU", "GPU"])
+    parser.add_argument("--decoupled", action="store_true",
+                        help="Run as a decoupled model, e.g. with --param streaming=true")
+    parser.add_argument("--tiny", action="store_true",
+                        help="Load a tiny random model instead of the real weights")
+    parser.add_argument("--verbose", action="store_true", help="Show the backend's log")
+    parser.add_argument("--output", help="Save the summary as JSON")
+    args = parser.parse_args()
+
+    pb_utils.Logger.quiet = not args.verbose
+    parameters = dict(param.split("=", 1) for param in args.param)
+    model_dir = tiny_model_dir(args.model_dir) if args.tiny else args.model_dir
+    try:
+        backend = OfflineBackend(
+            model_dir, args.version, parameters, args.instance_kind, args.decoupled or None
+        )
+        payloads = create_payload_corpus(
+            args.data, backend.config_path, args.requests, args.batch_size
+        )
+        arrivals = None
+        if args.rate > 0:
+            # Long enough a window to hold every payload, then cut to size
+            duration = 2 * len(payloads) / args.rate + 1
+            arrivals = poisson_arrivals(args.rate, duration, random.Random(0))[: len(payloads)]
+        result = simulate(backend, payloads, arrivals)
+        backend.finalize()
+    finally:
+        if args.tiny:
+            shutil.rmtree(os.path.dirname(model_dir))
+
+    summary = result["summary"]
+    print(f"First response: {_describe(result['results'][0])}")
+    print(f"\n{summary['model']}: {summary['requests']} requests, {summary['errors']} errors, "
+          f"{summary['executions']} executions of {summary['mean_batch_rows']:.1f} rows on average, "
+          f"{summary['throughput_rps']:.1f} req/s (initialize {summary['initialize_s']:.2f}s)")
+    print(f"{'':<10}{'mean':>9}" + "".join(f"{f'p{p}':>9}" for p in PERCENTILES) + f"{'max':>9}  (ms)")
+    for label in ("latency", "queue"):
+        s = summary[f"{label}_s"]
+        if s:
+            print(f"{label:<10}" + "".join(
+                f"{s[k] * 1000:>9.1f}" for k in ["mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+            ))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,168 @@
+# coding=utf-8
+
+"""
+Tiny randomly-initialised stand-ins for the backends' models, written as
+snapshots (see backend_common/startup.py) so that a backend's own
+initialize() loads them on CPU in well under a second, without the hub.
+Outputs are gibberish, but tokenization, batching, generation loops and
+pre/postprocessing all run the real code paths.
+
+The tokenizers are byte-level BPE trained on the repository's load test
+data, so prompt lengths scale with the payloads like the real ones do.
+"""
+
+import glob
+import json
+import os
+from typing import Iterator, List
+
+import torch
+
+from backend_common.startup import SNAPSHOT_DIR, save_snapshot
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+LLAMA_SPECIAL_TOKENS = [
+    "<|begin_of_text|>",
+    "<|eot_id|>",
+    "<|start_header_id|>",
+    "<|end_header_id|>",
+]
+# Llama 3's chat format, without the date header of the real template
+LLAMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n"
+    "{{ message['content'] }}<|eot_id|>{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+TROCR_SPECIAL_TOKENS = ["<s>", "<pad>", "</s>", "<unk>"]
+
+
+def _corpus() -> Iterator[str]:
+    for path in sorted(glob.glob(os.path.join(ROOT, "load_testing", "data", "*.json"))):
+        with open(path) as f:
+            data = json.load(f)
+        for item in data if isinstance(data, list) else [data]:
+            for value in item.values():
+                if value.get("type") == "string":
+                    yield value["content"]
+    yield "INVOICE No. 0123456789 TOTAL DUE"
+
+
+def tiny_tokenizer(special_tokens: List[str], vocab_size: int = 512, **kwargs):
+    """
+    A byte-level BPE PreTrainedTokenizerFast, trained in memory.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=special_tokens,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(_corpus(), trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, **kwargs)
+
+
+def tiny_llama(seed: int = 0):
+    """
+    :return: a two-layer Llama model and its chat tokenizer
+    """
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    tokenizer = tiny_tokenizer(
+        LLAMA_SPECIAL_TOKENS,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|eot_id|>",
+        chat_template=LLAMA_CHAT_TEMPLATE,
+    )
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=32768,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(seed)
+    return LlamaForCausalLM(config).eval(), tokenizer
+
+
+def tiny_trocr(seed: int = 0, image_size: int = 32, patch_size: int = 8):
+    """
+    :param image_size: side of the processor's pixel values; with the real
+        model's 384, use a larger patch_size to keep the encoder small
+    :return: a one-layer ViT encoder / TrOCR decoder and its processor
+    """
+    from transformers import (
+        TrOCRConfig,
+        TrOCRProcessor,
+        ViTConfig,
+        ViTImageProcessor,
+        VisionEncoderDecoderConfig,
+        VisionEncoderDecoderModel,
+    )
+
+    tokenizer = tiny_tokenizer(
+        TROCR_SPECIAL_TOKENS,
+        bos_token="<s>",
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+    image_processor = ViTImageProcessor(
+        size={"height": image_size, "width": image_size},
+        image_mean=[0.5, 0.5, 0.5],
+        image_std=[0.5, 0.5, 0.5],
+    )
+    processor = TrOCRProcessor(image_processor=image_processor, tokenizer=tokenizer)
+    encoder = ViTConfig(
+        image_size=image_size,
+        patch_size=patch_size,
+        hidden_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=64,
+    )
+    decoder = TrOCRConfig(
+        vocab_size=len(tokenizer),
+        d_model=32,
+        decoder_layers=1,
+        decoder_attention_heads=2,
+        decoder_ffn_dim=64,
+        bos_token_id=tokenizer.bos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        decoder_start_token_id=tokenizer.eos_token_id,
+    )
+    config = VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder)
+    config.decoder_start_token_id = tokenizer.eos_token_id
+    config.pad_token_id = tokenizer.pad_token_id
+    config.eos_token_id = tokenizer.eos_token_id
+    torch.manual_seed(seed)
+    return VisionEncoderDecoderModel(config).eval(), processor
+
+
+# Backend name -> builder of its tiny model
+TINY_MODELS = {"llama3_8b": tiny_llama, "trocr": tiny_trocr}
+
+
+def write_tiny_snapshot(model_name: str, version_dir: str, **kwargs) -> str:
+    """
+    Write the tiny model for a backend into its version directory.
+    :param kwargs: passed on to the model's builder
+    :return: the snapshot path
+    """
+    model, tokenizer = TINY_MODELS[model_name](**kwargs)
+    path = os.path.join(version_dir, SNAPSHOT_DIR)
+    save_snapshot(path, model, tokenizer, info={"model": f"tiny-{model_name}", "quantize": "full"})
+    return path
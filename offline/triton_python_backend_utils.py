@@ -0,0 +1,218 @@
+# coding=utf-8
+
+"""
+Stand-in for the `triton_python_backend_utils` module that Triton's
+Python backend provides, covering what the backends in this repository
+use. Put this directory first on sys.path to import a backend's model.py
+outside the server; offline/harness.py does that.
+
+Responses sent through a request's response sender (decoupled models)
+are collected on the sender, and its `done` event is set by the one
+flagged TRITONSERVER_RESPONSE_COMPLETE_FINAL.
+
+BLS requests (`InferenceRequest.exec` and `async_exec`) go to the models
+in `bls_models`, which OfflineBackend.serve_bls() in offline/harness.py
+adds backends to.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+TRITONSERVER_RESPONSE_COMPLETE_FINAL = 1
+
+
+class TritonError:
+    UNKNOWN = 0
+    INTERNAL = 1
+    NOT_FOUND = 2
+    INVALID_ARG = 3
+    UNAVAILABLE = 4
+    UNSUPPORTED = 5
+    ALREADY_EXISTS = 6
+    CANCELLED = 7
+
+    def __init__(self, message: str, code: int = INTERNAL):
+        self._message = message
+        self._code = code
+
+    def message(self) -> str:
+        return self._message
+
+    def code(self) -> int:
+        return self._code
+
+    def __repr__(self):
+        return f"TritonError({self._message!r}, code={self._code})"
+
+
+class TritonModelException(Exception):
+    pass
+
+
+class Logger:
+    """
+    Writes to stderr, or drops everything when `quiet` is set.
+    """
+
+    quiet = False
+
+    @classmethod
+    def _log(cls, level: str, message: str):
+        if not cls.quiet:
+            print(f"[{level}] {message}", file=sys.stderr)
+
+    @classmethod
+    def log_info(cls, message: str):
+        cls._log("info", message)
+
+    @classmethod
+    def log_warn(cls, message: str):
+        cls._log("warn", message)
+
+    @classmethod
+    def log_error(cls, message: str):
+        cls._log("error", message)
+
+    @classmethod
+    def log_verbose(cls, message: str):
+        cls._log("verbose", message)
+
+
+class Tensor:
+    def __init__(self, name: str, array):
+        self._name = name
+        self._array = np.asarray(array)
+
+    def name(self) -> str:
+        return self._name
+
+    def as_numpy(self) -> np.ndarray:
+        return self._array
+
+    def shape(self) -> tuple:
+        return self._array.shape
+
+
+class InferenceResponse:
+    def __init__(self, output_tensors: Sequence[Tensor] = (), error: TritonError = None):
+        self._output_tensors = list(output_tensors)
+        self._error = error
+
+    def output_tensors(self) -> List[Tensor]:
+        return self._output_tensors
+
+    def has_error(self) -> bool:
+        return self._error is not None
+
+    def error(self) -> Optional[TritonError]:
+        return self._error
+
+    def as_dict(self) -> Dict[str, np.ndarray]:
+        return {tensor.name(): tensor.as_numpy() for tensor in self._output_tensors}
+
+
+class ResponseSender:
+    def __init__(self):
+        self.responses: List[InferenceResponse] = []
+        self.done = threading.Event()
+        # perf_counter() time of the final response
+        self.finished = 0.0
+
+    def send(self, response: InferenceResponse = None, flags: int = 0):
+        if self.done.is_set():
+            raise TritonModelException("response sent after the final flag")
+        if response is not None:
+            self.responses.append(response)
+        if flags & TRITONSERVER_RESPONSE_COMPLETE_FINAL:
+            self.finished = time.perf_counter()
+            self.done.set()
+
+
+# Execute functions of the models BLS requests can reach, by model name;
+# not in the real API
+bls_models: Dict[str, Callable[[List["InferenceRequest"]], List[InferenceResponse]]] = {}
+
+
+class InferenceRequest:
+    """
+    :param inputs: the request's input tensors
+    :param requested_output_names: outputs the client asked for
+    :param timeout: the request's timeout parameter in microseconds, 0 for none
+    :param model_name: the model a BLS request is for
+    """
+
+    def __init__(
+        self,
+        inputs: Sequence[Tensor],
+        requested_output_names: Sequence[str] = (),
+        request_id: str = "",
+        timeout: int = 0,
+        model_name: str = "",
+    ):
+        self._inputs = {tensor.name(): tensor for tensor in inputs}
+        self._requested_output_names = list(requested_output_names)
+        self._request_id = request_id
+        self._timeout = timeout
+        self._model_name = model_name
+        self._cancelled = threading.Event()
+        self._response_sender = ResponseSender()
+
+    def timeout(self) -> int:
+        return self._timeout
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """
+        What the server does when the client disconnects; not in the real API.
+        """
+        self._cancelled.set()
+
+    def inputs(self) -> List[Tensor]:
+        return list(self._inputs.values())
+
+    def requested_output_names(self) -> List[str]:
+        return list(self._requested_output_names)
+
+    def request_id(self) -> str:
+        return self._request_id
+
+    def get_response_sender(self) -> ResponseSender:
+        return self._response_sender
+
+    def exec(self, decoupled: bool = False) -> InferenceResponse:
+        """
+        Run the request on `model_name` as a BLS call.
+        """
+        if decoupled:
+            raise TritonModelException("decoupled BLS calls aren't supported offline")
+        execute = bls_models.get(self._model_name)
+        if execute is None:
+            return InferenceResponse(
+                error=TritonError(f"Model '{self._model_name}' is not ready", TritonError.NOT_FOUND)
+            )
+        return execute([self])[0]
+
+    async def async_exec(self, decoupled: bool = False) -> InferenceResponse:
+        return await asyncio.get_running_loop().run_in_executor(None, self.exec, decoupled)
+
+
+def get_input_tensor_by_name(request: InferenceRequest, name: str) -> Optional[Tensor]:
+    return request._inputs.get(name)
+
+
+def get_output_tensor_by_name(response: InferenceResponse, name: str) -> Optional[Tensor]:
+    for tensor in response.output_tensors():
+        if tensor.name() == name:
+            return tensor
+    return None
+
+
+def using_decoupled_model_transaction_policy(model_config: dict) -> bool:
+    return bool(model_config.get("model_transaction_policy", {}).get("decoupled", False))
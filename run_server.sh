@@ -1,3 +1,6 @@
 #!/bin/bash
 
-docker run --gpus all -it --rm --shm-size=1G --ulimit memlock=-1 --ulimit stack=67108864 --env-file ./.env -v ${PWD}/model_repository:/opt/tritonserver/model_repository -v ${PWD}/.hf-cache:/opt/tritonserver/.hf-cache -p 80:8000 triton tritonserver --model-repository=model_repository
+# Catch config mistakes before starting the container
+python3 load_testing/model_config.py model_repository || exit 1
+
+docker run --gpus all -it --rm --shm-size=1G --ulimit memlock=-1 --ulimit stack=67108864 --env-file ./.env -v ${PWD}/model_repository:/opt/tritonserver/model_repository -v ${PWD}/.hf-cache:/opt/tritonserver/.hf-cache -v ${PWD}/backend_common:/opt/tritonserver/backend_common -p 80:8000 -p 8002:8002 triton tritonserver --model-repository=model_repository
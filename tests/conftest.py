@@ -0,0 +1,106 @@
+# coding=utf-8
+
+"""
+Shared fixtures for the CPU tests. Backends run in-process through
+offline/harness.py, loading the tiny random models from
+offline/tiny_models.py instead of the real weights.
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "offline"))
+
+import harness  # noqa: E402
+import triton_python_backend_utils as pb_utils  # noqa: E402
+from utils import create_payload_corpus  # noqa: E402
+
+MODEL_REPOSITORY = os.path.join(ROOT, "model_repository")
+
+# Vocabulary of the tiny_lm model, whose EOS id is never generated, so every
+# sequence runs to max_new_tokens
+TINY_VOCAB_SIZE = 256
+TINY_EOS_TOKEN_ID = TINY_VOCAB_SIZE
+
+pb_utils.Logger.quiet = True
+
+
+def reference_output(model, prompt, max_new_tokens: int) -> list:
+    """
+    Greedy completion of one unpadded prompt with `generate`, no cache reuse.
+    """
+    with torch.inference_mode():
+        input_ids = torch.tensor([prompt])
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=0,
+            eos_token_id=TINY_EOS_TOKEN_ID,
+        )
+    return output[0, len(prompt) :].tolist()
+
+
+def greedy_llama_payloads(config_path: str, count: int, max_new_tokens: int) -> list:
+    """
+    llama3_8b requests from the load test data, decoded greedily so their
+    completions can be compared and cached.
+    """
+    payloads = create_payload_corpus(
+        os.path.join(ROOT, "load_testing", "data", "data_llama.json"), config_path, count
+    )
+    for payload in payloads:
+        payload["inputs"] += [
+            {"name": "greedy", "datatype": "BOOL", "shape": [1, 1], "data": [True]},
+            {"name": "max_new_tokens", "datatype": "INT32", "shape": [1, 1],
+             "data": [max_new_tokens]},
+        ]
+        payload["outputs"] = [{"name": "generated_text"}, {"name": "completion_tokens"}]
+    return payloads
+
+
+def _tiny_model_dir(name: str):
+    model_dir = harness.tiny_model_dir(os.path.join(MODEL_REPOSITORY, name))
+    yield model_dir
+    shutil.rmtree(os.path.dirname(model_dir))
+
+
+@pytest.fixture(scope="session")
+def tiny_llama_dir():
+    """
+    A copy of model_repository/llama3_8b with a tiny random snapshot.
+    """
+    yield from _tiny_model_dir("llama3_8b")
+
+
+@pytest.fixture(scope="session")
+def tiny_trocr_dir():
+    """
+    A copy of model_repository/trocr with a tiny random snapshot.
+    """
+    yield from _tiny_model_dir("trocr")
+
+
+@pytest.fixture(scope="session")
+def tiny_lm():
+    """
+    A tiny random LlamaForCausalLM, for the generation code that takes a
+    model rather than a backend.
+    """
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=TINY_VOCAB_SIZE,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    return LlamaForCausalLM(config).eval()
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+"""
+llama3_8b's token-budget admission control, as in
+benchmarks/admission_control.py: the AdmissionController on its own with a
+fake clock, and the backend with the tiny random Llama.
+"""
+
+import os
+import sys
+
+import pytest
+
+import harness
+import triton_python_backend_utils as pb_utils
+from conftest import MODEL_REPOSITORY, greedy_llama_payloads
+
+sys.path.append(os.path.join(MODEL_REPOSITORY, "llama3_8b", "1"))
+from admission import AdmissionController, AdmissionRejected  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def controller(clock):
+    return AdmissionController(token_budget=1000, max_queue_seconds=2.0, clock=clock)
+
+
+def test_row_above_the_budget_is_rejected_for_good(controller):
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(1001)
+
+    assert not rejected.value.retryable
+    assert controller.stats()["rejected"] == {"too_large": 1, "queue_slo": 0}
+
+
+def test_cold_start_waits_at_the_seeded_drain_rate(controller):
+    # Nothing has finished: the drain rate is the budget per queue limit,
+    # 500 tokens/s, so 500 tokens over the budget wait 1s
+    controller.admit(1000)
+    controller.admit(500)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(1000)
+
+    assert rejected.value.retryable
+    assert rejected.value.retry_after == pytest.approx(1.0)
+
+
+def test_wait_follows_the_measured_drain_rate(controller, clock):
+    controller.admit(1000)
+    controller.admit(500)
+    # A row frees 1000 tokens after 10s of busy time, far slower than the
+    # seed, so a row 1s away at the seeded rate is now over the limit
+    clock.now = 10.0
+    controller.release(1000)
+
+    assert controller.estimated_wait(1000) > 2.0
+    with pytest.raises(AdmissionRejected):
+        controller.admit(1000)
+    assert controller.stats()["rejected"] == {"too_large": 0, "queue_slo": 1}
+
+
+def test_backend_rejects_rows_over_the_budget(tiny_llama_dir):
+    budget = 400
+    backend = harness.OfflineBackend(
+        tiny_llama_dir,
+        parameters={"admission_token_budget": str(budget), "admission_max_queue_s": "1"},
+    )
+    try:
+        payloads = greedy_llama_payloads(backend.config_path, 6, 100)
+        payloads += greedy_llama_payloads(backend.config_path, 1, budget)
+        responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+        stats = backend.model.admission.stats()
+    finally:
+        backend.finalize()
+
+    codes = [r.error().code() if r.has_error() else None for r in responses]
+    batch, too_large = codes[:-1], codes[-1]
+    busy = batch.count(pb_utils.TritonError.UNAVAILABLE)
+    assert too_large == pb_utils.TritonError.INVALID_ARG
+    assert batch.count(None) and busy and batch.count(None) + busy == len(batch)
+    assert stats["rejected"] == {"too_large": 1, "queue_slo": busy}
+    assert not stats["outstanding_tokens"] and not stats["outstanding_rows"]
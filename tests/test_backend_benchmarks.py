@@ -0,0 +1,111 @@
+# coding=utf-8
+
+"""
+pytest-benchmark cases for the backends, the same ones
+benchmarks/backend_offline.py times, run through the offline harness with
+the tiny random models. Every case also checks the responses, so with
+--benchmark-disable they run once each as plain tests.
+"""
+
+import base64
+import json
+import os
+import random
+import sys
+
+import pytest
+
+import harness
+from conftest import MODEL_REPOSITORY, ROOT, greedy_llama_payloads
+from utils import create_payload_corpus
+
+for model in ("trocr", "llama3_8b"):
+    sys.path.append(os.path.join(MODEL_REPOSITORY, model, "1"))
+from batching import bucket_by_length  # noqa: E402
+from preprocessing import BatchPreprocessor  # noqa: E402
+
+LOGO = os.path.join(ROOT, "assets", "triton_logo.png")
+BATCH_SIZE = 8
+
+
+def assert_no_errors(responses):
+    errors = [response.error().message() for response in responses if response.has_error()]
+    assert not errors, errors
+
+
+@pytest.fixture(scope="module")
+def image_data(tmp_path_factory):
+    """
+    A load_testing data file sending the repository's logo as image_bytes.
+    """
+    path = tmp_path_factory.mktemp("data") / "image.json"
+    path.write_text(json.dumps({"image_bytes": {"type": "image_bytes", "content": LOGO}}))
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def trocr(tiny_trocr_dir):
+    backend = harness.OfflineBackend(tiny_trocr_dir, parameters={"share_weights": "false"})
+    yield backend
+    backend.finalize()
+
+
+def test_trocr_preprocess(benchmark):
+    # The real model's 384x384 input, whatever the tiny model takes
+    preprocessor = BatchPreprocessor(image_size=(384, 384), num_workers=4)
+    with open(LOGO, "rb") as f:
+        images = [base64.b64encode(f.read()).decode("utf-8")] * BATCH_SIZE
+    try:
+        pixel_values = benchmark(preprocessor, images)
+    finally:
+        preprocessor.close()
+
+    assert tuple(pixel_values.shape) == (BATCH_SIZE, 3, 384, 384)
+
+
+def test_trocr_execute(benchmark, trocr, image_data):
+    payloads = create_payload_corpus(image_data, trocr.config_path, BATCH_SIZE)
+    requests = [harness.request_from_payload(payload) for payload in payloads]
+
+    responses = benchmark(trocr.execute, requests)
+
+    assert len(responses) == BATCH_SIZE
+    assert_no_errors(responses)
+
+
+def test_harness_batching(benchmark, trocr, image_data):
+    # Per request through the batcher, so batching overhead shows up
+    payloads = create_payload_corpus(image_data, trocr.config_path, 4 * BATCH_SIZE)
+
+    result = benchmark.pedantic(harness.simulate, args=(trocr, payloads), rounds=3)
+
+    assert result["summary"]["errors"] == 0
+
+
+def test_llama_bucketing(benchmark):
+    rng = random.Random(0)
+    lengths = [int(rng.lognormvariate(5, 1)) + 1 for _ in range(256)]
+
+    buckets = benchmark(bucket_by_length, lengths, max_padding=0.1, max_bucket_size=16)
+
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(lengths)))
+    assert all(len(bucket) <= 16 for bucket in buckets)
+
+
+@pytest.mark.parametrize("scheduler", ["static", "continuous"])
+def test_llama_generate(benchmark, tiny_llama_dir, scheduler):
+    backend = harness.OfflineBackend(
+        tiny_llama_dir, parameters={"scheduler": scheduler, "max_new_tokens": "16"}
+    )
+    try:
+        payloads = greedy_llama_payloads(backend.config_path, BATCH_SIZE, 16)
+        responses = benchmark(
+            lambda: backend.execute([harness.request_from_payload(p) for p in payloads])
+        )
+    finally:
+        backend.finalize()
+
+    assert len(responses) == BATCH_SIZE
+    assert_no_errors(responses)
+    tokens = [int(r.as_dict()["completion_tokens"].reshape(-1)[0]) for r in responses]
+    assert all(0 < count <= 16 for count in tokens)
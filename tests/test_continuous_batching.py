@@ -0,0 +1,77 @@
+# coding=utf-8
+
+"""
+The continuous batching engine of llama3_8b against HF `generate` with a
+tiny random Llama: greedy decoding must give the same tokens whether a
+prompt is decoded on its own or joins a running batch, as in
+benchmarks/continuous_batching.py.
+"""
+
+import itertools
+import os
+import sys
+
+import torch
+
+from conftest import MODEL_REPOSITORY, TINY_EOS_TOKEN_ID, TINY_VOCAB_SIZE, reference_output
+
+sys.path.append(os.path.join(MODEL_REPOSITORY, "llama3_8b", "1"))
+from engine import ContinuousBatchingEngine, GenerationParams, Sequence  # noqa: E402
+
+
+def random_sequences(count: int, seed: int) -> list:
+    generator = torch.Generator().manual_seed(seed)
+    seqs = []
+    for _ in range(count):
+        length = int(torch.randint(1, 60, (1,), generator=generator))
+        max_new_tokens = int(torch.randint(1, 24, (1,), generator=generator))
+        prompt = torch.randint(0, TINY_VOCAB_SIZE, (length,), generator=generator).tolist()
+        params = GenerationParams(max_new_tokens=max_new_tokens, do_sample=False)
+        seqs.append(Sequence(input_ids=prompt, params=params))
+    return seqs
+
+
+def test_joining_mid_stream_matches_generate(tiny_lm):
+    engine = ContinuousBatchingEngine(tiny_lm, eos_token_id=TINY_EOS_TOKEN_ID, max_running=4)
+    seqs = random_sequences(10, seed=1)
+
+    for seq in seqs[:5]:
+        engine.submit(seq)
+    for seq in seqs[5:]:
+        for _ in range(3):
+            engine.step()
+        engine.submit(seq)
+    engine.run_until_complete()
+
+    for seq in seqs:
+        assert seq.error is None
+        assert seq.generated == reference_output(tiny_lm, seq.input_ids, seq.params.max_new_tokens)
+    assert not engine.kv_cache.sequences
+
+
+def test_cancelled_slots_are_reused(tiny_lm):
+    engine = ContinuousBatchingEngine(tiny_lm, eos_token_id=TINY_EOS_TOKEN_ID, max_running=3)
+    seqs = random_sequences(12, seed=2)
+    slots = set()
+    for i, seq in enumerate(seqs):
+        if i % 5 == 2:
+            # Cancelled well before max_new_tokens
+            seq.params = GenerationParams(max_new_tokens=30, do_sample=False)
+            steps = itertools.count()
+            seq.stop_check = lambda steps=steps: "cancelled" if next(steps) > 6 else None
+        engine.submit(seq)
+        if i % 4 == 0:
+            engine.step()
+    while engine.has_work():
+        engine.step()
+        slots.update(seq.slot for seq in engine.kv_cache.sequences)
+
+    assert slots == {0, 1, 2}
+    assert not engine.kv_cache.sequences and engine.kv_cache.end == 0
+    for i, seq in enumerate(seqs):
+        reference = reference_output(tiny_lm, seq.input_ids, seq.params.max_new_tokens)
+        if i % 5 == 2:
+            assert seq.finish_reason == "cancelled"
+            assert seq.generated == reference[: len(seq.generated)]
+        else:
+            assert seq.generated == reference
@@ -0,0 +1,142 @@
+# coding=utf-8
+
+"""
+model_repository/document_pipeline with the tiny trocr and llama3_8b
+backends behind it, reached through the harness's BLS stand-in.
+"""
+
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import harness
+import triton_python_backend_utils as pb_utils
+from conftest import MODEL_REPOSITORY
+
+PIPELINE_DIR = os.path.join(MODEL_REPOSITORY, "document_pipeline")
+
+
+def crop_bytes(seed: int) -> bytes:
+    pixels = np.random.default_rng(seed).integers(0, 256, (24, 96, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def page_request(crops, **inputs) -> pb_utils.InferenceRequest:
+    tensors = [pb_utils.Tensor("image_bytes", np.array(crops, dtype=np.object_))]
+    for name, value in inputs.items():
+        tensors.append(pb_utils.Tensor(name, np.array([value])))
+    return pb_utils.InferenceRequest(tensors, ["generated_text", "ocr_text"])
+
+
+class Recorder:
+    """
+    Wraps a backend's execute to keep the requests it was given.
+    """
+
+    def __init__(self, backend):
+        self.batches = []
+        execute = backend.model.execute
+
+        def recording_execute(requests):
+            self.batches.append(requests)
+            return execute(requests)
+
+        backend.model.execute = recording_execute
+
+
+@pytest.fixture(scope="module")
+def models(tiny_trocr_dir, tiny_llama_dir):
+    trocr = harness.OfflineBackend(tiny_trocr_dir, parameters={"share_weights": "false"})
+    llama = harness.OfflineBackend(tiny_llama_dir, parameters={"max_new_tokens": "8"})
+    trocr.serve_bls()
+    llama.serve_bls()
+    yield trocr, llama
+    trocr.finalize()
+    llama.finalize()
+
+
+@pytest.fixture
+def pipeline(models):
+    backend = harness.OfflineBackend(PIPELINE_DIR, parameters={"ocr_batch_size": "2"})
+    yield backend
+    backend.finalize()
+
+
+def test_page_goes_through_ocr_then_llm(models, pipeline):
+    trocr, llama = models
+    crops = [crop_bytes(seed) for seed in range(5)]
+    ocr_calls, llm_calls = Recorder(trocr), Recorder(llama)
+
+    response = pipeline.execute([page_request(crops, system_message=b"Summarise.")])[0]
+
+    assert not response.has_error(), response.error()
+    outputs = response.as_dict()
+    ocr_text = outputs["ocr_text"].tolist()
+    # Batched by ocr_batch_size, with the text in crop order
+    assert sorted(len(batch[0].inputs()[0].as_numpy()) for batch in ocr_calls.batches) == [1, 2, 2]
+    direct = trocr.execute(
+        [
+            pb_utils.InferenceRequest(
+                [pb_utils.Tensor("image_bytes", np.array([[crop]], dtype=np.object_))]
+            )
+            for crop in crops
+        ]
+    )
+    assert ocr_text == [r.as_dict()["generated_text"].reshape(-1)[0] for r in direct]
+
+    (llm_request,) = [request for batch in llm_calls.batches for request in batch]
+    user_message = pb_utils.get_input_tensor_by_name(llm_request, "user_message")
+    system_message = pb_utils.get_input_tensor_by_name(llm_request, "system_message")
+    assert user_message.as_numpy().reshape(-1)[0].decode("utf-8") == "\n".join(ocr_text)
+    assert system_message.as_numpy().reshape(-1)[0] == b"Summarise."
+    assert isinstance(outputs["generated_text"].reshape(-1)[0], str)
+
+
+def test_max_new_tokens_is_passed_on(models, pipeline):
+    _, llama = models
+    llm_calls = Recorder(llama)
+
+    response = pipeline.execute(
+        [page_request([crop_bytes(0)], max_new_tokens=np.int32(3))]
+    )[0]
+
+    assert not response.has_error(), response.error()
+    (llm_request,) = llm_calls.batches[0]
+    max_new_tokens = pb_utils.get_input_tensor_by_name(llm_request, "max_new_tokens")
+    assert max_new_tokens.as_numpy().tolist() == [[3]]
+
+
+def test_pages_in_one_batch_are_answered_separately(pipeline):
+    pages = [[crop_bytes(0)], [b"not an image", crop_bytes(1)], [crop_bytes(2), crop_bytes(3)]]
+
+    responses = pipeline.execute([page_request(crops) for crops in pages])
+
+    assert [response.has_error() for response in responses] == [False, True, False]
+    assert "trocr" in responses[1].error().message()
+    assert [len(responses[i].as_dict()["ocr_text"]) for i in (0, 2)] == [1, 2]
+
+
+def test_request_without_crops_is_rejected(pipeline):
+    request = pb_utils.InferenceRequest(
+        [pb_utils.Tensor("system_message", np.array([b"Summarise."], dtype=np.object_))]
+    )
+
+    response = pipeline.execute([request])[0]
+
+    assert response.error().code() == pb_utils.TritonError.INVALID_ARG
+
+
+def test_missing_model_fails_the_request(models):
+    backend = harness.OfflineBackend(PIPELINE_DIR, parameters={"llm_model": "not_loaded"})
+    try:
+        response = backend.execute([page_request([crop_bytes(0)])])[0]
+    finally:
+        backend.finalize()
+
+    assert response.error().code() == pb_utils.TritonError.NOT_FOUND
+    assert "not_loaded" in response.error().message()
@@ -0,0 +1,76 @@
+# coding=utf-8
+
+"""
+Length bucketing in llama3_8b's static scheduler, on its own and through
+the backend with the tiny random Llama, as in benchmarks/length_bucketing.py.
+"""
+
+import os
+import sys
+
+import harness
+from conftest import MODEL_REPOSITORY, greedy_llama_payloads
+
+sys.path.append(os.path.join(MODEL_REPOSITORY, "llama3_8b", "1"))
+from batching import bucket_by_length, padding_tokens  # noqa: E402
+
+SENTENCE = "The patient reports a dry cough and mild fever for three days. "
+
+
+def test_buckets_keep_padding_under_the_limit():
+    lengths = [3, 40, 4, 41, 5, 90, 38, 6]
+
+    buckets = bucket_by_length(lengths, max_padding=0.1)
+
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(lengths)))
+    for bucket in buckets:
+        slots = max(lengths[i] for i in bucket) * len(bucket)
+        assert padding_tokens(lengths, [bucket]) <= 0.1 * slots
+    assert padding_tokens(lengths, buckets) < padding_tokens(lengths, [list(range(len(lengths)))])
+
+
+def test_bucket_caps():
+    lengths = [10] * 7
+
+    assert [len(b) for b in bucket_by_length(lengths, max_bucket_size=3)] == [3, 3, 1]
+    # (10 prompt + 5 new tokens) * 2 rows fit in 30 tokens, 3 rows don't
+    assert [len(b) for b in bucket_by_length(lengths, max_bucket_tokens=30, new_tokens=5)] == [
+        2, 2, 2, 1
+    ]
+
+
+def run(model_dir: str, max_padding: float):
+    """
+    One dynamic batch of greedy requests with prompts of mixed lengths.
+    :return: the completions in request order and the pad tokens generate was given
+    """
+    backend = harness.OfflineBackend(model_dir, parameters={"max_padding": str(max_padding)})
+    pad_tokens = []
+    generate = backend.model.model.generate
+
+    def counting_generate(*args, **kwargs):
+        pad_tokens.append(int((kwargs["attention_mask"] == 0).sum()))
+        return generate(*args, **kwargs)
+
+    backend.model.model.generate = counting_generate
+    payloads = greedy_llama_payloads(backend.config_path, 8, 8)
+    for i, payload in enumerate(payloads):
+        for input_dict in payload["inputs"]:
+            if input_dict["name"] == "user_message":
+                input_dict["data"] = [SENTENCE * (1 + (i * 7) % 16)]
+    try:
+        responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+    finally:
+        backend.finalize()
+    assert not any(response.has_error() for response in responses)
+    return [r.as_dict()["generated_text"].reshape(-1)[0] for r in responses], pad_tokens
+
+
+def test_bucketing_pads_less_with_the_same_completions(tiny_llama_dir):
+    # A max_padding of 1 keeps the whole batch in one bucket
+    unbucketed, unbucketed_pads = run(tiny_llama_dir, 1.0)
+    bucketed, bucketed_pads = run(tiny_llama_dir, 0.1)
+
+    assert len(unbucketed_pads) == 1 and len(bucketed_pads) > 1
+    assert sum(bucketed_pads) < sum(unbucketed_pads)
+    assert bucketed == unbucketed
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+"""
+The cache and speculative decoding metric families of
+backend_common/metrics.py, on their own and as the backends export them.
+"""
+
+import os
+
+import harness
+from backend_common.metrics import BackendMetrics, StubMetricsApi
+from conftest import greedy_llama_payloads
+from utils import create_payload_corpus
+
+LABELS = {"model": "m", "version": "1"}
+
+
+def test_cache_counters_follow_cumulative_stats():
+    api = StubMetricsApi()
+    metrics = BackendMetrics(api, model="m")
+    stats = {"hits": 3, "misses": 1, "hit_ratio": 0.75, "bytes": 100, "evictions": 0}
+    metrics.record_cache("prefix", stats)
+    metrics.record_cache("prefix", {**stats, "hits": 5, "misses": 3, "hit_ratio": 0.625, "evictions": 2})
+    metrics.flush(force=True)
+
+    def value(name, **labels):
+        return api.value(name, **LABELS, cache="prefix", **labels)
+
+    assert value("backend_cache_lookups_total", result="hit") == 5
+    assert value("backend_cache_lookups_total", result="miss") == 3
+    assert value("backend_cache_evictions_total") == 2
+    assert value("backend_cache_hit_ratio") == 0.625
+    assert value("backend_cache_bytes") == 100
+
+
+def test_speculative_counters_follow_cumulative_stats():
+    api = StubMetricsApi(histograms=False)
+    metrics = BackendMetrics(api, model="m")
+    metrics.record_speculative({"drafted_tokens": 8, "accepted_tokens": 6, "acceptance_rate": 0.75})
+    metrics.record_speculative({"drafted_tokens": 12, "accepted_tokens": 7, "acceptance_rate": 7 / 12})
+    metrics.flush(force=True)
+
+    assert api.value("backend_speculative_tokens_total", **LABELS, state="drafted") == 12
+    assert api.value("backend_speculative_tokens_total", **LABELS, state="accepted") == 7
+    assert api.value("backend_speculative_acceptance_rate", **LABELS) == 7 / 12
+    assert "backend_speculative_acceptance_rate{" in api.exposition()
+
+
+def run_twice(backend, payloads):
+    for _ in range(2):
+        responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+        assert not any(response.has_error() for response in responses)
+    backend.finalize()
+    return backend.model.metrics.api, {"model": backend.config.name, "version": "1"}
+
+
+def test_llama_exports_prefix_and_response_cache(tiny_llama_dir):
+    backend = harness.OfflineBackend(
+        tiny_llama_dir,
+        parameters={"scheduler": "continuous", "prefix_cache_mb": "64", "response_cache": "true"},
+    )
+    api, labels = run_twice(backend, greedy_llama_payloads(backend.config_path, 2, 4))
+
+    prefix = {**labels, "cache": "prefix"}
+    response = {**labels, "cache": "response"}
+    stats = backend.model.prefix_cache.stats()
+    assert api.value("backend_cache_lookups_total", **prefix, result="hit") == stats["hits"] > 0
+    assert api.value("backend_cache_bytes", **prefix) == stats["bytes"] > 0
+    # The second run is answered from the response cache
+    assert api.value("backend_cache_lookups_total", **response, result="miss") == 2
+    assert api.value("backend_cache_lookups_total", **response, result="hit") == 2
+    assert api.value("backend_cache_hit_ratio", **response) == 0.5
+
+
+def test_llama_exports_speculative_acceptance(tiny_llama_dir):
+    backend = harness.OfflineBackend(
+        tiny_llama_dir,
+        parameters={"draft_model": os.path.join(tiny_llama_dir, "1", "snapshot")},
+    )
+    api, labels = run_twice(backend, greedy_llama_payloads(backend.config_path, 1, 8))
+
+    stats = backend.model.speculative.stats()
+    assert api.value("backend_speculative_tokens_total", **labels, state="drafted") == stats["drafted_tokens"] > 0
+    # The draft is the target model itself, so every proposal is accepted
+    assert api.value("backend_speculative_acceptance_rate", **labels) == 1.0
+
+
+def test_trocr_exports_response_cache(tiny_trocr_dir, tmp_path):
+    data = tmp_path / "image.json"
+    data.write_text(
+        '{"image_bytes": {"type": "image_bytes", "content": "%s"}}'
+        % os.path.join(harness.ROOT, "assets", "triton_logo.png")
+    )
+    backend = harness.OfflineBackend(
+        tiny_trocr_dir, parameters={"share_weights": "false", "response_cache": "true"}
+    )
+    api, labels = run_twice(backend, create_payload_corpus(str(data), backend.config_path, 1))
+
+    response = {**labels, "cache": "response"}
+    assert api.value("backend_cache_lookups_total", **response, result="hit") == 1
+    assert api.value("backend_cache_lookups_total", **response, result="miss") == 1
+    assert api.value("backend_cache_bytes", **response) > 0
@@ -0,0 +1,82 @@
+# coding=utf-8
+
+"""
+The prefix cache of llama3_8b with a tiny random Llama, as in
+benchmarks/prefix_cache.py: completions started from a cached system
+prompt KV must match a cold `generate` over the whole prompt, and the
+cached tensors must come out of later decoding steps unchanged.
+"""
+
+import os
+import sys
+
+import torch
+
+from conftest import MODEL_REPOSITORY, TINY_EOS_TOKEN_ID, TINY_VOCAB_SIZE, reference_output
+
+sys.path.append(os.path.join(MODEL_REPOSITORY, "llama3_8b", "1"))
+from engine import ContinuousBatchingEngine, GenerationParams, Sequence  # noqa: E402
+from prefix_cache import PrefixCache, past_key_values_bytes  # noqa: E402
+
+MAX_NEW_TOKENS = 12
+
+
+def random_ids(generator, length: int) -> list:
+    return torch.randint(0, TINY_VOCAB_SIZE, (length,), generator=generator).tolist()
+
+
+def run(engine: ContinuousBatchingEngine, prefix: list, users: list) -> list:
+    """
+    Decode the prompts of one system prefix together.
+    """
+    params = GenerationParams(max_new_tokens=MAX_NEW_TOKENS, do_sample=False)
+    seqs = [
+        engine.submit(Sequence(input_ids=prefix + user, params=params, prefix_length=len(prefix)))
+        for user in users
+    ]
+    engine.run_until_complete()
+    return seqs
+
+
+def assert_matches_cold_runs(model, seqs, prefix, users):
+    for seq, user in zip(seqs, users):
+        assert seq.error is None
+        assert seq.generated == reference_output(model, prefix + user, MAX_NEW_TOKENS)
+
+
+def test_hits_and_evictions_match_cold_runs(tiny_lm):
+    generator = torch.Generator().manual_seed(0)
+    prefixes = [random_ids(generator, 48), random_ids(generator, 56)]
+    users = [[random_ids(generator, length) for length in (5, 17, 9)] for _ in prefixes]
+    with torch.inference_mode():
+        sizes = [
+            past_key_values_bytes(tiny_lm(torch.tensor([prefix]), use_cache=True).past_key_values)
+            for prefix in prefixes
+        ]
+    # Room for either prefix, but not both
+    cache = PrefixCache(max(sizes) + min(sizes) // 2)
+    engine = ContinuousBatchingEngine(
+        tiny_lm, eos_token_id=TINY_EOS_TOKEN_ID, max_running=4, prefix_cache=cache
+    )
+
+    # Miss on the first prefix, which is then cached; later prompts hit it
+    first = run(engine, prefixes[0], users[0][:1])
+    cached = cache.get(prefixes[0])
+    assert cached is not None
+    saved = [tensor.clone() for layer in cached for tensor in layer]
+    hits = run(engine, prefixes[0], users[0][1:])
+    assert_matches_cold_runs(tiny_lm, first + hits, prefixes[0], users[0])
+    assert [seq.cached_tokens for seq in hits] == [len(prefixes[0])] * len(hits)
+    for tensor, before in zip((t for layer in cached for t in layer), saved):
+        assert torch.equal(tensor, before)
+
+    # The second prefix doesn't fit next to the first, which is evicted
+    second = run(engine, prefixes[1], users[1])
+    assert_matches_cold_runs(tiny_lm, second, prefixes[1], users[1])
+    assert cache.evictions == 1
+    assert cache.get(prefixes[0]) is None
+
+    # Back to the first prefix: a miss that rebuilds it
+    again = run(engine, prefixes[0], users[0][:1])
+    assert_matches_cold_runs(tiny_lm, again, prefixes[0], users[0][:1])
+    assert again[0].cached_tokens == 0
@@ -0,0 +1,74 @@
+# coding=utf-8
+
+"""
+How quickly llama3_8b stops generating for requests nobody is waiting
+for, with each scheduler and the tiny random Llama, as in
+benchmarks/request_cancellation.py.
+"""
+
+import itertools
+import re
+
+import pytest
+
+import harness
+from conftest import greedy_llama_payloads
+
+GENERATED = re.compile(r"after (\d+) generated tokens")
+MAX_NEW_TOKENS = 64
+CANCEL_AT_STEP = 8
+# Decode steps a request may run past its cancellation or deadline
+MAX_STEPS = 2
+
+
+def completion_tokens(response) -> int:
+    """
+    Tokens generated for a response, also for the error of a stopped one.
+    """
+    if response.has_error():
+        match = GENERATED.search(response.error().message())
+        assert match is not None, response.error().message()
+        return int(match.group(1))
+    return int(response.as_dict()["completion_tokens"].reshape(-1)[0])
+
+
+@pytest.fixture(params=["static", "continuous"])
+def backend(request, tiny_llama_dir):
+    backend = harness.OfflineBackend(tiny_llama_dir, parameters={"scheduler": request.param})
+    yield backend
+    backend.finalize()
+
+
+@pytest.fixture
+def payloads(backend):
+    payloads = greedy_llama_payloads(backend.config_path, 2, MAX_NEW_TOKENS)
+    responses = backend.execute([harness.request_from_payload(p) for p in payloads])
+    # The tiny model must not stop on its own before the checks below
+    assert min(completion_tokens(r) for r in responses) > CANCEL_AT_STEP + MAX_STEPS
+    return payloads, [completion_tokens(r) for r in responses]
+
+
+def test_cancelled_request_stops(backend, payloads):
+    payloads, full = payloads
+    requests = [harness.request_from_payload(p) for p in payloads]
+    polls = itertools.count(1)
+    requests[0].is_cancelled = lambda: next(polls) >= CANCEL_AT_STEP
+
+    stopped, other = backend.execute(requests)
+
+    assert stopped.has_error()
+    assert abs(completion_tokens(stopped) - CANCEL_AT_STEP) <= MAX_STEPS
+    assert not other.has_error()
+    assert completion_tokens(other) == full[1]
+
+
+def test_expired_request_stops(backend, payloads):
+    payloads, full = payloads
+    # Expired by the time generation starts
+    payloads[0]["parameters"] = {"timeout": 1}
+
+    expired, other = backend.execute([harness.request_from_payload(p) for p in payloads])
+
+    assert expired.has_error()
+    assert completion_tokens(expired) <= MAX_STEPS
+    assert completion_tokens(other) == full[1]
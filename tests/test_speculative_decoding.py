@@ -0,0 +1,92 @@
+# coding=utf-8
+
+"""
+Speculative decoding in llama3_8b with the tiny random Llama as target, as
+in benchmarks/speculative_decoding.py: the output must match greedy
+decoding of the target whatever the draft proposes, and every accepted
+proposal saves a target forward pass.
+"""
+
+import copy
+import os
+import sys
+
+import pytest
+import torch
+
+from conftest import MODEL_REPOSITORY, TINY_EOS_TOKEN_ID, TINY_VOCAB_SIZE, reference_output
+
+sys.path.append(os.path.join(MODEL_REPOSITORY, "llama3_8b", "1"))
+from speculative import SpeculativeDecoder  # noqa: E402
+
+MAX_NEW_TOKENS = 20
+
+
+def noisy_copy(model, noise: float):
+    """
+    A draft model whose weights are the target's plus gaussian noise of
+    `noise` times each weight's std.
+    """
+    torch.manual_seed(1)
+    draft = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in draft.parameters():
+            if param.dim() > 1:
+                param.add_(torch.randn_like(param) * param.std() * noise)
+    return draft
+
+
+@pytest.fixture(scope="module")
+def prompts():
+    generator = torch.Generator().manual_seed(0)
+    return [
+        torch.randint(0, TINY_VOCAB_SIZE, (length,), generator=generator).tolist()
+        for length in (8, 23, 41)
+    ]
+
+
+def test_exact_draft_is_always_accepted(tiny_lm, prompts):
+    decoder = SpeculativeDecoder(
+        tiny_lm, tiny_lm, eos_token_id=TINY_EOS_TOKEN_ID, num_draft_tokens=4
+    )
+
+    for prompt in prompts:
+        output, stats = decoder.generate(prompt, MAX_NEW_TOKENS)
+        assert output == reference_output(tiny_lm, prompt, MAX_NEW_TOKENS)
+        assert stats.acceptance_rate == 1.0
+        # Four proposals and the target's own token per forward pass
+        assert stats.target_forwards == MAX_NEW_TOKENS // 5
+
+
+@pytest.mark.parametrize("noise", [0.05, 1.0])
+def test_output_matches_greedy_whatever_the_draft(tiny_lm, prompts, noise):
+    decoder = SpeculativeDecoder(
+        tiny_lm, noisy_copy(tiny_lm, noise), eos_token_id=TINY_EOS_TOKEN_ID, num_draft_tokens=4
+    )
+
+    for prompt in prompts:
+        output, _ = decoder.generate(prompt, MAX_NEW_TOKENS)
+        assert output == reference_output(tiny_lm, prompt, MAX_NEW_TOKENS)
+    stats = decoder.stats()
+    assert stats["generated_tokens"] == len(prompts) * MAX_NEW_TOKENS
+    assert stats["target_forwards_saved"] == stats["generated_tokens"] - stats["target_forwards"]
+    if noise < 0.1:
+        assert stats["target_forwards_saved"] > 0
+
+
+def test_tokens_stream_until_stopped(tiny_lm, prompts):
+    decoder = SpeculativeDecoder(
+        tiny_lm, tiny_lm, eos_token_id=TINY_EOS_TOKEN_ID, num_draft_tokens=4
+    )
+    streamed = []
+
+    output, stats = decoder.generate(
+        prompts[0],
+        MAX_NEW_TOKENS,
+        on_token=streamed.append,
+        should_stop=lambda: len(streamed) >= 3,
+    )
+
+    assert streamed == output
+    # Polled before each round of five tokens, so it stops after the first
+    assert len(output) == 5 and stats.target_forwards == 1